@@ -0,0 +1,66 @@
+import numpy
+import distribution
+import partial
+
+
+class AdaptiveShots():
+    """Adaptive shot allocation for one stage of the search.
+
+    Shots are issued in increments, until the confidence interval of the estimate that drives the next
+    stage meets the target, or until `max_shots` is reached. With the 'entropy' criterion, the half-width
+    of the confidence interval of the modelled entropy (in bits) is compared with the target. With the
+    'marginals' criterion, the largest half-width of the confidence intervals of the bit marginals
+    P(x_i = 1) is compared with the target. Both use the normal approximation of the binomial distribution.
+    """
+    criteria = ['entropy', 'marginals']
+
+    def __init__(
+            self,
+            increment: int = 25,
+            max_shots: int = 200,
+            target: float = 0.25,
+            criterion: str = 'entropy',
+            z: float = 1.96,
+            partial_search: partial.Partial = None
+    ):
+        """
+        :param increment: Number of shots in each increment
+        :param max_shots: Maximum number of shots per stage
+        :param target: Target half-width of the confidence interval (in bits for the 'entropy' criterion)
+        :param criterion: Estimate whose confidence interval is tested, one of `AdaptiveShots.criteria`
+        :param z: Number of standard errors in the half-width (1.96 for a 95% confidence interval)
+        :param partial_search: Partial search whose modelled state is tested (defaults to `partial.Partial()`)
+        """
+        assert criterion in self.criteria, "Unknown adaptive shots criterion: " + str(criterion)
+        assert 0 < increment <= max_shots, "The increment must be positive and at most max_shots"
+        self.increment = increment
+        self.max_shots = max_shots
+        self.target = target
+        self.criterion = criterion
+        self.z = z
+        self.partial_search = partial.Partial() if partial_search is None else partial_search
+
+    def get_marginals(self, n_index: int, n_shots: int, distrib: distribution.Distribution) -> numpy.ndarray:
+        """Returns the bit marginals of the modelled state (clamped away from 0 and 1, see `Partial.get_modelled_state`)"""
+        modelled_state = self.partial_search.get_modelled_state(n_index, n_shots, distrib)
+        return numpy.array([sin_beta**2 for cos_beta, sin_beta in modelled_state])
+
+    def get_halfwidth(self, n_index: int, n_shots: int, distrib: distribution.Distribution) -> float:
+        """Returns the half-width of the confidence interval that is tested by the selected criterion"""
+        p = self.get_marginals(n_index, n_shots, distrib)
+        variances = p*(1.0 - p)/n_shots
+        if self.criterion == 'marginals':
+            return float(self.z*numpy.sqrt(variances.max()))
+        # Delta method: the derivative of the binary entropy h(p) is log2((1-p)/p)
+        gradients = numpy.log2((1.0 - p)/p)
+        return float(self.z*numpy.sqrt(numpy.sum(gradients**2 * variances)))
+
+    def is_converged(self, n_index: int, n_shots: int, distrib: distribution.Distribution) -> bool:
+        """Returns True if no more shots are needed for this stage"""
+        if n_shots >= self.max_shots:
+            return True
+        return self.get_halfwidth(n_index, n_shots, distrib) <= self.target
+
+    def get_next_increment(self, n_shots: int) -> int:
+        """Returns the number of shots in the next increment, after `n_shots` shots"""
+        return min(self.increment, self.max_shots - n_shots)
@@ -0,0 +1,28 @@
+import os
+import pathlib
+import threading
+
+# Atomic file writes for the files that are shared between runs and processes (results chunks, sweep
+# cells, checkpoints and the gate library). The contents are written to a temporary file in the same
+# directory, which then replaces the file, so that a reader never sees a partial file, even if the
+# writer crashes.
+
+
+def write(path, write_contents, binary: bool = False) -> None:
+    """Writes a file atomically
+
+    :param path: Path of the file (its directory must exist)
+    :param write_contents: Function that writes the contents to the open file object
+    :param binary: If True, the file is opened in binary mode
+    """
+    path = pathlib.Path(path)
+    # A dot file with the process and thread IDs, so that concurrent writers never share a temporary file
+    tmp_path = path.with_name('.' + path.name + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+    try:
+        with tmp_path.open('wb' if binary else 'w') as file:
+            write_contents(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
@@ -0,0 +1,168 @@
+import argparse
+import csv
+import json
+import pathlib
+import sys
+
+import numpy
+import scrambler
+import search
+import stagetemplate
+
+# Streaming batch mode: runs the staged search on each (plain, cipher) target read from a JSONL or CSV
+# file (or stdin), and writes one JSON result line per target as soon as its search finishes. Targets
+# are read lazily, one at a time, so memory use does not grow with the size of the input. For example:
+#
+#   python3 batch.py --n-index 8 --input ../targets.jsonl --output ../results/batch.jsonl
+#   cat ../targets.csv | python3 batch.py --n-index 8 --format csv
+#
+# Each JSONL line is an object, and each CSV row has a header, with the fields `plain` and `cipher`, and
+# optionally `id` and `key` (if the key is known, the result includes the success probability).
+# Values can be integers or strings in any base that Python's int() recognizes, e.g. "0b1011" or "0x2f".
+
+
+def parse_value(value) -> int:
+    """Returns the integer value of a target field, which can be an integer or a prefixed string"""
+    if isinstance(value, int):
+        return value
+    return int(str(value).strip(), 0)
+
+
+def read_targets(stream, fmt: str = 'jsonl'):
+    """Yields the targets in the stream as dicts with the keys `id`, `plain`, `cipher` and `key` (or None)
+
+    :param stream: Text stream to read from
+    :param fmt: Input format, 'jsonl' or 'csv'
+    """
+    if fmt == 'jsonl':
+        records = (json.loads(line) for line in stream if line.strip())
+    elif fmt == 'csv':
+        records = csv.DictReader(stream)
+    else:
+        raise ValueError('Unknown target format: ' + str(fmt))
+    for i, record in enumerate(records):
+        key = record.get('key')
+        yield {
+            'id': record.get('id', i),
+            'plain': parse_value(record['plain']),
+            'cipher': parse_value(record['cipher']),
+            'key': parse_value(key) if key not in (None, '') else None
+        }
+
+
+def get_format(path: str, fmt: str = None) -> str:
+    """Returns the input format, taken from the file suffix unless it is given explicitly"""
+    if fmt is not None:
+        return fmt
+    if pathlib.Path(path).suffix.lower() == '.csv':
+        return 'csv'
+    return 'jsonl'
+
+
+def run_batch(targets, settings: dict, output, seed: int = None) -> int:
+    """Runs the search on each target and writes the results to `output` as JSON lines, as each one finishes.
+    The backend and the gates that only depend on n_index are shared by all of the targets.
+    A target whose search fails gets a result line with an `error` field.
+    Returns the number of targets that were processed.
+
+    :param targets: Iterable of targets (see `read_targets`)
+    :param settings: Search settings without the target fields (see `search.create_runner`)
+    :param output: Text stream for the results
+    :param seed: Base seed, from which a seed for each target is derived (as in `search.get_repeat_seeds`)
+    """
+    n_index = settings['n_index']
+    n_mask = (1 << n_index) - 1
+    enc = scrambler.scrambler_types[settings['scrambler']]()
+    backend = None
+    shared_gates = stagetemplate.SharedStageGates(n_index, settings.get('phase_synthesis', 'ancilla'))
+    seed_sequence = numpy.random.SeedSequence(seed) if seed is not None else None
+    n_targets = 0
+    try:
+        for target in targets:
+            for name in ['plain', 'cipher', 'key']:
+                value = target[name]
+                assert (value is None) or (value & n_mask == value), \
+                    'Target ' + str(target['id']) + ': ' + name + ' does not fit in n_index bits'
+            target_settings = dict(settings, plain=target['plain'], cipher=target['cipher'], key=target['key'])
+            runner = search.create_runner(target_settings, verbose=False, backend=backend, shared_gates=shared_gates)
+            backend = runner.backend
+            target_seed = None
+            if seed_sequence is not None:
+                # Successive spawns give the same seeds as get_repeat_seeds(seed, n_targets)
+                target_seed = int(seed_sequence.spawn(1)[0].generate_state(1)[0])
+            try:
+                result = runner.run(seed=target_seed)
+            except Exception as e:
+                # A failed search (e.g. lambda out of range after a noisy stage) does not stop the batch
+                record = {'id': target['id'], 'plain': target['plain'], 'cipher': target['cipher'],
+                          'key': target['key'], 'error': type(e).__name__ + ': ' + str(e), 'seed': target_seed}
+            else:
+                candidate = result['candidate']
+                record = {
+                    'id': target['id'],
+                    'plain': target['plain'],
+                    'cipher': target['cipher'],
+                    'key': target['key'],
+                    'candidate': candidate,
+                    'candidate_probability': result['candidate_probability'],
+                    'verified': enc.scramble(n_index, target['plain'], candidate) == target['cipher'],
+                    'verified_key': result['verified_key'],
+                    'verified_stage': result['verified_stage'],
+                    'sum_gl': result['sum_gl'],
+                    'probability': result['probability'],
+                    'entropy': result['stages'][-1]['entropy'],
+                    'seed': target_seed
+                }
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+            n_targets += 1
+    finally:
+        if backend is not None:
+            backend.close()
+    return n_targets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the staged partial search on a stream of (plain, cipher) targets')
+    parser.add_argument('--n-index', type=int, required=True)
+    parser.add_argument('--scrambler', default='basic')
+    parser.add_argument('--shots', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--folded', action='store_true', help='Use the constant-folded keyscan oracle')
+    parser.add_argument('--phase-synthesis', default='ancilla')
+    parser.add_argument('--verify-top-k', type=int, default=None,
+                        help='Verify the k most probable candidates after every stage, and stop once the key is found')
+    parser.add_argument('--input', default='-', help="Targets file, or '-' for stdin")
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default=None, help='Input format (default: from the file suffix)')
+    parser.add_argument('--output', default='-', help="Results file (JSON lines, appended), or '-' for stdout")
+    args = parser.parse_args()
+
+    # The backend is chosen by BackendSelector from the SUSD_* environment variables
+    settings = {
+        'scrambler': args.scrambler,
+        'n_index': args.n_index,
+        'n_shots': args.shots,
+        'folded_oracle': args.folded,
+        'phase_synthesis': args.phase_synthesis,
+        'verify_top_k': args.verify_top_k
+    }
+    fmt = get_format(args.input, args.format)
+    input_stream = sys.stdin if args.input == '-' else open(args.input, newline='')
+    if args.output == '-':
+        output_stream = sys.stdout
+    else:
+        output_path = pathlib.Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        output_stream = output_path.open('a')
+    try:
+        n_targets = run_batch(read_targets(input_stream, fmt), settings, output_stream, seed=args.seed)
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+    print(str(n_targets) + ' targets done', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
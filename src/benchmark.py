@@ -0,0 +1,225 @@
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import pathlib
+import resource
+import subprocess
+import sys
+import time
+
+import groverlong
+import instrument
+import scrambler
+import selector
+import search
+
+# Scaling benchmark for the staged partial search. Sweeps n_index, scrambler type, backend and shots,
+# and writes one JSON record per stage (build, transpile, execute and decode times, circuit metrics
+# and peak memory) so that runs can be compared across commits, e.g.:
+#
+#   python3 benchmark.py --n-index 4 6 8 --backend local_qiskit reduced --output ../results/bench.jsonl
+#   python3 benchmark.py --compare ../results/bench_old.jsonl ../results/bench.jsonl
+#   python3 benchmark.py --synthesis-report --n-index 4 8 12
+
+
+def get_commit() -> str:
+    """Returns the git commit hash of the checkout that contains this script, or None if it is not in a git checkout"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True, cwd=pathlib.Path(__file__).resolve().parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_peak_rss_kb() -> int:
+    """Returns the peak resident set size of this process so far, in kilobytes. Each benchmark cell runs
+    in a new process (see `run_benchmarks`), so this is the peak of the cell up to the current stage."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+# Trace spans of the stage loop that make up each step of a benchmark record
+step_spans = {
+    'build_s': ['build'],
+    'transpile_s': ['transpile'],
+    'execute_s': ['execute', 'submit', 'simulate', 'wait'],
+    'decode_s': ['decode']
+}
+
+
+def benchmark_search(runner: search.SearchRunner, seed=None) -> list:
+    """Runs the search once, through the same steps as `SearchRunner.run` (so that adaptive shots, early
+    stopping and classical verification apply), and returns one record per stage. The step times and
+    circuit metrics are taken from the trace spans of the stage, so the process-wide tracer must be an
+    `instrument.RecordingTracer` when the runner is created."""
+    tracer = runner.tracer
+    state = runner.start(seed)
+    records = []
+    while not runner.is_finished(state):
+        first_event = len(tracer.records)
+        stage, lamb, gl = runner.plan_stage(state)
+        distrib, n_shots = runner.sample_stage(stage, lamb, gl, state['modelled_state'])
+        runner.finish_stage(state, stage, lamb, gl, distrib, n_shots, seed)
+        events = tracer.records[first_event:]
+        summary = state['stages'][-1]
+        record = {'stage': stage, 'lamb': lamb, 'g_l': gl}
+        # With adaptive shots, a stage has a span for each increment
+        for name, span_names in step_spans.items():
+            durations = [event['duration_s'] for event in events if event['event'] in span_names]
+            record[name] = sum(durations) if durations else None
+        builds = [event for event in events if event['event'] == 'build']
+        # The reduced engine only simulates the x register
+        record['qubits'] = builds[-1]['qubits'] if builds else runner.n_index
+        transpiles = [event for event in events if event['event'] == 'transpile']
+        record['depth'] = transpiles[-1]['depth'] if transpiles else None
+        record['gate_counts'] = transpiles[-1]['gate_counts'] if transpiles else None
+        record['entropy'] = summary['entropy']
+        record['stage_shots'] = summary['shots']
+        record['verified'] = state['verified_key'] is not None
+        record['peak_rss_kb'] = get_peak_rss_kb()
+        records.append(record)
+    runner.get_result(state)
+    return records
+
+
+def run_cell(settings: dict, backend_name: str, seeds: list) -> tuple:
+    """Runs the repeats of one benchmark cell, and returns (setup time, device name, list of the stage records
+    of each repeat). The process-wide tracer is replaced, so the cell is meant to run in a process of its own.
+
+    :param settings: Search settings (see `search.create_runner`)
+    :param backend_name: Backend (see `selector.BackendSelector`), which is configured from the other SUSD_* variables
+    :param seeds: Seed of each repeat
+    """
+    # The runner takes the process-wide tracer, so that benchmark_search can read the spans of each stage.
+    # Spans are still written to SUSD_TRACE, if it is set.
+    instrument.set_tracer(instrument.RecordingTracer(instrument.get_tracer().stream))
+    start = time.perf_counter()
+    backend = selector.BackendSelector(backend_name).select(settings['n_index'], settings['folded_oracle'])
+    runner = search.create_runner(settings, verbose=False, backend=backend)
+    setup_s = time.perf_counter() - start
+    try:
+        repeats = [benchmark_search(runner, seed) for seed in seeds]
+    finally:
+        runner.backend.close()
+    return setup_s, runner.backend.device, repeats
+
+
+def run_benchmarks(args) -> None:
+    commit = get_commit()
+    output_path = pathlib.Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    seeds = search.get_repeat_seeds(args.seed, args.repeats)
+    # Each cell runs in a new process, so that its peak memory is not the peak of an earlier (larger) cell
+    context = multiprocessing.get_context('spawn')
+    with output_path.open('a') as file:
+        for n_index, scrambler_type, backend_name, n_shots in itertools.product(
+                args.n_index, args.scrambler, args.backend, args.shots):
+            n_mask = (1 << n_index) - 1
+            settings = {
+                'scrambler': scrambler_type,
+                'n_index': n_index,
+                'plain': scrambler.default_plain & n_mask,
+                'key': scrambler.default_key & n_mask,
+                'n_shots': n_shots,
+                'folded_oracle': args.folded,
+                'phase_synthesis': args.phase_synthesis
+            }
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                setup_s, device, repeats = executor.submit(run_cell, settings, backend_name, seeds).result()
+            for r, records in enumerate(repeats):
+                for record in records:
+                    record.update({
+                        'commit': commit,
+                        'time': time.time(),
+                        'n_index': n_index,
+                        'scrambler': scrambler_type,
+                        'backend': backend_name,
+                        'device': device,
+                        'shots': n_shots,
+                        'folded_oracle': args.folded,
+                        'phase_synthesis': args.phase_synthesis,
+                        'repeat': r,
+                        'setup_s': setup_s
+                    })
+                    file.write(json.dumps(record) + '\n')
+            file.flush()
+            print('n_index=' + str(n_index) + ' scrambler=' + scrambler_type + ' backend=' + backend_name +
+                  ' shots=' + str(n_shots) + ' done')
+
+
+def get_cell_key(record: dict) -> tuple:
+    return (record['n_index'], record['scrambler'], record['backend'], record['shots'],
+            record['folded_oracle'], record['phase_synthesis'])
+
+
+def load_totals(path: str) -> dict:
+    """Returns the mean total time (build+transpile+execute+decode) per repeat, for each benchmark cell"""
+    totals = collections.defaultdict(lambda: collections.defaultdict(float))
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            total = sum(record[k] or 0.0 for k in ['build_s', 'transpile_s', 'execute_s', 'decode_s'])
+            totals[get_cell_key(record)][record['repeat']] += total
+    return {cell: sum(repeats.values())/len(repeats) for cell, repeats in totals.items()}
+
+
+def compare(base_path: str, new_path: str) -> None:
+    """Prints the ratio of the mean total time per repeat (new/base) for the cells present in both files"""
+    base = load_totals(base_path)
+    new = load_totals(new_path)
+    print('n_index,scrambler,backend,shots,folded_oracle,phase_synthesis,base_s,new_s,ratio')
+    for cell in sorted(set(base) & set(new)):
+        ratio = new[cell]/base[cell] if base[cell] > 0.0 else float('nan')
+        print(','.join(str(c) for c in cell) + ',' + '%.4f,%.4f,%.3f' % (base[cell], new[cell], ratio))
+
+
+def print_synthesis_report(n_indexes: list) -> None:
+    """Prints the transpiled depth and CX count of the kickback oracle and the diffusion phase for every
+    phase synthesis strategy (see `GroverLong.get_synthesis_report`), as one CSV line per n_index and strategy.
+    The kickback tests all of the flag bits, as in the last stage."""
+    grover = groverlong.GroverLong()
+    # Phase of a single iteration at lambda = 1/2
+    phase = grover.get_alpha(0.5, grover.get_g(0.5))
+    print('n_index,phase_synthesis,kickback_depth,kickback_cx,diffusion_depth,diffusion_cx')
+    for n_index in n_indexes:
+        report = grover.get_synthesis_report(n_index, list(range(n_index)), phase)
+        for strategy, metrics in report.items():
+            print(','.join(str(v) for v in [
+                n_index, strategy, metrics['kickback']['depth'], metrics['kickback']['cx'],
+                metrics['diffusion']['depth'], metrics['diffusion']['cx']
+            ]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmark for the staged partial search')
+    parser.add_argument('--n-index', type=int, nargs='+', default=[4, 6, 8])
+    parser.add_argument('--scrambler', nargs='+', default=['basic'])
+    parser.add_argument('--backend', nargs='+', default=['local_qiskit'])
+    parser.add_argument('--shots', type=int, nargs='+', default=[100])
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--folded', action='store_true', help='Use the constant-folded keyscan oracle')
+    parser.add_argument('--phase-synthesis', default='ancilla')
+    parser.add_argument('--output', default='../results/benchmark.jsonl')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='Compare two benchmark files')
+    parser.add_argument('--synthesis-report', action='store_true',
+                        help='Print the depth and CX count of each phase synthesis strategy for each n_index')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    elif args.synthesis_report:
+        print_synthesis_report(args.n_index)
+    else:
+        run_benchmarks(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+
+import checkpoint
+import selector
+import search
+import stagetemplate
+
+
+class Campaign():
+    """Drives many independent partial searches concurrently with asyncio.
+
+    Each search keeps its own stage state (see `SearchRunner.new_state`). The blocking part of a stage
+    (building, submitting and waiting for the job) runs in a worker thread, so that while one search
+    waits for its stage-k result, the others can submit their circuits. The number of jobs in flight
+    is bounded separately for each backend target (backend type and device).
+    """
+
+    def __init__(self, max_in_flight: int = 4):
+        """
+        :param max_in_flight: Maximum number of stage jobs in flight per backend target
+        """
+        self.max_in_flight = max_in_flight
+        self._semaphores = dict()
+        self._executor = None
+
+    def _get_semaphore(self, backend: selector.Backend) -> asyncio.Semaphore:
+        target = (type(backend).__name__, backend.device)
+        if target not in self._semaphores:
+            self._semaphores[target] = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphores[target]
+
+    async def run_search(self, runner: search.SearchRunner, seed=None, checkpoint_file: checkpoint.Checkpoint = None) -> dict:
+        """Runs all of the stages of one search and returns its result, with the same steps as `SearchRunner.run`.
+        Every stage job gets its shots and seed from the runner, so seeded searches are deterministic
+        even when they share the backend.
+
+        :param seed: Optional seed for the shot sampling of the search
+        :param checkpoint_file: If given, the search state is saved after every stage, and a search with a saved
+            state is resumed after its last finished stage (see `checkpoint.Checkpoint`)
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self._get_semaphore(runner.backend)
+        # Each search runs in its own asyncio task, so the tracer context (stage, seed) is per search
+        state = runner.start(seed, checkpoint_file)
+        while not runner.is_finished(state):
+            stage, lamb, gl = runner.plan_stage(state)
+            async with semaphore:
+                # run_in_executor() does not pass the context on to the worker thread
+                sample_stage = functools.partial(contextvars.copy_context().run, runner.sample_stage)
+                distrib, n_shots = await loop.run_in_executor(
+                    self._executor, sample_stage, stage, lamb, gl, state['modelled_state']
+                )
+            runner.finish_stage(state, stage, lamb, gl, distrib, n_shots, seed, checkpoint_file)
+        result = runner.get_result(state)
+        result['seed'] = seed
+        return result
+
+    async def run(self, runners: list, seeds: list = None, checkpoint_files: list = None) -> list:
+        """Runs all of the searches concurrently and returns their results in the same order.
+        A search that fails does not stop the others: its entry in the results is the exception.
+
+        :param checkpoint_files: Optional checkpoint file (or None) for each search
+        """
+        if seeds is None:
+            seeds = [None] * len(runners)
+        if checkpoint_files is None:
+            checkpoint_files = [None] * len(runners)
+        # Enough threads for every backend target to have max_in_flight jobs
+        targets = set((type(r.backend).__name__, r.backend.device) for r in runners)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight * len(targets)) as executor:
+            self._executor = executor
+            try:
+                return await asyncio.gather(
+                    *[self.run_search(r, s, c) for r, s, c in zip(runners, seeds, checkpoint_files)],
+                    return_exceptions=True
+                )
+            finally:
+                self._executor = None
+
+
+def create_runners(settings_list: list, verbose: bool = False) -> list:
+    """Creates one search runner per settings dict (see `search.create_runner`). The runners share
+    a single backend, except for the reduced backend, which holds a separate engine per target.
+    Runners with the same n_index and phase synthesis also share the gates that only depend on them
+    (see `stagetemplate.SharedStageGates`), so that their stage templates have the same parameters
+    and can reuse each other's transpiled circuits."""
+    # The shared backend must fit the largest of the stage circuits
+    n_index = max(settings['n_index'] for settings in settings_list)
+    folded_oracle = all(settings['folded_oracle'] for settings in settings_list)
+    depths = [settings.get('stage_depth') for settings in settings_list]
+    depth = None if None in depths else max(depths)
+    backend = selector.BackendSelector().select(n_index, folded_oracle, depth)
+    runners = []
+    shared_gates = dict()
+    for settings in settings_list:
+        if isinstance(backend, selector.ReducedBackend):
+            if runners:
+                backend = selector.BackendSelector().select(n_index, folded_oracle, depth)
+            runners.append(search.create_runner(settings, verbose=verbose, backend=backend))
+            continue
+        key = (settings['n_index'], settings.get('phase_synthesis', 'ancilla'))
+        if key not in shared_gates:
+            shared_gates[key] = stagetemplate.SharedStageGates(*key)
+        runners.append(search.create_runner(settings, verbose=verbose, backend=backend, shared_gates=shared_gates[key]))
+    return runners
+
+
+def run_campaign(
+        settings_list: list,
+        max_in_flight: int = 4,
+        seed: int = None,
+        checkpoint_dir=None,
+        resume: bool = False
+) -> list:
+    """Runs a partial search for each settings dict concurrently and returns the results in order
+
+    :param settings_list: List of search settings (see `search.create_runner`)
+    :param max_in_flight: Maximum number of stage jobs in flight per backend target
+    :param seed: Base seed for the searches
+    :param checkpoint_dir: If given, each search saves its state to a checkpoint file in this directory after every stage
+    :param resume: If True, searches with a checkpoint file are resumed after their last finished stage
+        (finished searches are not run again)
+    """
+    runners = create_runners(settings_list)
+    seeds = search.get_repeat_seeds(seed, len(runners))
+    checkpoint_files = search.get_checkpoints(settings_list, checkpoint_dir, resume, prefix='search-')
+    try:
+        return asyncio.run(Campaign(max_in_flight).run(runners, seeds, checkpoint_files))
+    finally:
+        for backend in set(r.backend for r in runners):
+            backend.close()
@@ -0,0 +1,110 @@
+import json
+import pathlib
+
+import numpy
+import atomicfile
+import distribution
+
+# Per-stage checkpoints for the staged search. After every stage, the search state (the stage index, the
+# modelled state and entropy, the running totals, the per-stage summaries and the last measured distribution)
+# is written to a JSON file together with the run configuration, the seed and the state of the search's
+# random number generator. A search that is interrupted (e.g. by a crash or a remote timeout) can then be
+# resumed after its last finished stage, instead of running (and paying for) every stage again.
+
+# Version of the checkpoint file format
+format_version = 1
+
+
+class Checkpoint():
+    """Checkpoint file for one search (see `search.SearchRunner.run`)"""
+
+    def __init__(self, path, config: dict, resume: bool = True):
+        """
+        :param path: Path of the checkpoint file (the parent directory is created if it does not exist)
+        :param config: Run configuration (e.g. the settings of `search.create_runner`), which must match
+            the configuration in the file when resuming
+        :param resume: If True, `load()` returns the saved state, if any. Otherwise the search starts from
+            stage 1 and the file is overwritten.
+        """
+        self.path = pathlib.Path(path)
+        self.config = config
+        self.resume = resume
+
+    def save(self, state: dict, seed=None, rng_state: dict = None) -> None:
+        """Writes the search state after a finished stage (see `search.SearchRunner.new_state`)
+
+        :param seed: Seed of the search
+        :param rng_state: State of the search's random number generator (see `search.SearchRunner.get_rng_state`)
+        """
+        data = {
+            'version': format_version,
+            'config': get_json_config(self.config),
+            'seed': seed,
+            'rng_state': rng_state,
+            'state': get_json_state(state)
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        atomicfile.write(self.path, lambda file: json.dump(data, file))
+
+    def load(self, seed=None) -> tuple:
+        """Returns (state, rng_state) from the checkpoint file, or (None, None) if there is nothing to resume
+
+        :param seed: Seed of the search, which must match the seed in the file
+        """
+        if (not self.resume) or (not self.path.exists()):
+            return None, None
+        with self.path.open() as file:
+            data = json.load(file)
+        if data.get('version') != format_version:
+            raise ValueError('Unsupported checkpoint version in ' + str(self.path) + ': ' + str(data.get('version')))
+        if data['config'] != get_json_config(self.config):
+            raise ValueError('The checkpoint ' + str(self.path) + ' was written for another configuration')
+        if data['seed'] != seed:
+            raise ValueError('The checkpoint ' + str(self.path) + ' was written for seed ' + str(data['seed']))
+        return from_json_state(data['state']), data['rng_state']
+
+
+def get_json_config(config: dict) -> dict:
+    """Returns the configuration as it is stored in a checkpoint file (e.g. tuples become lists)"""
+    return json.loads(json.dumps(config, default=_to_json))
+
+
+def get_json_state(state: dict) -> dict:
+    """Returns a JSON-serializable copy of a search state"""
+    data = {name: value for name, value in state.items() if name not in ['modelled_state', 'distrib']}
+    modelled_state = state['modelled_state']
+    data['modelled_state'] = None if modelled_state is None else [[float(c), float(s)] for c, s in modelled_state]
+    distrib = state['distrib']
+    data['distrib'] = None if distrib is None else {
+        'outcomes': [int(v) for v in distrib.outcomes.tolist()],
+        'probs': distrib.probs.tolist(),
+        'shots': distrib.shots,
+        'exact': distrib.exact
+    }
+    return json.loads(json.dumps(data, default=_to_json))
+
+
+def from_json_state(data: dict) -> dict:
+    """Returns the search state for the output of `get_json_state()`"""
+    state = dict(data)
+    if data['modelled_state'] is not None:
+        state['modelled_state'] = [(c, s) for c, s in data['modelled_state']]
+    if data['distrib'] is not None:
+        outcomes = data['distrib']['outcomes']
+        dtype = numpy.int64 if all(v < (1 << 63) for v in outcomes) else object
+        state['distrib'] = distribution.Distribution(
+            numpy.array(outcomes, dtype=dtype),
+            numpy.array(data['distrib']['probs'], dtype=numpy.float64),
+            data['distrib']['shots'],
+            exact=data['distrib']['exact']
+        )
+    return state
+
+
+def _to_json(value):
+    # NumPy scalars and arrays, e.g. in the per-stage summaries
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    raise TypeError('Cannot store a value of type ' + type(value).__name__ + ' in a checkpoint')
@@ -0,0 +1,137 @@
+import numpy
+
+
+class Distribution():
+    """Normalized distribution of measured outcomes, held as NumPy arrays.
+
+    `outcomes` holds the packed integer value of each distinct outcome (bit `i` is qubit `i`, as in Qiskit)
+    and `probs` holds the corresponding probabilities. Registers are sliced out with vectorized bit
+    operations, e.g. the x register is `get_register(0, n_index)` and the y register is
+    `get_register(n_index, n_index)`.
+
+    An exact distribution holds the ideal probabilities (e.g. from a statevector) instead of
+    normalized shot counts.
+    """
+
+    def __init__(self, outcomes: numpy.ndarray, probs: numpy.ndarray, shots: int = None, exact: bool = False):
+        self.outcomes = outcomes
+        self.probs = probs
+        self.shots = shots
+        self.exact = exact
+
+    def __len__(self) -> int:
+        return len(self.outcomes)
+
+    def items(self):
+        """Iterates over (outcome, probability) pairs, like a dict or a `QuasiDistribution`"""
+        return zip(self.outcomes.tolist(), self.probs.tolist())
+
+    def get_register(self, offset: int, width: int) -> numpy.ndarray:
+        """Returns the value of the register of `width` qubits starting at qubit `offset`, for each outcome"""
+        mask = (1 << width) - 1
+        return (self.outcomes >> offset) & mask
+
+    def get_counts(self, n_shots: int) -> numpy.ndarray:
+        """Returns the (truncated) number of shots for each outcome"""
+        return numpy.trunc(self.probs * n_shots)
+
+    def get_bits(self, n_bits: int) -> numpy.ndarray:
+        """Returns a (outcomes x n_bits) boolean array of the values of the qubits `0..n_bits-1` in each outcome"""
+        shifts = numpy.arange(n_bits)
+        if self.outcomes.dtype == object:
+            shifts = shifts.astype(object)
+        return ((self.outcomes[:, numpy.newaxis] >> shifts) & 1).astype(bool)
+
+    def get_bit_counts(self, n_bits: int, n_shots: int) -> numpy.ndarray:
+        """Returns the number of shots in which each of the qubits `0..n_bits-1` was measured as 1"""
+        return self.get_counts(n_shots) @ self.get_bits(n_bits)
+
+    def get_bit_marginals(self, n_bits: int) -> numpy.ndarray:
+        """Returns the probability P(q_i = 1) for each of the qubits `0..n_bits-1`"""
+        return self.probs @ self.get_bits(n_bits)
+
+    def get_most_common(self, n_index: int, n_shots: int, n: int = 32) -> list:
+        """Returns the `n` most common outcomes as a list of ((bin(x register), bin(y register)), count),
+        in the same form as `collections.Counter.most_common()`"""
+        top = numpy.argsort(-self.probs, kind='stable')[:n]
+        x_reg = self.get_register(0, n_index)[top]
+        y_reg = self.get_register(n_index, n_index)[top]
+        counts = self.get_counts(n_shots)[top]
+        return [((bin(x), bin(y)), int(c)) for x, y, c in zip(x_reg.tolist(), y_reg.tolist(), counts.tolist())]
+
+    def get_top_register_values(self, offset: int, width: int, n: int = 1) -> list:
+        """Returns the `n` most probable values of the given register as a list of (value, probability),
+        where the probability of each value is summed over all of the other qubits"""
+        values, inverse = numpy.unique(self.get_register(offset, width), return_inverse=True)
+        sums = numpy.bincount(inverse.ravel(), weights=self.probs, minlength=len(values))
+        top = numpy.argsort(-sums, kind='stable')[:n]
+        return [(int(v), float(p)) for v, p in zip(values[top].tolist(), sums[top].tolist())]
+
+    def get_probability(self, n_index: int, n_shots: int, x_value: int, y_value: int = 0) -> float:
+        """Returns the measured probability of the given x and y register values"""
+        match = (self.get_register(0, n_index) == x_value) & (self.get_register(n_index, n_index) == y_value)
+        if self.exact:
+            return float(self.probs[match].sum())
+        return float(self.get_counts(n_shots)[match].sum()) / float(n_shots)
+
+    def to_quasi_distribution(self):
+        """Returns a `qiskit.result.QuasiDistribution` view of this distribution"""
+        import qiskit.result
+        return qiskit.result.QuasiDistribution(dict(self.items()), shots=self.shots)
+
+
+def _get_outcome_dtype(width: int):
+    # Python ints are needed if the packed outcomes do not fit in an int64
+    return numpy.int64 if width <= 63 else object
+
+
+def from_counts(counts: dict, shots: int) -> Distribution:
+    """Returns the normalized distribution for a dict of Qiskit counts, keyed by bit strings
+    (most significant qubit first)"""
+    keys = [bits.replace(' ', '') for bits in counts.keys()]
+    width = max((len(bits) for bits in keys), default=0)
+    if (width <= 63) and all(len(bits) == width for bits in keys):
+        # Decode all of the bit strings at once, as a (len(keys) x width) array of 0/1 digits
+        digits = numpy.frombuffer(''.join(keys).encode('ascii'), dtype=numpy.uint8).reshape(len(keys), width)
+        weights = numpy.left_shift(1, numpy.arange(width-1, -1, -1, dtype=numpy.int64))
+        outcomes = (digits - ord('0')).astype(numpy.int64) @ weights
+    else:
+        outcomes = numpy.array([int(bits, 2) for bits in keys], dtype=_get_outcome_dtype(width))
+    probs = numpy.fromiter(counts.values(), dtype=numpy.float64, count=len(counts)) / float(shots)
+    return Distribution(outcomes, probs, shots)
+
+
+def from_dict(distrib: dict, shots: int = None, width: int = 63, exact: bool = False) -> Distribution:
+    """Returns the distribution for a dict of probabilities keyed by integer outcomes
+    (e.g. a `qiskit.result.QuasiDistribution`)"""
+    outcomes = numpy.array(list(distrib.keys()), dtype=_get_outcome_dtype(width))
+    probs = numpy.fromiter(distrib.values(), dtype=numpy.float64, count=len(distrib))
+    return Distribution(outcomes, probs, shots, exact=exact)
+
+
+def get_marginal_matrix(distribs: list, n_bits: int, shots: list = None) -> numpy.ndarray:
+    """Returns the (runs x n_bits) matrix of the bit marginals P(q_i = 1) of several distributions, e.g. for
+    `Partial.get_modelled_states`. With shots, the marginals are computed from the (truncated) shot counts,
+    as in `Partial.get_modelled_state`.
+
+    :param distribs: List of normalized distributions, one per run
+    :param n_bits: Number of bits, i.e. the qubits `0..n_bits-1`
+    :param shots: Number of shots behind each distribution, or None for the exact marginals
+    """
+    if shots is None:
+        return numpy.array([d.get_bit_marginals(n_bits) for d in distribs]).reshape(len(distribs), n_bits)
+    return numpy.array([d.get_bit_counts(n_bits, n)/n for d, n in zip(distribs, shots)]).reshape(len(distribs), n_bits)
+
+
+def merge(distribs: list, shots: list) -> Distribution:
+    """Returns the distribution of the pooled shots from several runs of the same circuit
+
+    :param distribs: List of normalized distributions
+    :param shots: Number of shots behind each distribution
+    """
+    outcomes = numpy.concatenate([d.outcomes for d in distribs])
+    weights = numpy.concatenate([d.probs * n for d, n in zip(distribs, shots)])
+    values, inverse = numpy.unique(outcomes, return_inverse=True)
+    total_shots = sum(shots)
+    probs = numpy.bincount(inverse.ravel(), weights=weights, minlength=len(values)) / float(total_shots)
+    return Distribution(values, probs, total_shots)
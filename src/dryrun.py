@@ -0,0 +1,308 @@
+import argparse
+import json
+import sys
+
+import numpy
+import qiskit
+import groverlong
+import partial
+import resources
+import scrambler
+import search
+import selector
+import sweep
+
+# Dry run of the full stage schedule. For each stage, estimates lambda, g_l and the phase, the width of the
+# stage circuit, its depth and CX count (transpiled to the u, cx basis) and the runtime on each backend,
+# without running any jobs. The modelled entropy that drives lambda comes from an assumed trajectory (the
+# entropy drops by a fixed number of bits per stage, 1.0 being the ideal partial search) or from simulated
+# trajectories (seeded searches on the reduced NumPy engine, which are cheap up to n_index ~ 20). The totals
+# include SUM_GL, the total runtime and the memory needed by each backend, with the backends that do not
+# fit the memory budget (see `selector.BackendSelector.get_memory_budget`) marked as infeasible. For example:
+#
+#   python3 dryrun.py --n-index 8 12 16 20
+#   python3 dryrun.py --n-index 10 --trajectory simulated --trajectories 20 --seed 1
+#
+# The runtimes use the rough figures in `resources.runtime_constants`. On IBM Cloud, the circuits are
+# transpiled to the coupling map of the device, so the actual depth is larger than the estimate.
+
+
+def get_assumed_trajectory(partial_search: partial.Partial, n_index: int, bits_per_stage: float = 1.0) -> tuple:
+    """Returns (entropies, lambdas) as (1 x n_index) arrays for a modelled entropy that drops by `bits_per_stage`
+    in each stage. The entropy of each stage is the entropy before the stage."""
+    stages = numpy.arange(1, n_index+1)
+    entropies = numpy.maximum(n_index - bits_per_stage*(stages - 1), 0.0)
+    lambdas = partial_search.get_lambda_values(n_index, stages, entropies)
+    return entropies[numpy.newaxis, :], lambdas[numpy.newaxis, :]
+
+
+def get_simulated_trajectories(runner: search.SearchRunner, n_trajectories: int, seed: int = None) -> tuple:
+    """Returns (entropies, lambdas, failures): (trajectories x n_index) arrays of the entropy before each stage
+    and of lambda, from seeded searches on the runner (which should use the reduced engine), and the number of
+    searches that failed with lambda out of range (see `sweep.is_lambda_error`), which are left out of the arrays.
+    Any other exception is raised."""
+    n_index = runner.n_index
+    entropies = []
+    lambdas = []
+    failures = 0
+    for trajectory_seed in search.get_repeat_seeds(seed, n_trajectories):
+        try:
+            result = runner.run(seed=trajectory_seed)
+        except AssertionError as e:
+            if not sweep.is_lambda_error(e):
+                raise
+            failures += 1
+            continue
+        stage_entropies = [stage['entropy'] for stage in result['stages']]
+        entropies.append([float(n_index)] + stage_entropies[:-1])
+        lambdas.append([stage['lamb'] for stage in result['stages']])
+    return numpy.array(entropies).reshape(-1, n_index), numpy.array(lambdas).reshape(-1, n_index), failures
+
+
+def get_iterations(lambdas: numpy.ndarray) -> tuple:
+    """Returns (g_l, phases) arrays for an array of lambdas, with 0 and NaN where lambda is out of range"""
+    grover = groverlong.GroverLong()
+    valid = (lambdas > 0.0) & (lambdas <= groverlong.max_lambda)
+    gls = numpy.zeros(lambdas.shape, dtype=numpy.int64)
+    phases = numpy.full(lambdas.shape, numpy.nan)
+    if valid.any():
+        gls[valid] = grover.get_g(lambdas[valid])
+        phases[valid] = grover.get_alpha(lambdas[valid], gls[valid])
+    return gls, phases
+
+
+def get_circuit_metrics(runner: search.SearchRunner, stage: int, lamb: float, gl: int) -> dict:
+    """Returns the `depth`, `size` and `cx` count of the stage circuit, transpiled to the u, cx basis"""
+    circ, parameter_values = runner.build_stage(stage, lamb, gl)
+    new_circuit = qiskit.transpile(circ.assign_parameters(parameter_values), basis_gates=['u', 'cx'], optimization_level=1)
+    return {'depth': new_circuit.depth(), 'size': new_circuit.size(), 'cx': new_circuit.count_ops().get('cx', 0)}
+
+
+def plan_schedule(
+        settings: dict,
+        trajectory: str = 'assumed',
+        bits_per_stage: float = 1.0,
+        n_trajectories: int = 10,
+        seed: int = None,
+        backends: list = None,
+        queue_time: float = None,
+        max_transpile_qubits: int = 21
+) -> dict:
+    """Returns the estimated schedule of a search: a dict with the per-stage estimates (`stages`), `sum_gl`,
+    the number of failed simulated trajectories (`failures`), and the `runtime`, `memory`, `feasible`
+    flag and simulation `methods` of each backend. The simulation method of each backend is the one that
+    `selector.BackendSelector` configures from the SUSD_* environment variables (e.g. SUSD_AER_METHOD).
+
+    :param settings: Search settings (see `search.create_runner`)
+    :param trajectory: 'assumed' or 'simulated'
+    :param bits_per_stage: Drop of the modelled entropy in each stage, for the assumed trajectory
+    :param n_trajectories: Number of simulated trajectories
+    :param seed: Base seed for the simulated trajectories
+    :param backends: Names of the backends to estimate (defaults to all of `resources.backend_methods`)
+    :param queue_time: Queue time of a job on IBM Cloud, in seconds
+    :param max_transpile_qubits: The stage circuits are only built and transpiled up to this width; the depth,
+        CX count and the runtimes that depend on them are None for wider circuits
+    """
+    if backends is None:
+        backends = list(resources.backend_methods.keys())
+    n_index = settings['n_index']
+    folded = settings['folded_oracle']
+    n_shots = settings['n_shots']
+    n_qubits = resources.get_stage_qubits(n_index, folded)
+    failures = 0
+    if trajectory == 'simulated':
+        # The searches only run classically, on the reduced engine
+        simulation_runner = search.create_runner(settings, verbose=False, backend=selector.ReducedBackend(None))
+        entropies, lambdas, failures = get_simulated_trajectories(simulation_runner, n_trajectories, seed)
+    elif trajectory == 'assumed':
+        entropies, lambdas = get_assumed_trajectory(search.get_partial_search(settings), n_index, bits_per_stage)
+    else:
+        raise ValueError('Unknown trajectory: ' + str(trajectory))
+    gls, phases = get_iterations(lambdas)
+
+    circuit_runner = None
+    if n_qubits <= max_transpile_qubits:
+        enc = scrambler.scrambler_types[settings['scrambler']]()
+        cipher = settings.get('cipher')
+        if cipher is None:
+            cipher = enc.scramble(n_index, settings['plain'], settings['key'])
+        # A runner with the base backend only builds the stage circuits
+        circuit_runner = search.SearchRunner(
+            selector.Backend(),
+            enc,
+            n_index,
+            settings['plain'],
+            cipher,
+            n_shots=n_shots,
+            folded_oracle=folded,
+            phase_synthesis=settings.get('phase_synthesis', 'ancilla'),
+            verbose=False
+        )
+    stages = []
+    runtime = {name: 0.0 for name in backends}
+    for i in range(n_index):
+        stage = i + 1
+        out_of_range = int(numpy.sum(gls[:, i] == 0))
+        # The circuit of the stage is estimated for the largest g_l over the trajectories
+        gl = int(gls[:, i].max()) if len(gls) > 0 else 0
+        record = {
+            'stage': stage,
+            'entropy': float(entropies[:, i].mean()) if len(entropies) > 0 else None,
+            'lamb': float(lambdas[:, i].mean()) if len(lambdas) > 0 else None,
+            'g_l': gl,
+            'mean_g_l': float(gls[:, i].mean()) if len(gls) > 0 else None,
+            'phase': float(numpy.nanmean(phases[:, i])/numpy.pi) if gl > 0 else None,
+            'out_of_range': out_of_range,
+            'qubits': n_qubits,
+            'depth': None,
+            'size': None,
+            'cx': None
+        }
+        if (circuit_runner is not None) and (gl > 0):
+            lamb = float(lambdas[:, i][gls[:, i] == gl].mean())
+            record.update(get_circuit_metrics(circuit_runner, stage, lamb, gl))
+        record['runtime'] = dict()
+        for name in backends:
+            stage_runtime = resources.estimate_runtime(
+                name, n_index, folded, shots=n_shots, g_l=gl, size=record['size'], depth=record['depth'], queue_time=queue_time
+            ) if gl > 0 else None
+            record['runtime'][name] = stage_runtime
+            if (stage_runtime is None) or (runtime[name] is None):
+                runtime[name] = None
+            else:
+                runtime[name] += stage_runtime
+        stages.append(record)
+
+    backend_selector = selector.BackendSelector()
+    budget = backend_selector.get_memory_budget()
+    aer_method = backend_selector.get_aer_method()
+    mps_max_bond = backend_selector.get_mps_max_bond()
+    # The deepest of the transpiled stage circuits bounds the bond dimension of an MPS
+    depths = [record['depth'] for record in stages if record['depth'] is not None]
+    depth = max(depths) if depths else None
+    methods = dict()
+    memory = dict()
+    feasible = dict()
+    for name in backends:
+        method = backend_selector.get_memory_method(name, aer_method)
+        methods[name] = method
+        memory[name] = None if method is None else resources.estimate_memory(
+            method, n_index, folded, depth=depth, max_bond=mps_max_bond
+        )
+        feasible[name] = (memory[name] is None) or (budget is None) or (memory[name] <= budget)
+    return {
+        'n_index': n_index,
+        'qubits': n_qubits,
+        'trajectory': trajectory,
+        'trajectories': len(gls),
+        'failures': failures,
+        'sum_gl': float(gls.sum(axis=1).mean()) if len(gls) > 0 else None,
+        'max_sum_gl': int(gls.sum(axis=1).max()) if len(gls) > 0 else None,
+        'stages': stages,
+        'runtime': runtime,
+        'memory': memory,
+        'methods': methods,
+        'memory_budget': budget,
+        'feasible': feasible
+    }
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds is None:
+        return '-'
+    for unit, size in [('d', 86400.0), ('h', 3600.0), ('m', 60.0)]:
+        if seconds >= size:
+            return '%.1f%s' % (seconds/size, unit)
+    return '%.3gs' % seconds
+
+
+def print_schedule(schedule: dict, file=sys.stdout) -> None:
+    """Prints the estimated schedule as a table with one row per stage, followed by the totals"""
+    backends = list(schedule['runtime'].keys())
+    print('n_index = ' + str(schedule['n_index']) + ' (' + str(schedule['qubits']) + ' qubits), ' +
+          schedule['trajectory'] + ' trajectory' +
+          (' (' + str(schedule['trajectories']) + ' runs, ' + str(schedule['failures']) + ' failed)'
+           if schedule['trajectory'] == 'simulated' else ''), file=file)
+    columns = ['stage', 'entropy', 'lambda', 'g_l', 'phase/pi', 'qubits', 'depth', 'cx'] + backends
+    rows = []
+    for record in schedule['stages']:
+        row = [
+            str(record['stage']),
+            '-' if record['entropy'] is None else '%.3f' % record['entropy'],
+            '-' if record['lamb'] is None else '%.4f' % record['lamb'],
+            str(record['g_l']) if record['out_of_range'] == 0 else str(record['g_l']) + '!',
+            '-' if record['phase'] is None else '%.4f' % record['phase'],
+            str(record['qubits']),
+            '-' if record['depth'] is None else str(record['depth']),
+            '-' if record['cx'] is None else str(record['cx'])
+        ] + [format_seconds(record['runtime'][name]) for name in backends]
+        rows.append(row)
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)), file=file)
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)), file=file)
+    if any(record['out_of_range'] > 0 for record in schedule['stages']):
+        print('! lambda is out of range (> ' + str(groverlong.max_lambda) + ') in some of the trajectories', file=file)
+    print('SUM_GL = ' + ('-' if schedule['sum_gl'] is None else '%g' % schedule['sum_gl']) +
+          ('' if schedule['trajectory'] == 'assumed' else ' (max ' + str(schedule['max_sum_gl']) + ')'), file=file)
+    budget = schedule['memory_budget']
+    print('Memory budget = ' + ('(unknown)' if budget is None else resources.format_memory(budget)), file=file)
+    for name in backends:
+        memory = schedule['memory'][name]
+        print('  ' + name.ljust(14) + 'runtime ' + format_seconds(schedule['runtime'][name]).rjust(8) +
+              '   memory ' + ('-' if memory is None else resources.format_memory(memory)).rjust(8) +
+              ('' if schedule['methods'][name] is None else ' (' + schedule['methods'][name] + ')') +
+              ('' if schedule['feasible'][name] else '   INFEASIBLE'), file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimates the stage schedule and resources of the staged partial search, without running it')
+    parser.add_argument('--n-index', type=int, nargs='+', required=True)
+    parser.add_argument('--scrambler', default='basic')
+    parser.add_argument('--shots', type=int, default=100)
+    parser.add_argument('--folded', action='store_true', help='Use the constant-folded keyscan oracle')
+    parser.add_argument('--phase-synthesis', default='ancilla')
+    parser.add_argument('--trajectory', choices=['assumed', 'simulated'], default='assumed')
+    parser.add_argument('--bits-per-stage', type=float, default=1.0,
+                        help='Drop of the modelled entropy in each stage, for the assumed trajectory')
+    parser.add_argument('--trajectories', type=int, default=10, help='Number of simulated trajectories')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--backend', nargs='+', default=None, choices=list(resources.backend_methods.keys()))
+    parser.add_argument('--queue-time', type=float, default=None, help='Queue time of each job on IBM Cloud, in seconds')
+    parser.add_argument('--max-transpile-qubits', type=int, default=21,
+                        help='Only build and transpile the stage circuits up to this width')
+    parser.add_argument('--plain', type=lambda v: int(v, 0), default=scrambler.default_plain)
+    parser.add_argument('--key', type=lambda v: int(v, 0), default=scrambler.default_key)
+    parser.add_argument('--json', action='store_true', help='Print the schedules as JSON lines instead of tables')
+    args = parser.parse_args()
+
+    for n_index in args.n_index:
+        n_mask = (1 << n_index) - 1
+        settings = {
+            'scrambler': args.scrambler,
+            'n_index': n_index,
+            'plain': args.plain & n_mask,
+            'key': args.key & n_mask,
+            'n_shots': args.shots,
+            'folded_oracle': args.folded,
+            'phase_synthesis': args.phase_synthesis
+        }
+        schedule = plan_schedule(
+            settings,
+            trajectory=args.trajectory,
+            bits_per_stage=args.bits_per_stage,
+            n_trajectories=args.trajectories,
+            seed=args.seed,
+            backends=args.backend,
+            queue_time=args.queue_time,
+            max_transpile_qubits=args.max_transpile_qubits
+        )
+        if args.json:
+            print(json.dumps(schedule))
+        else:
+            print_schedule(schedule)
+            print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import collections
+import hashlib
+import os
+import pathlib
+import threading
+import qiskit
+import qiskit.circuit
+import qiskit.qpy
+import atomicfile
+
+# Library of synthesized gates (keyscan, kickback, rotation and diffusion boxes), cached in memory with
+# LRU eviction and, optionally, on disk as QPY files, so that worker processes and repeated runs can
+# load pre-synthesized gates instead of building them again. The disk cache is enabled by setting the
+# environment variable SUSD_GATE_LIBRARY to a directory. If SUSD_GATE_BASIS is set to a comma-separated
+# list of basis gates (e.g. "u,cx"), the gates are stored with their definitions transpiled to that basis.
+# Otherwise the definitions are still decomposed to `qpy_basis_gates` on disk, because the QPY round-trip
+# does not preserve every library gate (e.g. MCXVChain in Qiskit 1.0).
+
+# Basis gates of the QPY files when SUSD_GATE_BASIS is not set
+qpy_basis_gates = ['u', 'cx']
+
+
+class GateLibrary():
+    """LRU cache of gates, keyed by a tuple that identifies how the gate was built"""
+
+    def __init__(self, max_size: int = 128, directory=None, basis_gates: list = None):
+        """
+        :param max_size: Maximum number of gates to keep in memory
+        :param directory: Directory for the QPY files, or None to cache in memory only
+        :param basis_gates: If given, the definitions of new gates are transpiled to these basis gates
+        """
+        self.max_size = max_size
+        self.directory = None if directory is None else pathlib.Path(directory)
+        self.basis_gates = basis_gates
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, build, parameters: list = None) -> qiskit.circuit.Gate:
+        """Returns the gate for the given key, from memory or disk if possible, otherwise from `build()`
+
+        :param key: Tuple of values (str, int, float, bool or tuples of them) that identifies the gate
+        :param build: Function without arguments that builds the gate
+        :param parameters: The `qiskit.circuit.Parameter` objects of the gate, if any. A gate that was
+            built with other parameter objects (e.g. loaded from disk) gets these instead, matched by name.
+        """
+        basis = tuple(self.basis_gates) if self.basis_gates is not None else None
+        key = (basis,) + tuple(key)
+        with self._lock:
+            gate = self._entries.get(key)
+            if gate is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        if gate is not None:
+            return replace_parameters(gate, parameters)
+        gate = self._load(key, parameters)
+        if gate is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            gate = build()
+            if self.basis_gates is not None:
+                gate = get_transpiled_gate(gate, self.basis_gates)
+            self._save(key, gate)
+        with self._lock:
+            self._entries[key] = gate
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return gate
+
+    def get_path(self, key: tuple) -> pathlib.Path:
+        return self.directory / (hashlib.sha256(repr(key).encode()).hexdigest() + '.qpy')
+
+    def _load(self, key: tuple, parameters: list = None) -> qiskit.circuit.Gate:
+        if self.directory is None:
+            return None
+        path = self.get_path(key)
+        if not path.exists():
+            return None
+        with path.open('rb') as file:
+            circuit = qiskit.qpy.load(file)[0]
+        # Guard against hash collisions and files written for another key
+        if circuit.metadata.get('key') != repr(key):
+            return None
+        return replace_parameters(circuit.to_gate(), parameters)
+
+    def _save(self, key: tuple, gate: qiskit.circuit.Gate) -> None:
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.basis_gates is None:
+            gate = get_transpiled_gate(gate, qpy_basis_gates)
+        circuit = gate.definition.copy(name=gate.name)
+        circuit.metadata = {'key': repr(key)}
+        atomicfile.write(self.get_path(key), lambda file: qiskit.qpy.dump(circuit, file), binary=True)
+
+    def clear(self) -> None:
+        """Clears the in-memory cache (the files on disk are kept)"""
+        with self._lock:
+            self._entries.clear()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def replace_parameters(gate: qiskit.circuit.Gate, parameters: list = None) -> qiskit.circuit.Gate:
+    """Returns the gate with its parameters replaced by the given parameter objects of the same name"""
+    if not parameters or gate.definition is None:
+        return gate
+    by_name = {p.name: p for p in parameters}
+    mapping = {p: by_name[p.name] for p in gate.definition.parameters if p.name in by_name}
+    if all(p == q for p, q in mapping.items()):
+        return gate
+    circuit = gate.definition.assign_parameters(mapping)
+    circuit.name = gate.name
+    return circuit.to_gate()
+
+
+def get_transpiled_gate(gate: qiskit.circuit.Gate, basis_gates: list) -> qiskit.circuit.Gate:
+    """Returns a copy of the gate whose definition is transpiled to the given basis gates"""
+    circuit = qiskit.transpile(gate.definition, basis_gates=basis_gates, optimization_level=1)
+    circuit.name = gate.name
+    return circuit.to_gate()
+
+
+def get_inverse_gate(gate: qiskit.circuit.Gate, name: str) -> qiskit.circuit.Gate:
+    """Returns the inverse of a gate built with `to_gate()`, under a new name"""
+    inverse = gate.definition.inverse()
+    inverse.name = name
+    return inverse.to_gate()
+
+
+_library = None
+
+
+def get_gate_library() -> GateLibrary:
+    """Returns the process-wide gate library, configured from SUSD_GATE_LIBRARY and SUSD_GATE_BASIS on first use"""
+    global _library
+    if _library is None:
+        basis = os.environ.get('SUSD_GATE_BASIS')
+        _library = GateLibrary(
+            directory=os.environ.get('SUSD_GATE_LIBRARY') or None,
+            basis_gates=basis.split(',') if basis else None
+        )
+    return _library
@@ -1,32 +1,59 @@
+import qiskit
 import qiskit.circuit
+import qiskit.circuit.library
 import numpy
-import math
+import instrument
+
+# Strategies for synthesizing the multi-controlled phase in the kickback oracle and the diffusion operator:
+# 'ancilla'  - MCX onto the ancilla, phase on the ancilla, MCX again (the original construction)
+# 'mcp'      - a single multi-controlled phase gate on the control qubits, without using the ancilla
+# 'relative' - as 'ancilla', but computing the ancilla with relative-phase Toffoli gates (RCCX/RC3X),
+#              whose relative phases cancel between compute and uncompute. For more than 3 controls,
+#              the AND of half of the controls is computed into the ancilla, and the other half is
+#              chained with RCCX gates through the first half, which is in a known state whenever the
+#              ancilla is set (see `GroverLong.add_relative_controlled_phase`). No extra qubits are needed.
+phase_synthesis_strategies = ['ancilla', 'mcp', 'relative']
+
+# Largest lambda that `GroverLong.get_g` and `GroverLong.get_alpha` accept. Lambda must not exceed 1/2,
+# and the limit allows for small numerical inaccuracies.
+max_lambda = 0.6
+
 
 class GroverLong():
 
-    def __init__(self):
-        pass
+    def __init__(self, phase_synthesis: str = 'ancilla'):
+        """
+        :param phase_synthesis: Synthesis strategy for the multi-controlled phase (see `phase_synthesis_strategies`)
+        """
+        assert phase_synthesis in phase_synthesis_strategies, "Unknown phase synthesis strategy: " + phase_synthesis
+        self.phase_synthesis = phase_synthesis
 
-    def get_g(self, lamb: float) -> int:
+    def get_g(self, lamb):
         """Returns the number of Grover-Long iterations required for the given lambda
-        (based on the formula for $j_op$ in the paper by G. L. Long https://arxiv.org/abs/quant-ph/0106071)
+        (based on the formula for $j_op$ in the paper by G. L. Long https://arxiv.org/abs/quant-ph/0106071).
+        Returns an int for a scalar lambda, or an array of ints for an array of lambdas (e.g. one per run).
         """
-        assert lamb > 0.0, "lambda parameter in Grover-Long must be non-zero"
-        # Changed this condition to 'lamb <= 0.6' to allow for small numerical inaccuracies
-        assert lamb <= 0.6, "lambda parameter in Grover-Long must be less than or equal to 1/2"
-        gl = math.ceil((numpy.pi/(4.0*numpy.arcsin(numpy.sqrt(lamb)))) - 0.5)
-        return gl
+        lamb = numpy.asarray(lamb, dtype=numpy.float64)
+        assert numpy.all(lamb > 0.0), "lambda parameter in Grover-Long must be non-zero"
+        # Changed this condition to 'lamb <= max_lambda' to allow for small numerical inaccuracies
+        assert numpy.all(lamb <= max_lambda), "lambda parameter in Grover-Long must be less than or equal to 1/2"
+        gl = numpy.ceil((numpy.pi/(4.0*numpy.arcsin(numpy.sqrt(lamb)))) - 0.5).astype(numpy.int64)
+        return int(gl) if gl.ndim == 0 else gl
 
-    def get_alpha(self, lamb: float, g: int) -> float:
+    def get_alpha(self, lamb, g):
         """Returns the phase angle, alpha, (in units of radians) for the Grover-Long operators
-        (based on the formula for $\phi$ in the paper by G. L. Long https://arxiv.org/abs/quant-ph/0106071)"""
-        assert lamb > 0.0, "lambda parameter in Grover-Long must be non-zero"
-        # Changed this condition to 'lamb <= 0.6' to allow for small numerical inaccuracies
-        assert lamb <= 0.6, "lambda parameter in Grover-Long must be less than or equal to 1/2"
-        assert g >= 1, "iteration count in Grover-Long must be >= 1"
-        t = numpy.sin(numpy.pi/(4.0*float(g)+2.0))
+        (based on the formula for $\phi$ in the paper by G. L. Long https://arxiv.org/abs/quant-ph/0106071).
+        Returns a float for scalar arguments, or an array for arrays of lambdas and iteration counts."""
+        lamb = numpy.asarray(lamb, dtype=numpy.float64)
+        g = numpy.asarray(g)
+        assert numpy.all(lamb > 0.0), "lambda parameter in Grover-Long must be non-zero"
+        # Changed this condition to 'lamb <= max_lambda' to allow for small numerical inaccuracies
+        assert numpy.all(lamb <= max_lambda), "lambda parameter in Grover-Long must be less than or equal to 1/2"
+        assert numpy.all(g >= 1), "iteration count in Grover-Long must be >= 1"
+        t = numpy.sin(numpy.pi/(4.0*g+2.0))
         alpha = 2.0*numpy.arcsin(t/numpy.sqrt(lamb))
-        return alpha  # Result is returned in units of radians (standard in Qiskit library)
+        # Result is returned in units of radians (standard in Qiskit library)
+        return float(alpha) if alpha.ndim == 0 else alpha
 
     def get_oracle_kickback_circbox(self, n_index: int, flag_bits: list, phase: float) -> qiskit.circuit.Gate:
         """Returns a quantum gate for the phase oracle, using the specified partial oracle flag bits
@@ -43,11 +70,132 @@ class GroverLong():
         # Create the circuit for n_index flag bits + 1 ancilla bit
         circ = qiskit.circuit.QuantumCircuit(n_index+1, name="Kick")
         ancilla = n_index
-        circ.mcx(flag_bits, ancilla)
-        circ.u(0.0, 0.0, phase, ancilla)
-        circ.mcx(flag_bits, ancilla)
+        self.add_controlled_phase(circ, list(flag_bits), ancilla, phase)
         return circ.to_gate()
 
+    def add_controlled_phase(self, c: qiskit.circuit.QuantumCircuit, controls: list, ancilla: int, phase) -> None:
+        """Adds a phase factor $e^{i\phi}$ to the states where all of the control qubits are 1,
+        using the selected synthesis strategy. The ancilla must be in the $\ket{0}$ state
+        and is returned to $\ket{0}$.
+
+        :param c: Circuit to which the gates are added
+        :param controls: List of control qubits
+        :param ancilla: Ancilla qubit (not used by the 'mcp' strategy)
+        :param phase: Phase angle in units of radians
+        """
+        if self.phase_synthesis == 'mcp':
+            if len(controls) == 1:
+                c.p(phase, controls[0])
+            else:
+                c.mcp(phase, controls[:-1], controls[-1])
+            return
+        if self.phase_synthesis == 'relative':
+            self.add_relative_controlled_phase(c, controls, ancilla, phase)
+            return
+        c.mcx(controls, ancilla)
+        c.u(0.0, 0.0, phase, ancilla)
+        c.mcx(controls, ancilla)
+
+    def add_relative_controlled_phase(self, c: qiskit.circuit.QuantumCircuit, controls: list, ancilla: int, phase) -> None:
+        """Adds the controlled phase of the 'relative' strategy (see `add_controlled_phase`) for any number of controls.
+
+        Every gate that computes into a qubit is undone by its exact inverse after the phase, so relative
+        phases cancel. For more than 3 controls, the AND of the first half of the controls is computed into
+        the ancilla, borrowing the second half as dirty ancillas. If the ancilla is then set, the first half
+        is all ones, so after an X on each of them it can serve as clean work qubits for an RCCX chain over
+        the second half. The phase is applied between the end of the chain and the ancilla, which leaves the
+        states with the ancilla unset unchanged, whatever the chain computed for them.
+        """
+        if len(controls) == 1:
+            c.p(phase, controls[0])
+            return
+        if len(controls) <= 3:
+            compute = qiskit.circuit.QuantumCircuit(c.num_qubits)
+            self.add_relative_mcx(compute, controls, ancilla, [])
+            c.compose(compute, inplace=True)
+            c.u(0.0, 0.0, phase, ancilla)
+            c.compose(compute.inverse(), inplace=True)
+            return
+        # The first half is at least as long as the second, so that it has a work qubit for every RCCX of the chain
+        n_first = len(controls) - len(controls)//2
+        first = controls[:n_first]
+        second = controls[n_first:]
+        compute = qiskit.circuit.QuantumCircuit(c.num_qubits)
+        self.add_relative_mcx(compute, first, ancilla, second)
+        for i in first:
+            compute.x(i)
+        compute.append(qiskit.circuit.library.RCCXGate(), [ancilla, second[0], first[0]])
+        for i in range(1, len(second)):
+            compute.append(qiskit.circuit.library.RCCXGate(), [first[i-1], second[i], first[i]])
+        c.compose(compute, inplace=True)
+        c.cp(phase, first[len(second)-1], ancilla)
+        c.compose(compute.inverse(), inplace=True)
+
+    def add_relative_mcx(self, c: qiskit.circuit.QuantumCircuit, controls: list, target: int, dirty_ancillas: list) -> None:
+        """Adds a multi-controlled X, up to relative phases, onto a target in the $\ket{0}$ state
+
+        :param c: Circuit to which the gates are added
+        :param controls: List of control qubits
+        :param target: Target qubit
+        :param dirty_ancillas: Qubits in any state that may be borrowed (at least `len(controls)-2` for more than 3 controls),
+            which are returned to their original state
+        """
+        if len(controls) == 1:
+            c.cx(controls[0], target)
+        elif len(controls) == 2:
+            c.append(qiskit.circuit.library.RCCXGate(), controls + [target])
+        elif len(controls) == 3:
+            c.append(qiskit.circuit.library.RC3XGate(), controls + [target])
+        else:
+            # V-chain of relative-phase Toffoli gates through the borrowed qubits (Barenco et al., lemma 7.2).
+            # The inner chain runs twice, so that the borrowed qubits are restored.
+            ancillas = dirty_ancillas[:len(controls)-2]
+            c.append(qiskit.circuit.library.RCCXGate(), [controls[-1], ancillas[-1], target])
+            self.add_relative_v_chain(c, controls, ancillas)
+            c.append(qiskit.circuit.library.RCCXGate(), [controls[-1], ancillas[-1], target])
+            self.add_relative_v_chain(c, controls, ancillas)
+
+    def add_relative_v_chain(self, c: qiskit.circuit.QuantumCircuit, controls: list, ancillas: list) -> None:
+        """Adds the inner part of the dirty-ancilla V-chain of `add_relative_mcx`, which toggles the last ancilla
+        by the AND of all but the last control (and toggles the other ancillas back and forth)
+
+        :param c: Circuit to which the gates are added
+        :param controls: List of control qubits
+        :param ancillas: The `len(controls)-2` borrowed qubits
+        """
+        for i in range(len(ancillas)-1, 0, -1):
+            c.append(qiskit.circuit.library.RCCXGate(), [controls[i+1], ancillas[i-1], ancillas[i]])
+        c.append(qiskit.circuit.library.RCCXGate(), [controls[0], controls[1], ancillas[0]])
+        for i in range(1, len(ancillas)):
+            c.append(qiskit.circuit.library.RCCXGate(), [controls[i+1], ancillas[i-1], ancillas[i]])
+
+    def get_synthesis_report(self, n_index: int, flag_bits: list, phase: float, basis_gates: list = None) -> dict:
+        """Returns the transpiled depth and CX count of the kickback oracle and the diffusion phase
+        for every synthesis strategy, as a dict keyed by strategy name.
+
+        :param n_index: Scaling factor for the circuit
+        :param flag_bits: Flag bits tested by the kickback oracle
+        :param phase: Phase angle in units of radians
+        :param basis_gates: Basis for transpiling (default is ['u', 'cx'])
+        """
+        if basis_gates is None:
+            basis_gates = ['u', 'cx']
+        report = dict()
+        for strategy in phase_synthesis_strategies:
+            grover = GroverLong(strategy)
+            kick = qiskit.circuit.QuantumCircuit(n_index+1)
+            kick.append(grover.get_oracle_kickback_circbox(n_index, flag_bits, phase), range(n_index+1))
+            diffusion = qiskit.circuit.QuantumCircuit(n_index+1)
+            grover.add_controlled_phase(diffusion, list(range(n_index)), n_index, phase)
+            report[strategy] = dict()
+            for name, circ in [('kickback', kick), ('diffusion', diffusion)]:
+                new_circ = qiskit.transpile(circ, basis_gates=basis_gates, optimization_level=1)
+                report[strategy][name] = {
+                    'depth': new_circ.depth(),
+                    'cx': new_circ.count_ops().get('cx', 0)
+                }
+        return report
+
     def add_groverlong_circuit(
             self,
             c: qiskit.circuit.QuantumCircuit,
@@ -58,9 +206,12 @@ class GroverLong():
             inv_flag_circbox: qiskit.circuit.Gate,
             rotate_circbox: qiskit.circuit.Gate,
             inv_rotate_circbox: qiskit.circuit.Gate,
-            withbarriers: bool = True
+            withbarriers: bool = True,
+            folded: bool = False
     ) -> None:
         """Adds gates for the Grover-Long algorithm, using the given parameters.
+        The search itself builds its stage circuits from templates (see `stagetemplate.StageTemplate`),
+        which call `add_groverlong_iterations` with a parameterized phase.
 
         :param c: Circuit to which the gates are added
         :param n_index: Scaling factor for the circuit
@@ -70,22 +221,110 @@ class GroverLong():
         :param rotate_circbox: Operator gate that rotates from $\ket{0}$ to $\ket{\mu}$
         :param inv_rotate_circbox: Operator gate that rotates from $\ket{\mu}$ to $\ket{0}$
         :param withbarriers: Boolean flag indicating whether to add barriers to the circuit
+        :param folded: If True, the flag gates are constant-folded keyscan gates that act on the x qubits only,
+            the circuit has `n_index+1` qubits and `flag_bits` are indices of x qubits
+            (see `Scrambler.get_folded_keyscan_circbox`)
         """
         gl = self.get_g(lamb)
         phase = self.get_alpha(lamb, gl)
-        print('\ng_l = ' + str(gl))
-        print('phase = ' + str(phase/numpy.pi)) # Print phase in units of pi
+        # Phase is reported in units of pi
+        instrument.get_tracer().event('groverlong', g_l=gl, phase=phase/numpy.pi)
+
+        self.add_groverlong_iterations(
+            c, n_index, gl, phase, flag_bits, flag_circbox, inv_flag_circbox,
+            rotate_circbox, inv_rotate_circbox, withbarriers, folded
+        )
+
+    def add_groverlong_iterations(
+            self,
+            c: qiskit.circuit.QuantumCircuit,
+            n_index: int,
+            gl: int,
+            phase,
+            flag_bits: list,
+            flag_circbox: qiskit.circuit.Gate,
+            inv_flag_circbox: qiskit.circuit.Gate,
+            rotate_circbox: qiskit.circuit.Gate,
+            inv_rotate_circbox: qiskit.circuit.Gate,
+            withbarriers: bool = True,
+            folded: bool = False,
+            kickback_circbox: qiskit.circuit.Gate = None,
+            diffusion_circbox: qiskit.circuit.Gate = None
+    ) -> None:
+        """Adds `gl` Grover-Long iterations with the given phase, which can be a `qiskit.circuit.Parameter`.
 
+        :param c: Circuit to which the gates are added
+        :param n_index: Scaling factor for the circuit
+        :param gl: Number of Grover-Long iterations
+        :param phase: Phase factor that is used to mark the target states (in units of radians)
+        :param flag_bits: Specifies the list of flag bits (partial oracle bits) that are tested for this oracle.
+        :param rotate_circbox: Operator gate that rotates from $\ket{0}$ to $\ket{\mu}$
+        :param inv_rotate_circbox: Operator gate that rotates from $\ket{\mu}$ to $\ket{0}$
+        :param withbarriers: Boolean flag indicating whether to add barriers to the circuit
+        :param folded: If True, the flag gates are constant-folded keyscan gates that act on the x qubits only
+        :param kickback_circbox: Pre-built oracle kickback gate (see `get_oracle_kickback_circbox`), or None to build it here
+        :param diffusion_circbox: Pre-built diffusion gate (see `get_diffusion_circbox`), or None to add the diffusion gates inline
+        """
         # Create the oracle operator
-        subcirc = qiskit.circuit.QuantumCircuit(2*n_index+1, name="Oracle")
-        subcirc.append(flag_circbox, range(0, 2*n_index))
-        kickback_circbox = self.get_oracle_kickback_circbox(n_index, flag_bits, phase)
-        subcirc.append(kickback_circbox, range(n_index, 2*n_index+1))
-        subcirc.append(inv_flag_circbox, range(0, 2*n_index))
+        if kickback_circbox is None:
+            kickback_circbox = self.get_oracle_kickback_circbox(n_index, flag_bits, phase)
+        if folded:
+            # Flags are marked directly on the x qubits
+            subcirc = qiskit.circuit.QuantumCircuit(n_index+1, name="Oracle")
+            subcirc.append(flag_circbox, range(0, n_index))
+            subcirc.append(kickback_circbox, range(0, n_index+1))
+            subcirc.append(inv_flag_circbox, range(0, n_index))
+        else:
+            subcirc = qiskit.circuit.QuantumCircuit(2*n_index+1, name="Oracle")
+            subcirc.append(flag_circbox, range(0, 2*n_index))
+            subcirc.append(kickback_circbox, range(n_index, 2*n_index+1))
+            subcirc.append(inv_flag_circbox, range(0, 2*n_index))
         oracle_circbox = subcirc.to_gate()
 
         for i in range(0, gl):
-            self.add_grover_iteration(c, n_index, phase, oracle_circbox, rotate_circbox, inv_rotate_circbox)
+            self.add_grover_iteration(
+                c, n_index, phase, oracle_circbox, rotate_circbox, inv_rotate_circbox, withbarriers, folded,
+                diffusion_circbox
+            )
+
+    def get_diffusion_circbox(
+            self,
+            n_index: int,
+            phase,
+            rotate_circbox: qiskit.circuit.Gate,
+            inv_rotate_circbox: qiskit.circuit.Gate
+    ) -> qiskit.circuit.Gate:
+        """Returns the Grover-Long diffusion operator as a gate on the x qubits (0 to n_index-1) and the ancilla (n_index).
+        The gate only depends on n_index and the phase, so a parameterized diffusion gate can be shared by
+        the oracles for different (plain, cipher) pairs.
+
+        :param n_index: Scaling factor for the circuit
+        :param phase: Phase factor (in units of radians), which can be a `qiskit.circuit.Parameter`
+        :param rotate_circbox: Operator gate that rotates from $\ket{0}$ to $\ket{\mu}$
+        :param inv_rotate_circbox: Operator gate that rotates from $\ket{\mu}$ to $\ket{0}$
+        """
+        x_qubits = list(range(0, n_index))
+        circ = qiskit.circuit.QuantumCircuit(n_index+1, name="Diffusion")
+        self.add_diffusion(circ, x_qubits, n_index, phase, rotate_circbox, inv_rotate_circbox)
+        return circ.to_gate()
+
+    def add_diffusion(
+            self,
+            c: qiskit.circuit.QuantumCircuit,
+            x_qubits: list,
+            ancilla: int,
+            phase,
+            rotate_circbox: qiskit.circuit.Gate,
+            inv_rotate_circbox: qiskit.circuit.Gate
+    ) -> None:
+        """Adds the gates of the Grover-Long diffusion operator to the circuit"""
+        c.append(inv_rotate_circbox, x_qubits)
+        for i in x_qubits:
+            c.x(i)
+        self.add_controlled_phase(c, x_qubits, ancilla, phase)
+        for i in x_qubits:
+            c.x(i)
+        c.append(rotate_circbox, x_qubits)
 
     def add_grover_iteration(
             self,
@@ -95,7 +334,9 @@ class GroverLong():
             oracle_circbox: qiskit.circuit.Gate,
             rotate_circbox: qiskit.circuit.Gate,
             inv_rotate_circbox: qiskit.circuit.Gate,
-            withbarriers: bool = True
+            withbarriers: bool = True,
+            folded: bool = False,
+            diffusion_circbox: qiskit.circuit.Gate = None
     ) -> None:
         """Adds gates for a *single* iteration of the Grover-Long algorithm.
 
@@ -107,11 +348,15 @@ class GroverLong():
         :param rotate_circbox: Operator gate that rotates from $\ket{0}$ to $\ket{\mu}$
         :param inv_rotate_circbox: Operator gate that rotates from $\ket{\mu}$ to $\ket{0}$
         :param withbarriers: Boolean flag indicating whether to add barriers to the circuit
+        :param folded: If True, the circuit has no y register and the ancilla is at index `n_index`
+        :param diffusion_circbox: Pre-built diffusion gate (see `get_diffusion_circbox`), or None to add the diffusion gates inline
         """
         x_qubits = list(range(0, n_index))
-        y_qubits = list(range(n_index, 2*n_index))
-        ancilla = 2*n_index
-        all_qubits = list(range(0, 2*n_index+1))
+        if folded:
+            ancilla = n_index
+        else:
+            ancilla = 2*n_index
+        all_qubits = list(range(0, ancilla+1))
 
         # Add the phase kickback from the oracle
         if withbarriers: c.barrier(all_qubits)
@@ -119,12 +364,7 @@ class GroverLong():
 
         # Add the Grover-Long diffusion operator to the circuit
         if withbarriers: c.barrier(all_qubits)
-        c.append(inv_rotate_circbox, x_qubits)
-        for i in x_qubits:
-            c.x(i)
-        c.mcx(x_qubits, ancilla)
-        c.u(0.0, 0.0, phase, ancilla)
-        c.mcx(x_qubits, ancilla)
-        for i in x_qubits:
-            c.x(i)
-        c.append(rotate_circbox, x_qubits)
+        if diffusion_circbox is not None:
+            c.append(diffusion_circbox, x_qubits + [ancilla])
+        else:
+            self.add_diffusion(c, x_qubits, ancilla, phase, rotate_circbox, inv_rotate_circbox)
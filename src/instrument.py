@@ -0,0 +1,145 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+
+# Structured instrumentation for the staged search. When enabled, every span (build, transpile, submit or simulate,
+# wait, decode, model, entropy, ...) is written as one JSON line with its start time, duration, the
+# current context (e.g. repeat and stage) and any fields added inside the span, such as circuit metrics
+# or backend job IDs. Enable it by setting the environment variable SUSD_TRACE to a file path
+# (or to 'stderr'). When disabled, `span()` returns a shared no-op context manager.
+
+
+class _NullSpan():
+    """No-op span that is returned when the tracer is disabled"""
+
+    def __init__(self):
+        # Fields assigned inside a disabled span are discarded
+        self.fields = dict()
+
+    def __enter__(self) -> dict:
+        return self.fields
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        return False
+
+
+class _Span():
+
+    def __init__(self, tracer, name: str, fields: dict):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self) -> dict:
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        return self.fields
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        self.tracer.write(self.name, self.start_time, duration, self.fields)
+        return False
+
+
+class Tracer():
+    """Writes instrumentation events as JSON lines to a stream"""
+
+    def __init__(self, stream=None):
+        """
+        :param stream: Text stream for the events, or None to disable the tracer
+        """
+        self.stream = stream
+        self.enabled = stream is not None
+        # The context is kept per thread and asyncio task, so that concurrent searches (see campaign.py)
+        # each have their own stage and seed. A new dict is set on every change, never updated in place.
+        self._context = contextvars.ContextVar('context', default=dict())
+        self._write_lock = threading.Lock()
+        self._null_span = _NullSpan()
+
+    @property
+    def context(self) -> dict:
+        """Fields that are added to every event in the current context"""
+        return self._context.get()
+
+    def span(self, name: str, **fields):
+        """Returns a context manager that times the enclosed block and writes it as an event.
+        The context manager yields a dict, to which fields can be added inside the block."""
+        if not self.enabled:
+            return self._null_span
+        return _Span(self, name, fields)
+
+    def event(self, name: str, **fields) -> None:
+        """Writes an instantaneous event"""
+        if self.enabled:
+            self.write(name, time.time(), 0.0, fields)
+
+    def set_context(self, **fields) -> None:
+        """Sets fields that are added to every subsequent event in the current context (None removes a field)"""
+        context = dict(self._context.get())
+        for k, v in fields.items():
+            if v is None:
+                context.pop(k, None)
+            else:
+                context[k] = v
+        self._context.set(context)
+
+    def get_record(self, name: str, start_time: float, duration: float, fields: dict) -> dict:
+        record = {'event': name, 'ts': start_time, 'duration_s': duration, 'pid': os.getpid()}
+        record.update(self.context)
+        record.update(fields)
+        return record
+
+    def write(self, name: str, start_time: float, duration: float, fields: dict) -> None:
+        line = json.dumps(self.get_record(name, start_time, duration, fields), default=str) + '\n'
+        with self._write_lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+class RecordingTracer(Tracer):
+    """Tracer that keeps the events in memory (e.g. for the benchmarks), and also writes them to a stream if one is given"""
+
+    def __init__(self, stream=None):
+        """
+        :param stream: Text stream for the events, or None to keep them in memory only
+        """
+        super().__init__(stream)
+        self.enabled = True
+        self.records = []
+
+    def write(self, name: str, start_time: float, duration: float, fields: dict) -> None:
+        record = self.get_record(name, start_time, duration, fields)
+        with self._write_lock:
+            self.records.append(record)
+        if self.stream is not None:
+            super().write(name, start_time, duration, fields)
+
+
+_tracer = None
+
+
+def get_tracer() -> Tracer:
+    """Returns the process-wide tracer, configured from the SUSD_TRACE environment variable on first use"""
+    global _tracer
+    if _tracer is None:
+        trace_path = os.environ.get('SUSD_TRACE')
+        if not trace_path:
+            _tracer = Tracer()
+        elif trace_path == 'stderr':
+            _tracer = Tracer(sys.stderr)
+        else:
+            # Line-buffered append, so that worker processes can share the same file
+            _tracer = Tracer(open(trace_path, 'a', buffering=1))
+    return _tracer
+
+
+def set_tracer(tracer: Tracer) -> None:
+    """Replaces the process-wide tracer, e.g. with a `RecordingTracer`. Objects that have already taken the
+    tracer (e.g. a `search.SearchRunner`) keep the old one."""
+    global _tracer
+    _tracer = tracer
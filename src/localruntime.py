@@ -0,0 +1,52 @@
+import itertools
+import qiskit.primitives
+import qiskit.providers.basic_provider
+
+# Local stand-in for the parts of `qiskit_ibm_runtime` that are used by `selector.IBMCloudBackend`.
+# Circuits are run on the local BasicProvider simulator, so the session and batching logic
+# of IBMCloudBackend can be exercised offline, without IBM Cloud credentials.
+
+
+class LocalRuntimeService():
+    """Stand-in for `qiskit_ibm_runtime.QiskitRuntimeService`. Every device name maps to the local simulator."""
+
+    def __init__(self, simulator: str = 'basic_simulator'):
+        self.simulator = simulator
+        self.sessions_opened = 0
+        self.jobs_submitted = 0
+
+    def backend(self, name: str = None):
+        return qiskit.providers.basic_provider.BasicProvider().get_backend(self.simulator)
+
+
+class Session():
+    """Stand-in for `qiskit_ibm_runtime.Session`"""
+    _session_ids = itertools.count(1)
+
+    def __init__(self, service: LocalRuntimeService = None, backend: str = None, max_time=None):
+        self.service = service
+        self.backend_name = backend
+        self.session_id = 'local-session-' + str(next(self._session_ids))
+        self.active = True
+        service.sessions_opened += 1
+
+    def backend(self) -> str:
+        return self.backend_name
+
+    def close(self) -> None:
+        self.active = False
+
+
+class Sampler():
+    """Stand-in for the `qiskit_ibm_runtime.Sampler` primitive (V1 interface)"""
+
+    def __init__(self, backend=None, session: Session = None, options=None):
+        assert session is not None, "Local Sampler stand-in requires a session"
+        self.session = session
+
+    def run(self, circuits, parameter_values=None, **kwargs):
+        assert self.session.active, "Session is closed"
+        self.session.service.jobs_submitted += 1
+        # BackendSampler is not thread-safe, so each job gets its own instance (jobs may be submitted concurrently)
+        sampler = qiskit.primitives.BackendSampler(backend=self.session.service.backend(self.session.backend_name))
+        return sampler.run(circuits, parameter_values, **kwargs)
@@ -1,150 +1,97 @@
 import collections
 import pathlib
 
-import qiskit.circuit
-import selector
+import results
 import scrambler
-import partial
-import groverlong
+import search
 
-# Doc for qiskit.visualization - https://qiskit.org/documentation/tutorials/circuits/2_plotting_data_in_qiskit.html
-import qiskit.visualization
 
-# Import the matplotlib backend
-import matplotlib
+def plot_candidates(repeat_results: list) -> None:
+    """Plots the distribution of the key candidates found by the repeats"""
+    # Visualization is only imported when plotting is asked for, so that headless runs need no GUI toolkit.
+    # Doc for qiskit.visualization - https://qiskit.org/documentation/tutorials/circuits/2_plotting_data_in_qiskit.html
+    import qiskit.visualization
+    import matplotlib.pyplot
+    # matplotlib picks an interactive backend if one is available (e.g. TkAgg, which requires package 'tkinter').
+    # To choose a backend, set the environment variable MPLBACKEND, e.g. MPLBACKEND=TkAgg
+    # If 'tkinter' is not yet installed on your machine, you can install it e.g. on Ubuntu, with the command:
+    # sudo apt-get install python3-tk
+    counts = collections.Counter(bin(r['candidate']) for r in repeat_results)
+    qiskit.visualization.plot_distribution(dict(counts), title='Key candidates')
+    matplotlib.pyplot.show()
 
 
-# 'matplotlib' backend defaults to TkAgg (which requires package 'tkinter')
-# If 'tkinter' is not yet installed on your machine, you can install it e.g. on Ubuntu, with the command:
-# sudo apt-get install python3-tk
-
 def main():
-    # If you want to change the 'matplotlib' backend, use this code:
-    matplotlib.use('TkAgg')
-    #print(matplotlib.get_backend())
-
-    # Select the backend:
-    bs = selector.BackendSelector()
-    backend = bs.select()
-
     # Define basic parameters for the calculation
     n_repeats = 1
+    # Number of worker processes for running the repeats in parallel (1 runs them serially)
+    n_workers = 1
+    # Base seed for the per-repeat random number generators (None for non-deterministic runs)
+    seed = None
+    # Save a checkpoint of each repeat after every stage to this directory (None for no checkpoints)
+    checkpoint_dir = None  # e.g. pathlib.Path("../results/checkpoints")
+    # Resume each repeat after the last stage in its checkpoint (the settings and seed must be unchanged)
+    resume = False
+    # Plot the distribution of the key candidates at the end of the run (needs matplotlib and a display)
+    plot = False
     n_index: int = 8
     n_mask: int = int('1' * n_index, 2)  # 2 selects binary -> int conversion
     print('Scale factor = ' + str(n_index))
     # Number of shots for running the circuit on the backend at each stage
     n_shots = 100
     print('#Shots = ' + str(n_shots))
+    # Adaptive shot allocation (e.g. {'increment': 25, 'max_shots': 200, 'target': 0.25}, see adaptive.py),
+    # or None to run n_shots at every stage
+    adaptive_shots = None
+    # Stop the search early once the modelled entropy drops below this value (None runs all of the stages)
+    entropy_threshold = None
+    # Check the most probable candidates classically after every stage, and stop once the key is confirmed
+    # (None runs all of the stages)
+    verify_top_k = None
+    # Constant-fold the keyscan oracle onto the x register (n_index+1 qubits instead of 2*n_index+1)
+    folded_oracle = False
+    # Synthesis of the multi-controlled phases: 'ancilla', 'mcp' or 'relative' (see groverlong.py)
+    phase_synthesis = 'ancilla'
     # Inputs for Scrambler circuit
     print('Mask = ' + bin(n_mask))
-    plain: int = 0b10110000101101001011010010010010 & n_mask
-    key: int   = 0b01001101000100010001011101001100 & n_mask
+    plain: int = scrambler.default_plain & n_mask
+    key: int   = scrambler.default_key & n_mask
     print('Plaintext (binary) = ' + bin(plain))
     print('Encryption key = ' + bin(key))
 
     # Set up the scrambler
-    enc = scrambler.ScramblerBasic()
+    scrambler_type = 'basic'
+    enc = scrambler.scrambler_types[scrambler_type]()
     cipher = enc.scramble(n_index, plain, key)
     print('Cipher text = ' + bin(cipher))
     assert plain == enc.unscramble(n_index, cipher, key)
 
-    flag_circbox = enc.get_keyscan_circbox(n_index, plain, cipher)
-    inv_flag_circbox = enc.get_inverse_keyscan_circbox(n_index, plain, cipher)
-    partial_search = partial.Partial()
-    grover = groverlong.GroverLong()
-
-    for r in range(0, n_repeats):
-        modelled_state = None
-        modelled_entropy = float(n_index)
-        sum_gl = 0
-        for stage in range(1, n_index+1):
-            print('\nSTAGE ' + str(stage) + ':')
-            # Define the circuit
-            x_qubits = list(range(0, n_index))
-            y_qubits = list(range(n_index, 2 * n_index))
-            circ = qiskit.circuit.QuantumCircuit(2*n_index+1)
-
-            # Add the search circuit
-            #partial_search.add_search_circuit(circ, n_index, keyscan_box, inv_keyscan_box)
-            #partial_search.add_test_groverlong_circuit(circ, n_index, keyscan_box, inv_keyscan_box)
-            rotate_circbox = partial_search.get_rotate_circbox(n_index, modelled_state)
-            circ.append(rotate_circbox, x_qubits)
-
-            lamb = partial_search.get_lambda_value(n_index, stage, modelled_entropy)
-            print('lamb = ' + str(lamb))
-            flag_bits = list(range(stage))
-            sum_gl += grover.get_g(lamb)
-
-            grover.add_groverlong_circuit(
-                circ,
-                n_index,
-                lamb,
-                flag_bits,
-                flag_circbox,
-                inv_flag_circbox,
-                rotate_circbox,
-                rotate_circbox
-            )
-
-            # Visualize the circuit
-            # circuit.draw(output='mpl') # Uses 'matplotlib' instead of ASCII art
-            #print(circ.draw())  # Uses ASCII art
-
-            # Add the measurement gates for a proper run:
-            circ.measure_all()
-
-            # Run the circuit on the selected backend:
-            job = backend.run(circ, shots=n_shots)
-            result = job.result()
-            # Works for local simulation
-            #counts = result.get_counts(circ)
-            # Works with Sampler() primitive (remote IBM backend service)
-            #counts = result.quasi_dists[0]
-            # Works with everything(!)
-            distrib = backend.get_normalized_distrib_from_result(n_index, circ, result)
-            #print(distrib)
-
-            modelled_state = partial_search.get_modelled_state(n_index, n_shots, distrib)
-            print(modelled_state)
-            modelled_entropy = partial_search.get_entropy_from_modelled_state(n_index, modelled_state)
-            print('entropy of modelled state = ' + str(modelled_entropy))
-
-            # Analyse the count and check the results
-            parsed_count = collections.Counter()
-            for bits, probability in distrib.items():
-                x_reg = bits & n_mask
-                y_reg = bits & (n_mask << n_index)
-                y_reg >>= n_index
-                reg_tuple = (bin(x_reg), bin(y_reg))
-                parsed_count[reg_tuple] = int(probability*n_shots)
-            print()  # Blank line
-            print(parsed_count.most_common(32))
-
-            # Visualization
-            #qiskit.visualization.plot_distribution(counts)
-            #matplotlib.pyplot.show()
-
-            # Check that the expected solution is present in the counts
-            #expected_solution_key = (bin(key), bin(n_mask))
-            #if expected_solution_key in parsed_count:
-            #    print('Found solution ' + str(expected_solution_key) +
-            #          ' with count = ' + str(parsed_count[expected_solution_key]))
-
-        # Save result stats
-        results_dir = pathlib.Path("../results")
-        if not results_dir.exists():
-            results_dir.mkdir()
-        filepath = results_dir / "sampler.csv"
-        first_time_opening = False
-        if not filepath.exists():
-            filepath.touch()
-            first_time_opening = True
-        with filepath.open("a") as file:
-            if first_time_opening:
-                file.write('N_INDEX,N_SHOTS,SUM_GL,PROBABILITY\n')
-            expected_solution_key = (bin(key), bin(0))
-            probability = parsed_count[expected_solution_key] / float(n_shots)
-            file.write(str(n_index) + ',' + str(n_shots) + ',' + str(sum_gl) + ',' + str(probability) + '\n')
+    # The backend is selected (in each worker process) from the SUSD_* environment variables
+    settings = {
+        'scrambler': scrambler_type,
+        'n_index': n_index,
+        'plain': plain,
+        'key': key,
+        'n_shots': n_shots,
+        'folded_oracle': folded_oracle,
+        'phase_synthesis': phase_synthesis,
+        'adaptive_shots': adaptive_shots,
+        'entropy_threshold': entropy_threshold,
+        'verify_top_k': verify_top_k
+    }
+    repeat_results = search.run_repeats(
+        settings, n_repeats, n_workers=n_workers, seed=seed, checkpoint_dir=checkpoint_dir, resume=resume
+    )
+
+    # Save the results and the run configuration, in repeat order
+    # (load them with results.load_results(), or print the success-probability curves with results.py)
+    with results.ResultsStore(pathlib.Path("../results/runs")) as store:
+        for repeat_result in repeat_results:
+            store.add(settings, repeat_result)
+
+    # Visualization
+    if plot:
+        plot_candidates(repeat_results)
 
 
 if __name__ == '__main__':
@@ -1,47 +1,95 @@
 import numpy
 import qiskit.circuit
-import qiskit.result
+import distribution
 import scrambler
 import groverlong
 
 
+# Schedules for the weight of the target vector (lambda) after the first stage (see `Partial.get_lambda_value`):
+# 'entropy' - lambda = 2^((n_index - stage) - H), where H is the entropy of the modelled state
+# 'fixed'   - lambda = first_lambda at every stage, i.e. the modelled state is assumed to halve the search space
+lambda_schedules = ['entropy', 'fixed']
+
+
 class Partial():
 
-    def __init__(self):
-        pass
+    def __init__(
+            self,
+            empirical_factor: float = 0.2,
+            min_weight: float = None,
+            lambda_schedule: str = 'entropy',
+            first_lambda: float = 0.5,
+            max_lambda: float = None
+    ):
+        """
+        :param empirical_factor: Factor applied to the estimator of the minimum probability of a bit value
+            that was not measured (see `get_modelled_state`)
+        :param min_weight: Fixed minimum probability of a bit value, instead of the estimator
+        :param lambda_schedule: Schedule for lambda after the first stage (see `lambda_schedules`)
+        :param first_lambda: Lambda for the first stage (and for every stage with the 'fixed' schedule)
+        :param max_lambda: If given, lambda is capped at this value (None keeps the schedule's value)
+        """
+        assert lambda_schedule in lambda_schedules, "Unknown lambda schedule: " + str(lambda_schedule)
+        self.empirical_factor = empirical_factor
+        self.min_weight = min_weight
+        self.lambda_schedule = lambda_schedule
+        self.first_lambda = first_lambda
+        self.max_lambda = max_lambda
 
-    def get_modelled_state(self, n_index: int, n_shots: int, distrib: qiskit.result.QuasiDistribution) -> list:
+    def get_modelled_state(self, n_index: int, n_shots: int, distrib: distribution.Distribution) -> list:
         """Returns a modelled state in the form of a list of tuples
         [(cos(beta_1),sin(beta_1)), ..., (cos(beta_n),sin(beta_n))]
 
         :param n_index: Scaling factor for the circuit
         :param n_shots: Number of shots used to collect the job results
-        :param distrib: Instance of a QuasiDistribution that holds the results from the last set of measurements.
+        :param distrib: Instance of a Distribution (or a QuasiDistribution) that holds the results
+            from the last set of measurements.
         """
-        modelled_state = list()
-        bit_counts = [0] * n_index
-        for bits, probability in distrib.items():
-            mask = 0b1
-            for i in range(n_index):
-                if bits & mask:
-                    bit_counts[i] += int(probability*n_shots)
-                mask <<= 1
+        if not isinstance(distrib, distribution.Distribution):
+            distrib = distribution.from_dict(distrib, shots=n_shots)
+        if distrib.exact:
+            # Exact marginals need no estimator for missed low-probability bit values
+            return self.get_modelled_state_from_marginals(n_index, distrib.get_bit_marginals(n_index))
+        marginals = distrib.get_bit_counts(n_index, n_shots)/n_shots
+        return [tuple(bit) for bit in self.get_modelled_states(marginals[numpy.newaxis, :], n_shots)[0]]
 
-        # Estimator of minimum probability, in case we missed measuring a low-probability bit value
-        # See https://en.wikipedia.org/wiki/Binomial_distribution#Estimation_of_parameters
-        min_weight = 1.0/(float(n_shots) + 2.0)
-        empirical_factor = 0.2
-        min_weight *= empirical_factor
+    def get_min_weight(self, n_shots):
+        """Returns the minimum probability of a bit value in the modelled state, for the given number of shots
+        (a scalar, or an array with the number of shots of each run)"""
+        if self.min_weight is not None:
+            return numpy.full(numpy.shape(n_shots), self.min_weight)
+        return self.empirical_factor/(numpy.asarray(n_shots, dtype=numpy.float64) + 2.0)
 
-        for i in range(n_index):
-            weight_for_bit_equals_1 = bit_counts[i]/n_shots
+    def get_modelled_state_from_marginals(self, n_index: int, marginals) -> list:
+        """Returns a modelled state in the form of a list of tuples
+        [(cos(beta_1),sin(beta_1)), ..., (cos(beta_n),sin(beta_n))], directly from exact
+        per-bit probabilities
+
+        :param n_index: Scaling factor for the circuit
+        :param marginals: Sequence of probabilities P(x_i = 1) for i in `0..n_index-1`
+        """
+        marginals = numpy.asarray(marginals, dtype=numpy.float64)[numpy.newaxis, :n_index]
+        return [tuple(bit) for bit in self.get_modelled_states(marginals)[0]]
+
+    def get_modelled_states(self, marginals: numpy.ndarray, n_shots=None) -> numpy.ndarray:
+        """Returns the modelled states of many runs at once, as a (runs x n_index x 2) array in which
+        `[r, i]` is (cos(beta_i), sin(beta_i)) for run `r`
+
+        :param marginals: (runs x n_index) array of the measured probabilities P(x_i = 1)
+        :param n_shots: Number of shots behind the marginals (a scalar, or an array with the number of shots
+            of each run), or None for exact marginals
+        """
+        weights = numpy.asarray(marginals, dtype=numpy.float64)
+        if n_shots is None:
+            # Clip rounding errors from summing the probabilities
+            weights = numpy.clip(weights, 0.0, 1.0)
+        else:
+            # Estimator of minimum probability, in case we missed measuring a low-probability bit value
+            # See https://en.wikipedia.org/wiki/Binomial_distribution#Estimation_of_parameters
+            min_weight = numpy.expand_dims(self.get_min_weight(n_shots), -1)
             # Weight should not be exactly equal to 1 or 0
-            weight_for_bit_equals_1 = max(weight_for_bit_equals_1, min_weight)
-            weight_for_bit_equals_1 = min(weight_for_bit_equals_1, 1.0 - min_weight)
-            sin_beta = numpy.sqrt(weight_for_bit_equals_1)
-            cos_beta = numpy.sqrt(1.0 - weight_for_bit_equals_1)
-            modelled_state.append( (cos_beta, sin_beta) )
-        return modelled_state
+            weights = numpy.minimum(numpy.maximum(weights, min_weight), 1.0 - min_weight)
+        return numpy.stack([numpy.sqrt(1.0 - weights), numpy.sqrt(weights)], axis=-1)
 
     def get_entropy_from_modelled_state(self, n_index: int, modelled_state: list) -> float:
         """Returns the Shannon entropy of the modeled state
@@ -50,16 +98,16 @@ class Partial():
         :param modelled_state: A modelled state in the form of a list of tuples
         [(cos(beta_1),sin(beta_1)), ..., (cos(beta_n),sin(beta_n))]
         """
-        entropy: float = 0.0
-        for i in range(n_index):
-            cos_beta, sin_beta = modelled_state[i]
-            c2 = cos_beta**2
-            s2 = sin_beta**2
-            if c2 > 0.0:
-                entropy += -c2*numpy.log2(c2)
-            if s2 > 0.0:
-                entropy += -s2*numpy.log2(s2)
-        return entropy
+        modelled_states = numpy.asarray(modelled_state[:n_index], dtype=numpy.float64)[numpy.newaxis]
+        return float(self.get_entropies(modelled_states)[0])
+
+    def get_entropies(self, modelled_states: numpy.ndarray) -> numpy.ndarray:
+        """Returns the Shannon entropy of each run's modelled state, for a (runs x n_index x 2) array of
+        modelled states (see `get_modelled_states`)"""
+        probs = numpy.asarray(modelled_states, dtype=numpy.float64)**2
+        # Zero probabilities contribute nothing (log2(1) = 0)
+        terms = -probs*numpy.log2(numpy.where(probs > 0.0, probs, 1.0))
+        return terms.sum(axis=(-2, -1))
 
     def get_rotate_circbox(self, n_index: int, modelled_state: list = None) -> qiskit.circuit.Gate:
         """Create the operator gate for the rotation operator that takes $\ket{0}$ to $\ket{\mu}$
@@ -80,9 +128,46 @@ class Partial():
                 rotate_circ.u(2.0*beta, 0.0, numpy.pi, i)
         return rotate_circ.to_gate()
 
+    def get_beta_angles(self, n_index: int, modelled_state: list = None) -> list:
+        """Returns the rotation angles [beta_1, ..., beta_n] (in units of radians) for the modelled state.
+        An empty modelled state maps to beta = pi/4 for every bit, which is the Hadamard rotation.
+
+        :param n_index: Scaling factor for the circuit
+        :param modelled_state: A modelled state in the form of a list of tuples
+        [(cos(beta_1),sin(beta_1)), ..., (cos(beta_n),sin(beta_n))]
+        """
+        if (modelled_state is None) or (modelled_state==[]):
+            return [numpy.pi/4.0] * n_index
+        return [float(numpy.arccos(modelled_state[i][0])) for i in range(n_index)]
+
+    def get_parameterized_rotate_circbox(self, n_index: int, betas) -> qiskit.circuit.Gate:
+        """Create the rotation operator gate from a list of angles, which can be `qiskit.circuit.Parameter` objects
+
+        :param n_index: Scaling factor for the circuit
+        :param betas: Sequence of n_index rotation angles [beta_1, ..., beta_n]
+        """
+        rotate_circ = qiskit.circuit.QuantumCircuit(n_index, name="R")
+        for i in range(n_index):
+            rotate_circ.u(2.0*betas[i], 0.0, numpy.pi, i)
+        return rotate_circ.to_gate()
+
     def get_lambda_value(self, n_index: int, stage: int, modelled_entropy: float) -> float:
         """Estimate the weight of the target vector (lambda) for this stage"""
-        if stage==1:
-            return 0.5
+        return float(self.get_lambda_values(n_index, stage, modelled_entropy))
+
+    def get_lambda_values(self, n_index: int, stages, modelled_entropies) -> numpy.ndarray:
+        """Returns the lambda of many runs at once (see `get_lambda_value`)
+
+        :param n_index: Scaling factor for the circuit
+        :param stages: Stage of each run (an array, or a scalar for runs at the same stage)
+        :param modelled_entropies: Entropy of each run's modelled state after the previous stage
+        """
+        stages = numpy.asarray(stages)
+        modelled_entropies = numpy.asarray(modelled_entropies, dtype=numpy.float64)
+        if self.lambda_schedule == 'fixed':
+            lamb = numpy.full(numpy.broadcast(stages, modelled_entropies).shape, self.first_lambda)
         else:
-            return 2.0**(float(n_index - stage) - modelled_entropy)
+            lamb = numpy.where(stages == 1, self.first_lambda, 2.0**((n_index - stages) - modelled_entropies))
+        if self.max_lambda is not None:
+            lamb = numpy.minimum(lamb, self.max_lambda)
+        return lamb
@@ -0,0 +1,98 @@
+import numpy
+import scrambler
+import groverlong
+
+
+class ReducedEngine():
+    """Simulates the staged partial search on a 2^n_index amplitude vector over the x register only.
+
+    The keyscan oracles in `scrambler` are built from X, CX and SWAP gates, so the y register holds
+    a classical function of x and is returned to $\ket{0}$ by the inverse keyscan. The ancilla is
+    likewise restored by every kickback, which leaves a diagonal phase on x as the only effect of
+    the oracle. Qubit `i` of the x register maps to bit `i` of the amplitude index (as in Qiskit).
+    """
+
+    def __init__(self, enc: scrambler.Scrambler, n_index: int, plain: int, cipher: int, seed: int = None):
+        """
+        :param enc: Scrambler whose classical `scramble()` method defines the keyscan oracle
+        :param n_index: Scaling factor for the circuit
+        :param plain: Known plaintext
+        :param cipher: Known ciphertext
+        :param seed: Optional seed for the random number generator used to sample shots
+        """
+        self.n_index = n_index
+        self.enc = enc
+        self.plain = plain
+        self.cipher = cipher
+        self.grover = groverlong.GroverLong()
+        self.rng = numpy.random.default_rng(seed)
+        # Ciphertext of every key, from which the flag bits of each stage are computed
+        self.truth_table = enc.get_truth_table(n_index, plain)
+
+    def get_flag_mask(self, flag_bits: list) -> numpy.ndarray:
+        """Returns a boolean array that is True for every x where all of the given flag bits are set,
+        i.e. where the y register would match the ciphertext in those bits (see `Scrambler.get_flag_mask`)"""
+        return self.enc.get_flag_mask(self.n_index, self.plain, self.cipher, flag_bits, truth_table=self.truth_table)
+
+    def get_rotate_vector(self, modelled_state: list = None) -> numpy.ndarray:
+        """Returns the amplitude vector $\ket{\mu}$ produced by `Partial.get_rotate_circbox` acting on $\ket{0}$
+
+        :param modelled_state: A modelled state in the form of a list of tuples
+        [(cos(beta_1),sin(beta_1)), ..., (cos(beta_n),sin(beta_n))]
+        """
+        mu = numpy.ones(1, dtype=numpy.float64)
+        for i in range(self.n_index):
+            if (modelled_state is None) or (modelled_state==[]):
+                qubit_state = numpy.array([1.0, 1.0]) / numpy.sqrt(2.0)
+            else:
+                cos_beta, sin_beta = modelled_state[i]
+                qubit_state = numpy.array([cos_beta, sin_beta])
+            # Qubit i is bit i of the index, so each new qubit becomes the most significant factor
+            mu = numpy.kron(qubit_state, mu)
+        return mu
+
+    def apply_oracle(self, psi: numpy.ndarray, flag_mask: numpy.ndarray, phase: float) -> None:
+        """Applies the phase kickback of the oracle in place (phase in units of radians)"""
+        psi[flag_mask] *= numpy.exp(1j*phase)
+
+    def apply_diffusion(self, psi: numpy.ndarray, mu: numpy.ndarray, phase: float) -> None:
+        """Applies the Grover-Long diffusion operator $R (I + (e^{i\phi}-1)\ket{0}\bra{0}) R$ in place.
+        The rotation R is real and self-inverse with $R\ket{0} = \ket{\mu}$, so this reduces to
+        a rank-one update along $\ket{\mu}$."""
+        overlap = numpy.dot(mu, psi)
+        psi += (numpy.exp(1j*phase) - 1.0) * overlap * mu
+
+    def run_stage(self, modelled_state: list, lamb: float, flag_bits: list) -> numpy.ndarray:
+        """Returns the final amplitude vector over the x register for a single stage of the search
+
+        :param modelled_state: A modelled state in the form of a list of tuples, or None for the first stage
+        :param lamb: Weighting factor (amplitude squared) of the target vector
+        :param flag_bits: Specifies the list of flag bits (partial oracle bits) that are tested for this oracle.
+        """
+        gl = self.grover.get_g(lamb)
+        phase = self.grover.get_alpha(lamb, gl)
+        mu = self.get_rotate_vector(modelled_state)
+        flag_mask = self.get_flag_mask(flag_bits)
+        psi = mu.astype(numpy.complex128)
+        for i in range(0, gl):
+            self.apply_oracle(psi, flag_mask, phase)
+            self.apply_diffusion(psi, mu, phase)
+        return psi
+
+    def get_probabilities(self, psi: numpy.ndarray) -> numpy.ndarray:
+        """Returns the measurement probabilities of the x register"""
+        probs = numpy.abs(psi)**2
+        return probs / probs.sum()
+
+    def sample_distrib(self, probs: numpy.ndarray, n_shots: int, rng: numpy.random.Generator = None) -> tuple:
+        """Samples `n_shots` measurements and returns the arrays (outcomes, normalized counts).
+        The y register and the ancilla are always zero, so the outcomes have the same layout as
+        the full-register outcomes decoded by the circuit backends.
+
+        :param rng: Random number generator for this sample (defaults to the engine's generator)
+        """
+        if rng is None:
+            rng = self.rng
+        counts = rng.multinomial(n_shots, probs)
+        outcomes = numpy.flatnonzero(counts)
+        return outcomes, counts[outcomes] / float(n_shots)
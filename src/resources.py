@@ -0,0 +1,135 @@
+import os
+
+# Estimates of the resources needed to run the stage circuits, e.g. for choosing a backend that fits
+# in the memory budget (see `selector.BackendSelector`). The estimates are upper bounds for the
+# simulator state only; the circuits themselves and the interpreter overhead are not included.
+
+# Bytes per complex amplitude (complex128)
+amplitude_bytes = 16
+# Working copies of the state vector that a simulator may hold while applying a gate
+statevector_copies = 2
+
+
+def parse_memory(text: str) -> int:
+    """Returns the number of bytes for a memory size such as '512M', '8G' or '1048576'"""
+    text = text.strip().upper().rstrip('B')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_memory(n_bytes: float) -> str:
+    """Returns a memory size in human-readable form, e.g. '1.5G'"""
+    for unit, size in [('T', 1 << 40), ('G', 1 << 30), ('M', 1 << 20), ('K', 1 << 10)]:
+        if n_bytes >= size:
+            return '%.1f%s' % (n_bytes/size, unit)
+    return str(int(n_bytes)) + 'B'
+
+
+def get_available_memory() -> int:
+    """Returns the physical memory that is currently available, in bytes, or None if it is unknown"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_stage_qubits(n_index: int, folded: bool = False) -> int:
+    """Returns the width of the stage circuits: the x and y registers and the ancilla, or the x register
+    and the ancilla for the constant-folded oracle"""
+    return n_index + 1 if folded else 2*n_index + 1
+
+
+def estimate_memory(method: str, n_index: int, folded: bool = False, depth: int = None, max_bond: int = None) -> int:
+    """Returns an estimate of the peak memory (in bytes) for simulating one stage of the search
+
+    :param method: 'statevector', 'matrix_product_state' or 'reduced' (the NumPy engine in `reduced`)
+    :param n_index: Scaling factor for the circuit
+    :param folded: If True, the stage circuits use the constant-folded oracle
+    :param depth: Depth of the stage circuit, if known. It bounds the bond dimension of an MPS,
+        which can at most double with every layer of two-qubit gates.
+    :param max_bond: Maximum bond dimension of an MPS (truncation), if any
+    """
+    if method == 'reduced':
+        # Amplitudes, the rotated vector |mu>, the keyscan values and the probabilities, over x only
+        return (2*amplitude_bytes + 8 + 8) * (1 << n_index)
+    n_qubits = get_stage_qubits(n_index, folded)
+    if method == 'statevector':
+        return statevector_copies * amplitude_bytes * (1 << n_qubits)
+    if method == 'matrix_product_state':
+        # The bond dimension across the middle cut is at most 2^(n_qubits/2)
+        bond_exponent = n_qubits // 2
+        if depth is not None:
+            bond_exponent = min(bond_exponent, depth)
+        bond = 1 << bond_exponent
+        if max_bond is not None:
+            bond = min(bond, max_bond)
+        # Each site holds two (bond x bond) matrices, one per value of the qubit
+        return statevector_copies * n_qubits * 2 * bond * bond * amplitude_bytes
+    raise ValueError('Unknown simulation method: ' + str(method))
+
+
+# Throughput figures for the runtime predictions (see `estimate_runtime`), measured for single stages on a
+# desktop machine. They only give the order of magnitude, and can be adjusted for other machines and services.
+runtime_constants = {
+    # Seconds per gate (in the u, cx basis) per amplitude of the state vector
+    'local_qiskit': 1.2e-8,
+    'local_aer': 2e-11,
+    # Seconds per Grover-Long iteration per amplitude of the x register
+    'reduced': 3.5e-8,
+    # Fixed cost of submitting and collecting a local job
+    'local_job': 0.005,
+    # Waiting time in the queue for each job on IBM Cloud (depends on the service plan and the time of day)
+    'ibm_cloud_queue': 60.0,
+    # Duration of one layer of the transpiled circuit, and the delay between shots, on IBM hardware
+    'ibm_cloud_layer': 5e-7,
+    'ibm_cloud_repetition': 2.5e-4
+}
+
+# Simulation method of each backend, for the memory estimates (None for remote backends)
+backend_methods = {
+    'local_qiskit': 'statevector',
+    'local_aer': 'statevector',
+    'reduced': 'reduced',
+    'ibm_cloud': None
+}
+
+
+def estimate_runtime(
+        backend_name: str,
+        n_index: int,
+        folded: bool = False,
+        shots: int = 100,
+        g_l: int = 1,
+        size: int = None,
+        depth: int = None,
+        queue_time: float = None
+) -> float:
+    """Returns an estimate of the runtime (in seconds) of one stage on the named backend, or None if the
+    estimate needs the size or depth of the transpiled circuit and it is not given
+
+    :param backend_name: One of the keys of `backend_methods`
+    :param n_index: Scaling factor for the circuit
+    :param folded: If True, the stage circuits use the constant-folded oracle
+    :param shots: Number of shots
+    :param g_l: Number of Grover-Long iterations in the stage
+    :param size: Number of gates in the stage circuit, transpiled to the u, cx basis
+    :param depth: Depth of the transpiled stage circuit
+    :param queue_time: Queue time of a job on IBM Cloud (defaults to `runtime_constants['ibm_cloud_queue']`)
+    """
+    if backend_name == 'reduced':
+        # Rotation, oracle and diffusion passes over the amplitudes, plus sampling the shots
+        return runtime_constants['local_job'] + runtime_constants['reduced'] * (g_l + 2) * (1 << n_index)
+    if backend_name in ['local_qiskit', 'local_aer']:
+        if size is None:
+            return None
+        n_qubits = get_stage_qubits(n_index, folded)
+        return runtime_constants['local_job'] + runtime_constants[backend_name] * size * (1 << n_qubits)
+    if backend_name == 'ibm_cloud':
+        if depth is None:
+            return None
+        if queue_time is None:
+            queue_time = runtime_constants['ibm_cloud_queue']
+        return queue_time + shots * (depth * runtime_constants['ibm_cloud_layer'] + runtime_constants['ibm_cloud_repetition'])
+    raise ValueError('Unknown backend: ' + str(backend_name))
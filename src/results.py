@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import pathlib
+import time
+
+import numpy
+import atomicfile
+
+# Append-only store for search results. Rows are buffered in memory and flushed in batches, each batch
+# as a new compressed NPZ chunk in the results directory (existing chunks are never rewritten). Every
+# row holds the full run configuration and the stage-wise lamb, g_l and entropy, in a columnar layout,
+# so that sweeps can be analysed without re-parsing text, e.g.:
+#
+#   python3 results.py ../results/runs --x n_index --group-by scrambler backend n_shots entropy_threshold
+
+# Per-run columns: name -> (dtype, value used when missing)
+scalar_columns = {
+    'run_id': (numpy.str_, ''),
+    'time': (numpy.float64, numpy.nan),
+    'scrambler': (numpy.str_, ''),
+    'backend': (numpy.str_, ''),
+    'device': (numpy.str_, ''),
+    'n_index': (numpy.int64, -1),
+    'n_shots': (numpy.int64, -1),
+    'folded_oracle': (numpy.bool_, False),
+    'phase_synthesis': (numpy.str_, ''),
+    'plain': (numpy.int64, -1),
+    'key': (numpy.int64, -1),
+    # Early stopping and the model of the partial search (see `search.create_runner`), with -1 (or '') for the
+    # settings that are not given. Unlike NaN, these values compare equal, so that rows can be grouped by them.
+    'adaptive_shots': (numpy.str_, ''),
+    'entropy_threshold': (numpy.float64, -1.0),
+    'verify_top_k': (numpy.int64, -1),
+    'empirical_factor': (numpy.float64, -1.0),
+    'min_weight': (numpy.float64, -1.0),
+    'lambda_schedule': (numpy.str_, ''),
+    'first_lambda': (numpy.float64, -1.0),
+    'max_lambda': (numpy.float64, -1.0),
+    'seed': (numpy.int64, -1),
+    'sum_gl': (numpy.int64, -1),
+    'total_shots': (numpy.int64, -1),
+    'probability': (numpy.float64, numpy.nan),
+    'candidate': (numpy.int64, -1),
+    'candidate_probability': (numpy.float64, numpy.nan),
+    'verified_key': (numpy.int64, -1),
+    'verified_stage': (numpy.int64, -1),
+    'n_stages': (numpy.int64, 0)
+}
+
+# Per-stage columns, stored as (runs x stages) arrays padded with the missing value
+stage_columns = {
+    'lamb': (numpy.float64, numpy.nan),
+    'g_l': (numpy.int64, -1),
+    'entropy': (numpy.float64, numpy.nan),
+    'shots': (numpy.int64, -1)
+}
+
+# Search settings that are stored as they are given in the run configuration
+config_columns = [
+    'scrambler', 'n_index', 'n_shots', 'folded_oracle', 'plain', 'key', 'entropy_threshold', 'verify_top_k',
+    'empirical_factor', 'min_weight', 'lambda_schedule', 'first_lambda', 'max_lambda'
+]
+
+# Default grouping of the success-probability curves, which keeps runs that stop early apart from full-length runs
+default_group_by = ['scrambler', 'backend', 'n_shots', 'adaptive_shots', 'entropy_threshold', 'verify_top_k']
+
+
+class ResultsStore():
+    """Buffers search results and appends them to a results directory as NPZ chunks"""
+
+    def __init__(self, directory, batch_size: int = 64, run_id: str = None):
+        """
+        :param directory: Results directory (created if it does not exist)
+        :param batch_size: Number of rows that are buffered before they are flushed to a new chunk
+        :param run_id: Identifier that is stored with every row (defaults to the start time and process ID)
+        """
+        self.directory = pathlib.Path(directory)
+        self.batch_size = batch_size
+        if run_id is None:
+            run_id = time.strftime('%Y%m%dT%H%M%S') + '-' + str(os.getpid())
+        self.run_id = run_id
+        self.chunks_written = 0
+        self._rows = []
+
+    def add(self, config: dict, result: dict) -> None:
+        """Adds the result of one search to the buffer
+
+        :param config: Search settings (see `search.create_runner`)
+        :param result: Search result (see `search.SearchRunner.run`)
+        """
+        row = {name: config.get(name) for name in config_columns}
+        row['phase_synthesis'] = config.get('phase_synthesis', 'ancilla')
+        # The arguments of adaptive.AdaptiveShots are stored as a JSON string
+        adaptive_shots = config.get('adaptive_shots')
+        row['adaptive_shots'] = None if adaptive_shots is None else json.dumps(adaptive_shots, sort_keys=True)
+        for name in ['backend', 'device', 'seed', 'sum_gl', 'total_shots', 'probability', 'candidate', 'candidate_probability',
+                     'verified_key', 'verified_stage']:
+            row[name] = result.get(name)
+        row['run_id'] = self.run_id
+        row['time'] = time.time()
+        stages = result.get('stages', [])
+        row['n_stages'] = len(stages)
+        for name in stage_columns:
+            row[name] = [stage.get(name) for stage in stages]
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered rows to a new chunk"""
+        if not self._rows:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        columns = get_columns(self._rows)
+        name = 'results-' + self.run_id + '-' + str(self.chunks_written).zfill(5) + '.npz'
+        atomicfile.write(self.directory / name, lambda file: numpy.savez_compressed(file, **columns), binary=True)
+        self.chunks_written += 1
+        self._rows = []
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
+
+
+def get_columns(rows: list) -> dict:
+    """Returns the columns for a list of rows (see `ResultsStore.add`) as NumPy arrays"""
+    columns = dict()
+    for name, (dtype, missing) in scalar_columns.items():
+        columns[name] = numpy.array([missing if row[name] is None else row[name] for row in rows], dtype=dtype)
+    n_stages = max((len(row['lamb']) for row in rows), default=0)
+    for name, (dtype, missing) in stage_columns.items():
+        column = numpy.full((len(rows), n_stages), missing, dtype=dtype)
+        for i, row in enumerate(rows):
+            column[i, :len(row[name])] = row[name]
+        columns[name] = column
+    return columns
+
+
+def load_results(directory) -> dict:
+    """Returns all of the rows in the results directory as a dict of NumPy arrays (one per column).
+    The per-stage columns are padded to the largest number of stages in any chunk, and columns that
+    are missing from older chunks are filled with the missing value."""
+    chunks = []
+    for path in sorted(pathlib.Path(directory).glob('results-*.npz')):
+        with numpy.load(path) as chunk:
+            chunks.append({name: chunk[name] for name in chunk.files})
+    data = dict()
+    for name, (dtype, missing) in scalar_columns.items():
+        parts = [
+            chunk[name] if name in chunk else numpy.full(len(chunk['run_id']), missing, dtype=dtype)
+            for chunk in chunks
+        ]
+        data[name] = numpy.concatenate(parts) if parts else numpy.array([], dtype=dtype)
+    n_stages = max((chunk['lamb'].shape[1] for chunk in chunks), default=0)
+    for name, (dtype, missing) in stage_columns.items():
+        parts = []
+        for chunk in chunks:
+            part = chunk[name]
+            parts.append(numpy.pad(part, ((0, 0), (0, n_stages - part.shape[1])), constant_values=missing))
+        data[name] = numpy.concatenate(parts) if parts else numpy.zeros((0, 0), dtype=dtype)
+    return data
+
+
+def get_success_curves(data: dict, x: str = 'n_index', group_by: tuple = tuple(default_group_by)) -> list:
+    """Returns the aggregate success-probability curve, as a function of the column `x`, for each group of rows
+    with the same values in the `group_by` columns (any of the `scalar_columns`). Each curve is a dict with the keys `group` (a dict of the
+    group values) and `x`, `count`, `mean_probability`, `stderr` and `success_rate` (arrays over the x values).
+    The success rate is the fraction of searches whose most probable candidate is the key (for known keys)."""
+    if len(data['run_id']) == 0:
+        return []
+    groups = numpy.rec.fromarrays([data[name] for name in group_by], names=list(group_by)) if group_by else None
+    group_values = numpy.unique(groups) if group_by else [None]
+    curves = []
+    for group_value in group_values:
+        in_group = (groups == group_value) if group_by else numpy.ones(len(data['run_id']), dtype=bool)
+        x_values = numpy.unique(data[x][in_group])
+        curve = {
+            'group': {name: group_value[name].item() for name in group_by} if group_by else dict(),
+            'x': x_values,
+            'count': numpy.zeros(len(x_values), dtype=numpy.int64),
+            'mean_probability': numpy.full(len(x_values), numpy.nan),
+            'stderr': numpy.full(len(x_values), numpy.nan),
+            'success_rate': numpy.full(len(x_values), numpy.nan)
+        }
+        for i, x_value in enumerate(x_values):
+            rows = in_group & (data[x] == x_value)
+            curve['count'][i] = rows.sum()
+            probability = data['probability'][rows]
+            probability = probability[~numpy.isnan(probability)]
+            if len(probability) > 0:
+                curve['mean_probability'][i] = probability.mean()
+                curve['stderr'][i] = probability.std(ddof=1)/numpy.sqrt(len(probability)) if len(probability) > 1 else numpy.nan
+            known_key = rows & (data['key'] >= 0)
+            if known_key.any():
+                curve['success_rate'][i] = (data['candidate'][known_key] == data['key'][known_key]).mean()
+        curves.append(curve)
+    return curves
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints the success-probability curves for a results directory')
+    parser.add_argument('directory', nargs='?', default='../results/runs')
+    parser.add_argument('--x', default='n_index')
+    parser.add_argument('--group-by', nargs='*', default=default_group_by, choices=list(scalar_columns))
+    args = parser.parse_args()
+    curves = get_success_curves(load_results(args.directory), x=args.x, group_by=tuple(args.group_by))
+    print(','.join(list(args.group_by) + [args.x, 'count', 'mean_probability', 'stderr', 'success_rate']))
+    for curve in curves:
+        group = [str(curve['group'][name]) for name in args.group_by]
+        for i in range(len(curve['x'])):
+            values = [curve['x'][i], curve['count'][i], curve['mean_probability'][i], curve['stderr'][i], curve['success_rate'][i]]
+            print(','.join(group + [str(v) for v in values]))
+
+
+if __name__ == '__main__':
+    main()
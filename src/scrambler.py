@@ -1,3 +1,4 @@
+import numpy
 import qiskit.circuit
 
 class Scrambler():
@@ -8,6 +9,49 @@ class Scrambler():
     def unscramble(self, bit_width: int, cipher: int, key: int) -> int:
         pass
 
+    def scramble_many(self, bit_width: int, plain, keys) -> numpy.ndarray:
+        """Scrambles a batch of plaintexts and/or keys, returning a `numpy.uint64` array of ciphertexts.
+        Either argument can be an int or a NumPy array (they are broadcast against each other).
+        Subclasses override this with vectorized operations; the default calls `scramble()` for each element."""
+        plain, keys = numpy.broadcast_arrays(_as_uint64(plain), _as_uint64(keys))
+        ciphers = [self.scramble(bit_width, int(p), int(k)) for p, k in zip(plain.ravel(), keys.ravel())]
+        return numpy.array(ciphers, dtype=numpy.uint64).reshape(plain.shape)
+
+    def unscramble_many(self, bit_width: int, cipher, keys) -> numpy.ndarray:
+        """Unscrambles a batch of ciphertexts and/or keys, returning a `numpy.uint64` array of plaintexts
+        (see `scramble_many()`)"""
+        cipher, keys = numpy.broadcast_arrays(_as_uint64(cipher), _as_uint64(keys))
+        plains = [self.unscramble(bit_width, int(c), int(k)) for c, k in zip(cipher.ravel(), keys.ravel())]
+        return numpy.array(plains, dtype=numpy.uint64).reshape(cipher.shape)
+
+    def get_truth_table(self, n_index: int, plain: int) -> numpy.ndarray:
+        """Returns the ciphertext for every one of the 2^n_index keys, indexed by key"""
+        keys = numpy.arange(1 << n_index, dtype=numpy.uint64)
+        return self.scramble_many(n_index, plain, keys)
+
+    def get_flag_mask(
+            self,
+            n_index: int,
+            plain: int,
+            cipher: int,
+            flag_bits: list = None,
+            truth_table: numpy.ndarray = None
+    ) -> numpy.ndarray:
+        """Returns a boolean array over all of the 2^n_index keys, which is True for every key whose
+        ciphertext matches `cipher` in the given flag bits (or in all of the bits, if `flag_bits` is None)
+
+        :param truth_table: The output of `get_truth_table()` for (n_index, plain), if it is already known
+        """
+        if flag_bits is None:
+            flag_bits = range(n_index)
+        if truth_table is None:
+            truth_table = self.get_truth_table(n_index, plain)
+        bits_mask = 0
+        for i in flag_bits:
+            bits_mask |= (0b1 << i)
+        bits_mask = numpy.uint64(bits_mask)
+        return (truth_table & bits_mask) == (numpy.uint64(cipher) & bits_mask)
+
     def get_keyscan_circbox(self, n_index: int, plain: int, cipher: int) -> qiskit.circuit.Gate:
         pass
 
@@ -24,6 +68,43 @@ class Scrambler():
     ) -> None:
         pass
 
+    def get_flag_qubit_map(self, n_index: int, plain: int) -> list:
+        """Returns a list whose entry `j` is the index of the x qubit that carries flag bit `j`
+        in the constant-folded keyscan oracle.
+
+        This works for any scrambler whose `scramble()` is a fixed bit permutation of `plain ^ key`,
+        which holds for all of the scramblers built from X, CX and SWAP gates in this module."""
+        n_mask = (1 << n_index) - 1
+        base = self.scramble(n_index, plain, 0)
+        qubit_map = [None] * n_index
+        for i in range(n_index):
+            diff = (self.scramble(n_index, plain, 1 << i) ^ base) & n_mask
+            assert (diff != 0) and (diff & (diff - 1) == 0), "Scrambler cannot be constant-folded"
+            qubit_map[diff.bit_length() - 1] = i
+        return qubit_map
+
+    def get_folded_keyscan_circbox(self, n_index: int, plain: int, cipher: int) -> qiskit.circuit.Gate:
+        """Encapsulates the constant-folded keyscan circuit in a single gate that spans the x qubits only.
+
+        The flag bits are a classical function of the key, `scramble(plain, x) XOR NOT cipher`, so
+        the plaintext and ciphertext constants reduce to X gates on the x qubits that carry each flag bit
+        (see `get_flag_qubit_map()`). No y register is needed and the gate is its own inverse."""
+        n_mask = (1 << n_index) - 1
+        flip = (self.scramble(n_index, plain, 0) ^ ~cipher) & n_mask
+        qubit_map = self.get_flag_qubit_map(n_index, plain)
+        subcirc = qiskit.QuantumCircuit(n_index, name="FoldedScramble")
+        for j in range(n_index):
+            if flip & (0b1 << j):
+                subcirc.x(qubit_map[j])
+        return subcirc.to_gate()
+
+    def get_inverse_folded_keyscan_circbox(self, n_index: int, plain: int, cipher: int) -> qiskit.circuit.Gate:
+        """Encapsulates the inverse of the constant-folded keyscan circuit in a single gate"""
+        # The folded keyscan circuit consists of X gates only, so it is self-inverse
+        gate = self.get_folded_keyscan_circbox(n_index, plain, cipher)
+        gate.name = "InvFoldedScramble"
+        return gate
+
 
 class ScramblerBasic(Scrambler):
 
@@ -40,6 +121,14 @@ class ScramblerBasic(Scrambler):
         # Decryption performed simply as XOR of cipher and key
         return cipher ^ key
 
+    def scramble_many(self, bit_width: int, plain, keys) -> numpy.ndarray:
+        """Vectorized `scramble()` (see `Scrambler.scramble_many()`)"""
+        return _as_uint64(plain) ^ _as_uint64(keys)
+
+    def unscramble_many(self, bit_width: int, cipher, keys) -> numpy.ndarray:
+        """Vectorized `unscramble()` (see `Scrambler.unscramble_many()`)"""
+        return _as_uint64(cipher) ^ _as_uint64(keys)
+
     def get_keyscan_circbox(self, n_index: int, plain: int, cipher: int) -> qiskit.circuit.Gate:
         """Encapsulates the keyscan circuit in a single gate"""
         # Create a sub-circuit to span the x and y qubits, but not the ancilla qubit
@@ -49,10 +138,8 @@ class ScramblerBasic(Scrambler):
 
     def get_inverse_keyscan_circbox(self, n_index: int, plain: int, cipher: int) -> qiskit.circuit.Gate:
         """Encapsulates the inverse (hermitian adjoint) keyscan circuit in a single gate"""
-        # Create a sub-circuit to span the x and y qubits, but not the ancilla qubit
-        subcirc = qiskit.QuantumCircuit(2*n_index, name="Scramble")
-        self.add_keyscan_circuit(subcirc, n_index, plain, cipher, withbarriers=False)
-        invcirc = subcirc.inverse()
+        # Invert the definition of the keyscan gate, instead of building the sub-circuit again
+        invcirc = self.get_keyscan_circbox(n_index, plain, cipher).definition.inverse()
         invcirc.name = "InvScramble"
         return invcirc.to_gate()
 
@@ -111,6 +198,11 @@ class ScramblerWithSwap(Scrambler):
         cipher = (cipher & ~mask1) | bit2
         return cipher
 
+    def _swap_bits_many(self, ciphers: numpy.ndarray, pos1: int, pos2: int) -> numpy.ndarray:
+        # XOR both bits with their difference, which swaps them wherever they differ
+        diff = ((ciphers >> numpy.uint64(pos1)) ^ (ciphers >> numpy.uint64(pos2))) & numpy.uint64(1)
+        return ciphers ^ ((diff << numpy.uint64(pos1)) | (diff << numpy.uint64(pos2)))
+
     def scramble(self, bit_width: int, plain: int, key: int) -> int:
         cipher = plain ^ key
         cipher = self._swap_bits(bit_width, cipher, 0, 4)
@@ -123,6 +215,19 @@ class ScramblerWithSwap(Scrambler):
         plain = cipher ^ key
         return plain
 
+    def scramble_many(self, bit_width: int, plain, keys) -> numpy.ndarray:
+        """Vectorized `scramble()` (see `Scrambler.scramble_many()`)"""
+        ciphers = _as_uint64(plain) ^ _as_uint64(keys)
+        ciphers = self._swap_bits_many(ciphers, 0, 4)
+        ciphers = self._swap_bits_many(ciphers, 2, 6)
+        return ciphers
+
+    def unscramble_many(self, bit_width: int, cipher, keys) -> numpy.ndarray:
+        """Vectorized `unscramble()` (see `Scrambler.unscramble_many()`)"""
+        ciphers = self._swap_bits_many(_as_uint64(cipher), 2, 6)
+        ciphers = self._swap_bits_many(ciphers, 0, 4)
+        return ciphers ^ _as_uint64(keys)
+
     def get_keyscan_circbox(self, n_index: int, plain: int, cipher: int) -> qiskit.circuit.Gate:
         # Create a sub-circuit to span the x and y qubits, but not the ancilla qubit
         subcirc = qiskit.QuantumCircuit(2*n_index, name="Scramble")
@@ -130,10 +235,8 @@ class ScramblerWithSwap(Scrambler):
         return subcirc.to_gate()
 
     def get_inverse_keyscan_circbox(self, n_index: int, plain: int, cipher: int) -> qiskit.circuit.Gate:
-        # Create a sub-circuit to span the x and y qubits, but not the ancilla qubit
-        subcirc = qiskit.QuantumCircuit(2*n_index, name="Scramble")
-        self.add_keyscan_circuit(subcirc, n_index, plain, cipher, withbarriers=False)
-        invcirc = subcirc.inverse()
+        # Invert the definition of the keyscan gate, instead of building the sub-circuit again
+        invcirc = self.get_keyscan_circbox(n_index, plain, cipher).definition.inverse()
         invcirc.name = "InvScramble"
         return invcirc.to_gate()
 
@@ -172,3 +275,19 @@ class ScramblerWithSwap(Scrambler):
                 c.x(i)
             mask <<= 1
         if withbarriers: c.barrier(y_qubits)
+
+
+def _as_uint64(values) -> numpy.ndarray:
+    # Python ints and integer arrays of up to 64 bits are handled as unsigned 64-bit values
+    return numpy.asarray(values, dtype=numpy.uint64)
+
+
+# Scrambler classes by name, e.g. for selecting a scrambler from a configuration
+scrambler_types = {
+    'basic': ScramblerBasic,
+    'swap': ScramblerWithSwap
+}
+
+# Default plain text and encryption key of the mainline and the scripts (masked to n_index bits)
+default_plain = 0b10110000101101001011010010010010
+default_key = 0b01001101000100010001011101001100
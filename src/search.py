@@ -0,0 +1,540 @@
+import concurrent.futures
+import multiprocessing.util
+import pathlib
+
+import numpy
+import adaptive
+import checkpoint
+import distribution
+import gatelibrary
+import instrument
+import selector
+import scrambler
+import partial
+import groverlong
+import stagetemplate
+
+
+class SearchRunner():
+    """Runs the staged partial search for one (plain, cipher) pair on a given backend.
+
+    The keyscan gates and stage templates (or the reduced engine) are prepared once in the constructor,
+    so that `run()` can be called repeatedly, e.g. once per repeat.
+    """
+
+    def __init__(
+            self,
+            backend: selector.Backend,
+            enc: scrambler.Scrambler,
+            n_index: int,
+            plain: int,
+            cipher: int,
+            n_shots: int = 100,
+            folded_oracle: bool = False,
+            key: int = None,
+            phase_synthesis: str = 'ancilla',
+            verbose: bool = True,
+            shared_gates: stagetemplate.SharedStageGates = None,
+            adaptive_shots: adaptive.AdaptiveShots = None,
+            entropy_threshold: float = None,
+            verify_top_k: int = None,
+            partial_search: partial.Partial = None
+    ):
+        """
+        :param backend: Backend returned by `BackendSelector.select()`
+        :param enc: Scrambler that defines the keyscan oracle
+        :param n_index: Scaling factor for the circuit
+        :param plain: Known plaintext
+        :param cipher: Known ciphertext
+        :param n_shots: Number of shots for running the circuit on the backend at each stage
+            (ignored if `adaptive_shots` is given)
+        :param folded_oracle: If True, use the constant-folded keyscan oracle (n_index+1 qubits)
+        :param key: The expected key, if known, for computing the success probability
+        :param phase_synthesis: Synthesis strategy for the multi-controlled phases (see `groverlong.phase_synthesis_strategies`)
+        :param verbose: If True, print the progress of each stage
+        :param shared_gates: Gates that only depend on n_index, shared with the runners for other targets
+            (None builds them for this runner)
+        :param adaptive_shots: If given, the shots of each stage are issued in increments until the
+            modelled state is known well enough (see `adaptive.AdaptiveShots`)
+        :param entropy_threshold: If given, the search stops early once the modelled entropy drops below this value
+        :param verify_top_k: If given, the `verify_top_k` most probable x register values are checked classically
+            against (plain, cipher) after every stage, and the search stops as soon as one of them is a valid key
+        :param partial_search: Model of the partial search, i.e. the modelled state and the lambda schedule
+            (defaults to `partial.Partial()`)
+        """
+        self.backend = backend
+        self.enc = enc
+        self.n_index = n_index
+        self.n_mask = (1 << n_index) - 1
+        self.plain = plain
+        self.cipher = cipher
+        self.n_shots = n_shots
+        self.folded_oracle = folded_oracle
+        self.key = key
+        self.verbose = verbose
+        self.adaptive_shots = adaptive_shots
+        self.entropy_threshold = entropy_threshold
+        self.verify_top_k = verify_top_k
+        self.partial_search = partial.Partial() if partial_search is None else partial_search
+        self.grover = groverlong.GroverLong()
+        self.templates = None
+        self.flag_qubit_map = None
+        self.tracer = instrument.get_tracer()
+        # Generator for the seeds of the stage jobs (see `set_seed`)
+        self.rng = None
+
+        if isinstance(backend, selector.ReducedBackend):
+            backend.prepare(enc, n_index, plain, cipher)
+            return
+        # The keyscan gates are taken from the gate library. The folded keyscan gate is self-inverse, and the
+        # inverse of the full keyscan gate is derived from the keyscan gate.
+        library = gatelibrary.get_gate_library()
+        gate_key = (type(enc).__name__, n_index, plain, cipher)
+        if folded_oracle:
+            flag_circbox = library.get(
+                ('folded_keyscan',) + gate_key, lambda: enc.get_folded_keyscan_circbox(n_index, plain, cipher)
+            )
+            inv_flag_circbox = library.get(
+                ('inverse_folded_keyscan',) + gate_key, lambda: enc.get_inverse_folded_keyscan_circbox(n_index, plain, cipher)
+            )
+            self.flag_qubit_map = enc.get_flag_qubit_map(n_index, plain)
+        else:
+            flag_circbox = library.get(
+                ('keyscan',) + gate_key, lambda: enc.get_keyscan_circbox(n_index, plain, cipher)
+            )
+            inv_flag_circbox = library.get(
+                ('inverse_keyscan',) + gate_key, lambda: gatelibrary.get_inverse_gate(flag_circbox, "InvScramble")
+            )
+        self.templates = stagetemplate.StageTemplateLibrary(
+            n_index,
+            flag_circbox,
+            inv_flag_circbox,
+            folded=folded_oracle,
+            phase_synthesis=phase_synthesis,
+            shared_gates=shared_gates
+        )
+
+    def _print(self, *args) -> None:
+        if self.verbose:
+            print(*args)
+
+    def set_seed(self, seed=None) -> None:
+        """Seeds the shot sampling of the search (None for non-deterministic sampling). Each stage job gets
+        its own seed from this generator, so the backend can be shared with other searches."""
+        self.rng = None if seed is None else numpy.random.default_rng(seed)
+
+    def get_rng_state(self) -> dict:
+        """Returns the state of the seeded random number generator (JSON-serializable), or None if there is none"""
+        return None if self.rng is None else self.rng.bit_generator.state
+
+    def set_rng_state(self, rng_state: dict) -> None:
+        """Restores a state returned by `get_rng_state()`, e.g. when resuming a search from a checkpoint"""
+        if rng_state is None:
+            self.rng = None
+            return
+        self.rng = numpy.random.default_rng()
+        self.rng.bit_generator.state = rng_state
+
+    def get_job_seed(self) -> int:
+        """Returns the seed for the next stage job, or None if the search is not seeded"""
+        return None if self.rng is None else int(self.rng.integers(2**31))
+
+    def get_circuit_flag_bits(self, flag_bits: list) -> list:
+        """Maps the flag bits of a stage to the qubits that the oracle tests"""
+        if self.folded_oracle:
+            return [self.flag_qubit_map[j] for j in flag_bits]
+        return flag_bits
+
+    def build_stage(self, stage: int, lamb: float, gl: int, modelled_state: list = None) -> tuple:
+        """Returns the stage circuit (a parameterized template) and the parameter values for this stage"""
+        flag_bits = list(range(stage))
+        phase = self.grover.get_alpha(lamb, gl)
+        self._print('\ng_l = ' + str(gl))
+        self._print('phase = ' + str(phase/numpy.pi)) # Print phase in units of pi
+        # Phase is reported in units of pi
+        self.tracer.event('groverlong', g_l=gl, phase=phase/numpy.pi)
+
+        # The stage circuit is built once per (stage, g_l) and only the angles change
+        template = self.templates.get_template(stage, gl, self.get_circuit_flag_bits(flag_bits))
+        parameter_values = template.get_parameter_values(
+            self.partial_search.get_beta_angles(self.n_index, modelled_state),
+            phase
+        )
+        return template.circuit, parameter_values
+
+    def run_stage(self, stage: int, lamb: float, gl: int, modelled_state: list = None, shots: int = None):
+        """Runs a single stage of the search and returns the normalized distribution of measured outcomes
+
+        :param shots: Number of shots (defaults to `n_shots`)
+        """
+        if shots is None:
+            shots = self.n_shots
+        seed = self.get_job_seed()
+        if isinstance(self.backend, selector.ReducedBackend):
+            # Simulate the x register only, with the oracle computed classically
+            flag_bits = list(range(stage))
+            with self.tracer.span('execute'):
+                result = self.backend.run_stage(modelled_state, lamb, flag_bits, shots=shots, seed=seed)
+            return self.backend.get_normalized_distrib_from_result(self.n_index, None, result)
+
+        with self.tracer.span('build') as span:
+            circ, parameter_values = self.build_stage(stage, lamb, gl, modelled_state)
+            span['qubits'] = circ.num_qubits
+
+        # Visualize the circuit
+        # circuit.draw(output='mpl') # Uses 'matplotlib' instead of ASCII art
+        #print(circ.draw())  # Uses ASCII art
+
+        # Run the circuit on the selected backend. Local simulators are transpiled for here, so that the
+        # 'transpile' span is separate, and the simulation of a synchronous backend is timed as 'simulate'.
+        transpiled = hasattr(self.backend, 'transpile') and not self.backend.exact
+        submit_name = 'simulate' if (transpiled and self.backend.synchronous) else 'submit'
+        if transpiled:
+            new_circuit = self.backend.transpile(circ, parameter_values)
+        with self.tracer.span(submit_name) as span:
+            if transpiled:
+                job = self.backend.run_transpiled(new_circuit, shots=shots, seed=seed)
+            else:
+                job = self.backend.run(circ, shots=shots, parameter_values=parameter_values, seed=seed)
+            if self.tracer.enabled:
+                span['job_id'] = get_job_id(job)
+        with self.tracer.span('wait'):
+            result = job.result()
+        # Works for local simulation
+        #counts = result.get_counts(circ)
+        # Works with Sampler() primitive (remote IBM backend service)
+        #counts = result.quasi_dists[0]
+        # Works with everything(!)
+        with self.tracer.span('decode') as span:
+            distrib = self.backend.get_normalized_distrib_from_result(self.n_index, circ, result)
+            span['outcomes'] = len(distrib)
+        #print(distrib)
+        return distrib
+
+    def sample_stage(self, stage: int, lamb: float, gl: int, modelled_state: list = None) -> tuple:
+        """Runs a single stage of the search, with adaptive shot allocation if it is enabled, and
+        returns (distribution, number of shots)"""
+        if (self.adaptive_shots is None) or getattr(self.backend, 'exact', False):
+            return self.run_stage(stage, lamb, gl, modelled_state), self.n_shots
+        # Issue shots in increments and pool them, until the modelled state is known well enough
+        n_shots = 0
+        distrib = None
+        while True:
+            increment = self.adaptive_shots.get_next_increment(n_shots)
+            new_distrib = self.run_stage(stage, lamb, gl, modelled_state, shots=increment)
+            if distrib is None:
+                distrib = new_distrib
+            else:
+                distrib = distribution.merge([distrib, new_distrib], [n_shots, increment])
+            n_shots += increment
+            if self.adaptive_shots.is_converged(self.n_index, n_shots, distrib):
+                break
+        self._print('#Shots = ' + str(n_shots))
+        return distrib, n_shots
+
+    def new_state(self) -> dict:
+        """Returns the initial state of a search. The state holds the number of the last completed `stage`,
+        the `modelled_state` and `modelled_entropy`, the running `sum_gl` and `total_shots`, the list of
+        per-stage summaries (`stages`), the last measured distribution (`distrib`) and its number of shots (`n_shots`),
+        and the key that was confirmed by classical verification (`verified_key`) and the stage that found it (`verified_stage`)."""
+        return {
+            'stage': 0,
+            'modelled_state': None,
+            'modelled_entropy': float(self.n_index),
+            'sum_gl': 0,
+            'total_shots': 0,
+            'stages': [],
+            'distrib': None,
+            'n_shots': self.n_shots,
+            'verified_key': None,
+            'verified_stage': None
+        }
+
+    def is_finished(self, state: dict) -> bool:
+        if state['verified_key'] is not None:
+            return True
+        if (self.entropy_threshold is not None) and (state['stage'] > 0):
+            # Stop early once the modelled state is (almost) a single key
+            if state['modelled_entropy'] < self.entropy_threshold:
+                return True
+        return state['stage'] >= self.n_index
+
+    def plan_stage(self, state: dict) -> tuple:
+        """Returns (stage, lamb, g_l) for the next stage of the search"""
+        stage = state['stage'] + 1
+        self.tracer.set_context(stage=stage)
+        self._print('\nSTAGE ' + str(stage) + ':')
+        lamb = self.partial_search.get_lambda_value(self.n_index, stage, state['modelled_entropy'])
+        self._print('lamb = ' + str(lamb))
+        gl = self.grover.get_g(lamb)
+        return stage, lamb, gl
+
+    def update_state(self, state: dict, stage: int, lamb: float, gl: int, distrib, n_shots: int = None) -> None:
+        """Updates the search state with the distribution measured in the given stage
+
+        :param n_shots: Number of shots behind the distribution (defaults to `n_shots`)
+        """
+        if n_shots is None:
+            n_shots = self.n_shots
+        with self.tracer.span('model'):
+            modelled_state = self.partial_search.get_modelled_state(self.n_index, n_shots, distrib)
+        self._print(modelled_state)
+        with self.tracer.span('entropy'):
+            modelled_entropy = self.partial_search.get_entropy_from_modelled_state(self.n_index, modelled_state)
+        self._print('entropy of modelled state = ' + str(modelled_entropy))
+        state['stage'] = stage
+        state['modelled_state'] = modelled_state
+        state['modelled_entropy'] = modelled_entropy
+        state['sum_gl'] += gl
+        state['total_shots'] += n_shots
+        state['stages'].append({'stage': stage, 'lamb': lamb, 'g_l': gl, 'entropy': modelled_entropy, 'shots': n_shots})
+        state['distrib'] = distrib
+        state['n_shots'] = n_shots
+        self.tracer.event('stage', lamb=lamb, g_l=gl, entropy=modelled_entropy, shots=n_shots)
+
+        # Analyse the count and check the results
+        if self.verbose:
+            print()  # Blank line
+            print(distrib.get_most_common(self.n_index, n_shots, 32))
+        if self.verify_top_k:
+            self.verify_candidates(state, stage, distrib)
+
+    def verify_candidates(self, state: dict, stage: int, distrib) -> None:
+        """Checks the most probable x register values of the distribution against (plain, cipher) and
+        records the first valid key (and the stage) in the search state"""
+        with self.tracer.span('verify') as span:
+            candidates = distrib.get_top_register_values(0, self.n_index, self.verify_top_k)
+            keys = numpy.array([candidate for candidate, candidate_probability in candidates], dtype=numpy.uint64)
+            matches = numpy.flatnonzero(self.enc.scramble_many(self.n_index, self.plain, keys) == numpy.uint64(self.cipher))
+            if len(matches) > 0:
+                # The candidates are in order of decreasing probability
+                candidate = int(keys[matches[0]])
+                state['verified_key'] = candidate
+                state['verified_stage'] = stage
+                self._print('Verified key = ' + bin(candidate) + ' at stage ' + str(stage))
+            span['candidates'] = len(candidates)
+            span['verified'] = state['verified_key'] is not None
+
+    def get_result(self, state: dict) -> dict:
+        """Returns the result of a finished search: the total number of Grover-Long iterations (`sum_gl`),
+        the total number of shots (`total_shots`),
+        the success probability (`probability`, or None if no key is given), the most probable value
+        of the x register (`candidate`) and its probability (`candidate_probability`), the `backend`
+        and `device` names, the classically verified key and the stage at which it was found (`verified_key` and
+        `verified_stage`, or None), and a list of per-stage dicts with `stage`, `lamb`, `g_l`, `entropy` and `shots`"""
+        probability = None
+        if self.key is not None:
+            # Probability of measuring the expected key in the x register, with the y register cleared
+            probability = state['distrib'].get_probability(self.n_index, state['n_shots'], self.key, 0)
+        candidate, candidate_probability = state['distrib'].get_top_register_values(0, self.n_index, 1)[0]
+        self.tracer.set_context(stage=None)
+        self.tracer.event(
+            'search', sum_gl=state['sum_gl'], total_shots=state['total_shots'], probability=probability,
+            verified_stage=state['verified_stage']
+        )
+        return {
+            'backend': self.backend.name,
+            'device': self.backend.device,
+            'sum_gl': state['sum_gl'],
+            'total_shots': state['total_shots'],
+            'probability': probability,
+            'candidate': candidate,
+            'candidate_probability': candidate_probability,
+            'verified_key': state['verified_key'],
+            'verified_stage': state['verified_stage'],
+            'stages': state['stages']
+        }
+
+    def start(self, seed=None, checkpoint_file: checkpoint.Checkpoint = None) -> dict:
+        """Seeds the search and returns its initial state, or the state saved in the checkpoint file.
+        `start()`, `plan_stage()`, `sample_stage()`, `finish_stage()` and `get_result()` are the steps of `run()`,
+        which other drivers of the stage loop (e.g. `campaign.Campaign`) use in the same order.
+
+        :param seed: Optional seed for the shot sampling (see `set_seed`)
+        :param checkpoint_file: If given, a search with a saved state is resumed after its last finished stage
+        """
+        self.set_seed(seed)
+        self.tracer.set_context(seed=seed)
+        state = self.new_state()
+        if checkpoint_file is not None:
+            saved_state, rng_state = checkpoint_file.load(seed)
+            if saved_state is not None:
+                state = saved_state
+                self.set_rng_state(rng_state)
+                self._print('\nResuming after stage ' + str(state['stage']) + ' from ' + str(checkpoint_file.path))
+                self.tracer.event('resume', resumed_stage=state['stage'])
+        return state
+
+    def finish_stage(
+            self,
+            state: dict,
+            stage: int,
+            lamb: float,
+            gl: int,
+            distrib,
+            n_shots: int = None,
+            seed=None,
+            checkpoint_file: checkpoint.Checkpoint = None
+    ) -> None:
+        """Updates the search state with the result of a stage (see `update_state`) and saves it to the checkpoint file, if any
+
+        :param seed: Seed of the search, which is saved with the state
+        """
+        self.update_state(state, stage, lamb, gl, distrib, n_shots)
+        if checkpoint_file is not None:
+            with self.tracer.span('checkpoint'):
+                checkpoint_file.save(state, seed, self.get_rng_state())
+
+    def run(self, seed=None, checkpoint_file: checkpoint.Checkpoint = None) -> dict:
+        """Runs all of the stages of the search once and returns the result (see `get_result`), with the `seed`
+
+        :param seed: Optional seed for the shot sampling (see `set_seed`)
+        :param checkpoint_file: If given, the search state is saved after every stage, and a search with a saved
+            state is resumed after its last finished stage (see `checkpoint.Checkpoint`)
+        """
+        state = self.start(seed, checkpoint_file)
+        while not self.is_finished(state):
+            stage, lamb, gl = self.plan_stage(state)
+            distrib, n_shots = self.sample_stage(stage, lamb, gl, state['modelled_state'])
+            self.finish_stage(state, stage, lamb, gl, distrib, n_shots, seed, checkpoint_file)
+        result = self.get_result(state)
+        result['seed'] = seed
+        return result
+
+
+def get_job_id(job) -> str:
+    """Returns the backend job ID, or None if the job object has none"""
+    job_id = getattr(job, 'job_id', None)
+    return job_id() if callable(job_id) else job_id
+
+
+def get_repeat_seeds(seed: int, n_repeats: int) -> list:
+    """Returns deterministic, independent seeds for each repeat, derived from a single base seed"""
+    if seed is None:
+        return [None] * n_repeats
+    children = numpy.random.SeedSequence(seed).spawn(n_repeats)
+    return [int(child.generate_state(1)[0]) for child in children]
+
+
+# Search runner for the current worker process, created once by _init_worker()
+_worker_runner = None
+
+
+def _init_worker(settings: dict) -> None:
+    global _worker_runner
+    _worker_runner = create_runner(settings, verbose=False)
+    # Close the backend (e.g. the IBM runtime session) when the worker process exits. atexit handlers
+    # do not run in pool workers, but multiprocessing runs the finalizers that have an exit priority.
+    multiprocessing.util.Finalize(_worker_runner, _worker_runner.backend.close, exitpriority=10)
+
+
+def _run_worker_repeat(args: tuple) -> dict:
+    seed, checkpoint_file = args
+    return _worker_runner.run(seed=seed, checkpoint_file=checkpoint_file)
+
+
+# Settings that configure the model of the partial search (see `partial.Partial`)
+partial_settings = ['empirical_factor', 'min_weight', 'lambda_schedule', 'first_lambda', 'max_lambda']
+
+
+def get_partial_search(settings: dict) -> partial.Partial:
+    """Returns the model of the partial search for the `partial_settings` in the settings (defaults for the others)"""
+    return partial.Partial(**{name: settings[name] for name in partial_settings if settings.get(name) is not None})
+
+
+def create_runner(
+        settings: dict,
+        verbose: bool = True,
+        backend: selector.Backend = None,
+        shared_gates: stagetemplate.SharedStageGates = None
+) -> SearchRunner:
+    """Creates a search runner (and its backend) from a dict of settings with the keys
+    `scrambler` (a key of `scrambler.scrambler_types`), `n_index`, `plain`, `key`, `n_shots`, `folded_oracle`
+    and (optionally) `phase_synthesis`, `adaptive_shots` (a dict of `adaptive.AdaptiveShots` arguments),
+    `entropy_threshold`, `verify_top_k` and the `partial_settings` (arguments of `partial.Partial`). If the key is unknown, give the `cipher` instead and set `key` to None.
+    Unless a backend is given, it is chosen by `BackendSelector` from the `SUSD_*` environment variables, and
+    the optional `stage_depth` (the depth of the deepest stage circuit, e.g. from dryrun.py) bounds the memory of an MPS simulation."""
+    if backend is None:
+        backend = selector.BackendSelector().select(settings['n_index'], settings['folded_oracle'], settings.get('stage_depth'))
+    enc = scrambler.scrambler_types[settings['scrambler']]()
+    n_index = settings['n_index']
+    key = settings.get('key')
+    cipher = settings.get('cipher')
+    if cipher is None:
+        cipher = enc.scramble(n_index, settings['plain'], key)
+    partial_search = get_partial_search(settings)
+    adaptive_shots = None
+    if settings.get('adaptive_shots') is not None:
+        adaptive_shots = adaptive.AdaptiveShots(partial_search=partial_search, **settings['adaptive_shots'])
+    runner = SearchRunner(
+        backend,
+        enc,
+        n_index,
+        settings['plain'],
+        cipher,
+        n_shots=settings['n_shots'],
+        folded_oracle=settings['folded_oracle'],
+        key=key,
+        phase_synthesis=settings.get('phase_synthesis', 'ancilla'),
+        verbose=verbose,
+        shared_gates=shared_gates,
+        adaptive_shots=adaptive_shots,
+        entropy_threshold=settings.get('entropy_threshold'),
+        verify_top_k=settings.get('verify_top_k'),
+        partial_search=partial_search
+    )
+    return runner
+
+
+def get_repeat_checkpoints(settings: dict, n_repeats: int, checkpoint_dir=None, resume: bool = False) -> list:
+    """Returns a checkpoint for each repeat, in the directory `checkpoint_dir` (or None for each repeat if it is None)"""
+    return get_checkpoints([settings] * n_repeats, checkpoint_dir, resume, prefix='repeat-')
+
+
+def get_checkpoints(settings_list: list, checkpoint_dir=None, resume: bool = False, prefix: str = 'repeat-') -> list:
+    """Returns a checkpoint for each settings dict, named `prefix` followed by its index, in the directory
+    `checkpoint_dir` (or None for each one if it is None)"""
+    if checkpoint_dir is None:
+        return [None] * len(settings_list)
+    checkpoint_dir = pathlib.Path(checkpoint_dir)
+    return [
+        checkpoint.Checkpoint(checkpoint_dir / (prefix + str(i).zfill(5) + '.json'), settings, resume=resume)
+        for i, settings in enumerate(settings_list)
+    ]
+
+
+def run_repeats(
+        settings: dict,
+        n_repeats: int,
+        n_workers: int = 1,
+        seed: int = None,
+        checkpoint_dir=None,
+        resume: bool = False
+) -> list:
+    """Runs independent repeats of the search, spread over a pool of `n_workers` processes.
+    Each worker creates its own backend and runner, and each repeat gets a deterministic seed
+    derived from `seed`. Results are returned in repeat order.
+
+    :param settings: Search settings (see `create_runner`)
+    :param n_repeats: Number of repeats
+    :param n_workers: Number of worker processes (1 runs the repeats serially in this process)
+    :param seed: Base seed for the repeats
+    :param checkpoint_dir: If given, each repeat saves its state to a checkpoint file in this directory after every stage
+    :param resume: If True, repeats with a checkpoint file are resumed after their last finished stage
+        (finished repeats are not run again)
+    """
+    seeds = get_repeat_seeds(seed, n_repeats)
+    checkpoints = get_repeat_checkpoints(settings, n_repeats, checkpoint_dir, resume)
+    if n_workers <= 1:
+        runner = create_runner(settings)
+        try:
+            return [runner.run(seed=s, checkpoint_file=c) for s, c in zip(seeds, checkpoints)]
+        finally:
+            runner.backend.close()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(settings,)
+    ) as executor:
+        # map() returns the results in the order of the seeds
+        return list(executor.map(_run_worker_repeat, zip(seeds, checkpoints)))
@@ -1,13 +1,35 @@
+import importlib
 import os
+import sys
+import threading
+import numpy
 import qiskit
-import qiskit_ibm_runtime
 import qiskit.result
+import qiskit.primitives
 import qiskit.providers.basic_provider
-import collections
+import distribution
+import transpilecache
+import instrument
+import resources
 from abc import ABC, abstractmethod
 
 class Backend:
-    def run(self, circuit, shots=None):
+    # Name of the backend type, as selected by SUSD_BACKEND
+    name = None
+    # True if run() only returns once the circuit has been simulated, so that the job is already done
+    synchronous = False
+
+    def run(self, circuit, shots=None, parameter_values=None, seed=None):
+        """Submits a circuit and returns the job. The shots and the seed only apply to this job, so that
+        concurrent searches (see campaign.py) can share the backend.
+
+        :param shots: Number of shots (defaults to the backend's `shots`)
+        :param parameter_values: Optional dict of values for the parameters of the circuit
+        :param seed: Seed for sampling the shots of this job, where supported (None for non-deterministic sampling)
+        """
+        pass
+
+    def run_many(self, circuits, shots=None, parameter_values=None, seed=None):
         pass
 
     def get_normalized_distrib_from_result(
@@ -15,65 +37,211 @@ class Backend:
             n_index: int,
             circuit: qiskit.circuit.QuantumCircuit,
             result
-    ) -> qiskit.result.QuasiDistribution:
+    ) -> distribution.Distribution:
+        pass
+
+    def get_normalized_distribs_from_result(self, n_index: int, circuits: list, result) -> list:
+        pass
+
+    def close(self) -> None:
         pass
 
 class LocalQiskitBackend(Backend):
+    name = 'local_qiskit'
+    # BasicSimulator.run() simulates the circuit before it returns the job
+    synchronous = True
     device = None
     shots = None
+    transpile_cache = None
+    exact = False
     _backend = None
-    def __init__(self, device, shots=None):
+    def __init__(self, device, shots=None, transpile_cache_size=32, exact=False):
         self.device = device
         self.shots = shots
+        # In exact mode, circuits are evaluated as statevectors and no shots are sampled
+        self.exact = exact
+        # Stage circuits are often resubmitted unchanged (e.g. stage 1 of every repeat)
+        self.transpile_cache = transpilecache.TranspileCache(transpile_cache_size)
+        # BasicSimulator keeps the state of the running simulation on the instance, so concurrent
+        # searches (see campaign.py) must not run circuits on it at the same time
+        self._run_lock = threading.Lock()
         # BasicAer is obsolete in Qiskit 1.0.x
         #self._backend = qiskit.BasicAer.get_backend(self.device)
         self._backend = qiskit.providers.basic_provider.BasicProvider().get_backend(self.device)
 
-    def run(self, circuit, shots=None):
-        if shots is not None:
-            self.shots = shots
+    def run(self, circuit, shots=None, parameter_values=None, seed=None):
+        if self.exact:
+            # The reference Sampler returns exact probabilities when no shots are given
+            if parameter_values is not None:
+                values = [parameter_values[p] for p in circuit.parameters]
+                return self._new_exact_sampler().run(circuit, [values])
+            return self._new_exact_sampler().run(circuit)
         # Returns a Qiskit job object - formally 'Any'
         #return qiskit.execute(circuit, self._backend, shots=self.shots)
-        new_circuit = qiskit.transpile(circuit, self._backend)
-        job = self._backend.run(new_circuit, shots=self.shots)
+        new_circuit = self.transpile(circuit, parameter_values)
+        return self.run_transpiled(new_circuit, shots, seed)
+
+    def transpile(self, circuit, parameter_values=None) -> qiskit.circuit.QuantumCircuit:
+        """Returns the circuit transpiled for the simulator (through the transpile cache),
+        with the given parameter values bound to it"""
+        tracer = instrument.get_tracer()
+        with tracer.span('transpile') as span:
+            hits = self.transpile_cache.hits
+            new_circuit = self.transpile_cache.transpile(circuit, self._backend)
+            if parameter_values is not None:
+                # Bind after transpiling, so that a parameterized circuit is only transpiled once
+                new_circuit = new_circuit.assign_parameters(parameter_values)
+                # Keep the original name, which is used to look up the counts in the result
+                new_circuit.name = circuit.name
+            if tracer.enabled:
+                span['cache_hit'] = self.transpile_cache.hits > hits
+                span['depth'] = new_circuit.depth()
+                span['size'] = new_circuit.size()
+                span['gate_counts'] = dict(new_circuit.count_ops())
+        return new_circuit
+
+    def run_transpiled(self, new_circuit, shots=None, seed=None):
+        """Runs a circuit returned by `transpile()` on the simulator
+
+        :param shots: Number of shots (defaults to the backend's `shots`)
+        :param seed: Simulator seed for this job (None for non-deterministic sampling)
+        """
+        with self._run_lock:
+            job = self._backend.run(new_circuit, **self._get_run_options(shots, seed))
         return job
 
+    def _new_exact_sampler(self):
+        # The Sampler primitives keep every circuit they have run, keyed without the definitions of
+        # custom gates, so the stage circuits for different oracles would collide: use one Sampler per job.
+        # The reference Sampler returns exact probabilities when no shots are given
+        return qiskit.primitives.Sampler()
+
+    def _get_run_options(self, shots=None, seed=None) -> dict:
+        # Options of a single job: the backend is shared by concurrent searches, so nothing is stored on it
+        options = {'shots': self.shots if shots is None else shots}
+        if seed is not None:
+            options['seed_simulator'] = seed
+        return options
+
+    def run_many(self, circuits, shots=None, parameter_values=None, seed=None):
+        """Runs several independent circuits as a single job (see `IBMCloudBackend.run_many`)"""
+        if self.exact:
+            if parameter_values is not None:
+                values = [[bindings[p] for p in c.parameters] for c, bindings in zip(circuits, parameter_values)]
+                return self._new_exact_sampler().run(circuits, values)
+            return self._new_exact_sampler().run(circuits)
+        new_circuits = []
+        for i, circuit in enumerate(circuits):
+            new_circuit = self.transpile_cache.transpile(circuit, self._backend)
+            if parameter_values is not None:
+                new_circuit = new_circuit.assign_parameters(parameter_values[i])
+            new_circuits.append(new_circuit)
+        with self._run_lock:
+            return self._backend.run(new_circuits, **self._get_run_options(shots, seed))
+
     def get_normalized_distrib_from_result(
             self,
             n_index: int,
             circuit: qiskit.circuit.QuantumCircuit,
             result
-    ) -> qiskit.result.QuasiDistribution:
+    ) -> distribution.Distribution:
+        if self.exact:
+            return distribution.from_dict(result.quasi_dists[0], exact=True)
         # Works for local Aer simulation
         counts = result.get_counts(circuit)
-        # Analyse and convert the count
-        parsed_count = dict()
-        for bits, count in counts.items():
-            mask = 0b1
-            q_reg = 0b0
-            bits = bits[::-1] # Reverses the string with a slice operation
-            for i in range(2*n_index+1):
-                if bits[i]=='1':
-                    q_reg |= mask
-                mask <<= 1
-            parsed_count[q_reg] = float(count)/float(self.shots)
-        quasi_distrib = qiskit.result.QuasiDistribution(parsed_count, shots=self.shots)
-        return quasi_distrib
+        # Decode the bit strings (of width 2*n_index+1, or n_index+1 for a constant-folded oracle) into arrays.
+        # The shots of the job are the total of its counts.
+        return distribution.from_counts(counts, sum(counts.values()))
+
+    def get_normalized_distribs_from_result(self, n_index: int, circuits: list, result) -> list:
+        """Returns one distribution per circuit from the result of `run_many()`"""
+        if self.exact:
+            return [distribution.from_dict(quasi_distrib, exact=True) for quasi_distrib in result.quasi_dists]
+        # Counts are looked up by experiment index, since circuits from the same template share a name
+        return [self.get_normalized_distrib_from_result(n_index, i, result) for i in range(len(circuits))]
 
 
 
 
+class AerBackend(LocalQiskitBackend):
+    """Runs circuits on the (multithreaded) Qiskit Aer simulator.
+    Transpiling, binding and decoding work in the same way as for `LocalQiskitBackend`."""
+    name = 'local_aer'
+    # AerSimulator.run() returns as soon as the job is queued on Aer's executor
+    synchronous = False
+    methods = ['automatic', 'statevector', 'matrix_product_state']
+    method = None
+    def __init__(
+            self,
+            device,
+            shots=None,
+            method='automatic',
+            max_parallel_threads=0,
+            fusion_enable=True,
+            shot_branching_enable=False,
+            transpile_cache_size=32,
+            exact=False,
+            mps_max_bond=None
+    ):
+        """
+        :param method: Aer simulation method, one of `AerBackend.methods`
+        :param max_parallel_threads: Maximum number of threads (0 uses all of the available cores)
+        :param fusion_enable: Enables gate fusion
+        :param shot_branching_enable: Enables shot branching (shares the simulation between shots where possible)
+        :param mps_max_bond: Maximum bond dimension for the 'matrix_product_state' method (None for no truncation)
+        """
+        assert method in self.methods, "Unknown Aer simulation method: " + method
+        self.device = device
+        self.shots = shots
+        self.method = method
+        self.exact = exact
+        backend_options = {
+            'method': method,
+            'max_parallel_threads': max_parallel_threads,
+            'fusion_enable': fusion_enable,
+            'shot_branching_enable': shot_branching_enable
+        }
+        if mps_max_bond is not None:
+            backend_options['matrix_product_state_max_bond_dimension'] = mps_max_bond
+        self._backend_options = backend_options
+        self.transpile_cache = transpilecache.TranspileCache(transpile_cache_size)
+        self._run_lock = threading.Lock()
+        # Aer is only imported when this backend is selected
+        import qiskit_aer
+        self._backend = qiskit_aer.AerSimulator(**backend_options)
+
+    def _new_exact_sampler(self):
+        import qiskit_aer.primitives
+        # With no shots, the Aer Sampler returns the exact probabilities
+        return qiskit_aer.primitives.Sampler(backend_options=self._backend_options, run_options={'shots': None})
+
+
 class IBMCloudBackend(Backend):
+    name = 'ibm_cloud'
     device = None
     shots = None
     _ibm_svc_instance = None
     _ibm_svc_token = None
     _ibm_service = None
+    _runtime = None
     _backend = None
     _primitive = None
-    def __init__(self, device, shots=None):
+    def __init__(self, device, shots=None, service=None):
         self.device = device
         self.shots = shots
+        # Sessions (and their Sampler primitives) are opened once per device and reused for every job
+        self._sessions = dict()
+        self._samplers = dict()
+        if service is not None:
+            import localruntime
+            assert isinstance(service, localruntime.LocalRuntimeService), "Unknown IBM service stand-in"
+            # Offline stand-in for the IBM Cloud service
+            self._runtime = localruntime
+            self._ibm_service = service
+            return
+        # The IBM runtime is only imported when this backend is selected (it is slow to import)
+        import qiskit_ibm_runtime
+        self._runtime = qiskit_ibm_runtime
         assert (('SUSD_IBM_SVC_INSTANCE' in os.environ) and ('SUSD_IBM_SVC_TOKEN' in os.environ)),\
             "No IBM service credentials provided"
         self._ibm_svc_instance = os.environ['SUSD_IBM_SVC_INSTANCE']
@@ -84,45 +252,336 @@ class IBMCloudBackend(Backend):
             token=self._ibm_svc_token
         )
 
-    def run(self, circuit, shots=None):
-        session = qiskit_ibm_runtime.Session(self._ibm_service, backend="ibmq_qasm_simulator")
-        self._primitive = qiskit_ibm_runtime.Sampler(session=session)
-        return self._primitive.run(circuit, shots=shots)
+    def _get_primitive(self):
+        """Returns the Sampler primitive for the selected device, opening a session on first use"""
+        if self.device not in self._samplers:
+            session = self._runtime.Session(self._ibm_service, backend=self.device)
+            self._sessions[self.device] = session
+            self._samplers[self.device] = self._runtime.Sampler(session=session)
+        self._primitive = self._samplers[self.device]
+        return self._primitive
+
+    def close(self) -> None:
+        """Closes all of the sessions opened by this backend"""
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+        self._samplers.clear()
+        self._primitive = None
+
+    def run(self, circuit, shots=None, parameter_values=None, seed=None):
+        if parameter_values is not None:
+            return self.run_many([circuit], shots=shots, parameter_values=[parameter_values], seed=seed)
+        return self.run_many([circuit], shots=shots, seed=seed)
+
+    def run_many(self, circuits, shots=None, parameter_values=None, seed=None):
+        """Submits several independent circuits in a single primitive call.
+        The result holds one quasi-distribution per circuit, in the same order.
+
+        :param circuits: List of circuits
+        :param shots: Number of shots for each circuit
+        :param parameter_values: Optional list with one dict of parameter values per circuit
+        :param seed: Ignored, the shots of a device are not seeded
+        """
+        if shots is None:
+            shots = self.shots
+        primitive = self._get_primitive()
+        if parameter_values is not None:
+            # The Sampler primitive takes values in the order of circuit.parameters
+            values = [
+                [bindings[p] for p in circuit.parameters] for circuit, bindings in zip(circuits, parameter_values)
+            ]
+            return primitive.run(circuits, parameter_values=values, shots=shots)
+        return primitive.run(circuits, shots=shots)
 
     def get_normalized_distrib_from_result(
             self,
             n_index: int,
             circuit: qiskit.circuit.QuantumCircuit,
             result
-    ) -> qiskit.result.QuasiDistribution:
+    ) -> distribution.Distribution:
         # Works with Sampler() primitive (remote IBM backend service)
         quasi_distrib = result.quasi_dists[0]
-        return quasi_distrib
+        return distribution.from_dict(quasi_distrib, shots=self._get_result_shots(result, 0))
+
+    def get_normalized_distribs_from_result(self, n_index: int, circuits: list, result) -> list:
+        """Returns one distribution per circuit from the result of `run_many()`"""
+        return [
+            distribution.from_dict(quasi_distrib, shots=self._get_result_shots(result, i))
+            for i, quasi_distrib in enumerate(result.quasi_dists)
+        ]
+
+    def _get_result_shots(self, result, i: int) -> int:
+        # The shots of each circuit are reported in the metadata of the result
+        return result.metadata[i].get('shots', self.shots)
+
 
 
+class ReducedBackend(Backend):
+    """Runs each stage on the NumPy engine in `reduced` instead of simulating a circuit.
+    The engine must be prepared for a given scrambler and plaintext/ciphertext pair
+    before calling `run_stage()`."""
+    name = 'reduced'
+    device = None
+    shots = None
+    exact = False
+    engine = None
+    def __init__(self, device, shots=None, exact=False):
+        self.device = device
+        self.shots = shots
+        # In exact mode, the outcome probabilities are returned without sampling any shots
+        self.exact = exact
+
+    def prepare(self, enc, n_index: int, plain: int, cipher: int, seed: int = None):
+        import reduced
+        self.engine = reduced.ReducedEngine(enc, n_index, plain, cipher, seed=seed)
+
+    def run(self, circuit, shots=None, parameter_values=None, seed=None):
+        raise NotImplementedError("ReducedBackend does not run circuits, use run_stage() instead")
+
+    def run_stage(self, modelled_state: list, lamb: float, flag_bits: list, shots=None, seed=None):
+        """Returns the distribution of x register outcomes for one stage of the search
+
+        :param shots: Number of shots (defaults to the backend's `shots`)
+        :param seed: Seed for sampling the shots of this stage (None uses the engine's generator)
+        """
+        assert self.engine is not None, "ReducedBackend.prepare() must be called before run_stage()"
+        if shots is None:
+            shots = self.shots
+        psi = self.engine.run_stage(modelled_state, lamb, flag_bits)
+        probs = self.engine.get_probabilities(psi)
+        if self.exact:
+            outcomes = numpy.flatnonzero(probs)
+            return distribution.Distribution(outcomes, probs[outcomes], exact=True)
+        rng = None if seed is None else numpy.random.default_rng(seed)
+        outcomes, weights = self.engine.sample_distrib(probs, shots, rng=rng)
+        return distribution.Distribution(outcomes, weights, shots)
+
+    def get_normalized_distrib_from_result(
+            self,
+            n_index: int,
+            circuit: qiskit.circuit.QuantumCircuit,
+            result
+    ) -> distribution.Distribution:
+        # The result from run_stage() is already a distribution over the register values
+        return result
+
+
+
+def _get_bool_env(name: str, default: bool) -> bool:
+    if name not in os.environ:
+        return default
+    return os.environ[name].lower() in ['1', 'true', 'yes']
+
+
+
+def _create_local_qiskit(selector) -> LocalQiskitBackend:
+    return LocalQiskitBackend(selector.selected_device, selector.shots, exact=selector.exact)
+
+
+def _create_local_aer(selector) -> AerBackend:
+    if selector.selected_device == 'basic_simulator':
+        selector.selected_device = 'aer_simulator'
+    return AerBackend(
+        selector.selected_device,
+        selector.shots,
+        method=selector.aer_method,
+        max_parallel_threads=int(os.environ.get('SUSD_AER_THREADS', '0')),
+        fusion_enable=_get_bool_env('SUSD_AER_FUSION', True),
+        shot_branching_enable=_get_bool_env('SUSD_AER_SHOT_BRANCHING', False),
+        exact=selector.exact,
+        mps_max_bond=selector.mps_max_bond
+    )
+
+
+def _create_ibm_cloud(selector) -> IBMCloudBackend:
+    assert not selector.exact, "Exact mode is not available on the IBM Cloud backend"
+    # Default to 'ibmq_qasm_simulator' device
+    if selector.selected_device == 'basic_simulator':
+        selector.selected_device = 'ibmq_qasm_simulator'
+    if os.environ.get('SUSD_IBM_SERVICE') == 'local':
+        import localruntime
+        # Run the IBM Cloud code path offline, against the local stand-in service
+        return IBMCloudBackend(selector.selected_device, selector.shots, service=localruntime.LocalRuntimeService())
+    return IBMCloudBackend(selector.selected_device, selector.shots)
+
+
+def _create_reduced(selector) -> ReducedBackend:
+    return ReducedBackend(selector.selected_device, selector.shots, exact=selector.exact)
+
+
+# Backend plugins by name. Each entry is a function that takes the BackendSelector and returns a backend,
+# or a 'module:function' string, in which case the module is only imported when that backend is selected.
+# The built-in backends import their simulator or runtime packages (e.g. qiskit_aer) on creation.
+backend_factories = {
+    'local_qiskit': _create_local_qiskit,
+    'local_aer': _create_local_aer,
+    'ibm_cloud': _create_ibm_cloud,
+    'reduced': _create_reduced
+}
+
+
+def register_backend(name: str, factory) -> None:
+    """Registers a backend plugin under the given name, so that it can be selected with SUSD_BACKEND
+
+    :param name: Backend name
+    :param factory: Function that takes the `BackendSelector` and returns a `Backend`, or a
+        'module:function' string for a function that is imported on first use
+    """
+    backend_factories[name] = factory
+
+
+def get_backend_factory(name: str):
+    """Returns the factory function for the named backend, importing its module if necessary"""
+    factory = backend_factories[name]
+    if isinstance(factory, str):
+        module_name, function_name = factory.split(':')
+        factory = getattr(importlib.import_module(module_name), function_name)
+        backend_factories[name] = factory
+    return factory
+
 
 class BackendSelector:
-    _available_backends = ['local_qiskit', 'ibm_cloud']
     selected_backend = 'local_qiskit'
     selected_device = 'basic_simulator'
     shots = 1024
+    exact = False
+    aer_method = 'automatic'
+    mps_max_bond = None
+    # Reason for the choice of backend, set by select()
+    reason = None
+
+    def __init__(self, backend_name: str = None):
+        """
+        :param backend_name: Backend to select (a key of `backend_factories`, or "auto"), instead of SUSD_BACKEND
+        """
+        assert (backend_name is None) or (backend_name in backend_factories) or (backend_name == 'auto'), \
+            "Unknown backend: " + str(backend_name)
+        self.backend_name = backend_name
+
+    def get_backend_name(self) -> str:
+        """Returns the backend name given to the constructor, or else SUSD_BACKEND (None if neither is set)"""
+        return self.backend_name if self.backend_name is not None else os.environ.get('SUSD_BACKEND')
 
-    def select(self):
+    def select(self, n_index: int = None, folded_oracle: bool = False, depth: int = None):
+        """Returns the backend selected by the SUSD_* environment variables. With SUSD_BACKEND="auto",
+        the backend is chosen to fit the stage circuits for the given n_index in the memory budget.
+
+        :param n_index: Scaling factor for the circuit (needed for "auto" and for the memory check)
+        :param folded_oracle: If True, the stage circuits use the constant-folded oracle
+        :param depth: Depth of the deepest (transpiled) stage circuit, if known, which bounds the memory
+            of an MPS simulation (see `resources.estimate_memory`)
+        """
         # List of available BasicAer backends (simulations)
         # print(qiskit.BasicAer.backends())
 
-        if 'SUSD_BACKEND' in os.environ:
-            susd_backend = os.environ['SUSD_BACKEND']
-            if susd_backend in self._available_backends:
+        susd_backend = self.get_backend_name()
+        if susd_backend is not None:
+            if (susd_backend in backend_factories) or (susd_backend == 'auto'):
                 self.selected_backend = susd_backend
         if 'SUSD_DEVICE' in os.environ:
             self.selected_device = os.environ['SUSD_DEVICE']
+        # Exact probabilities (no shot sampling) are only available on local simulators
+        self.exact = _get_bool_env('SUSD_EXACT', self.exact)
+
+        aer_method = os.environ.get('SUSD_AER_METHOD', 'automatic')
+        mps_max_bond = self.get_mps_max_bond()
+        if self.selected_backend == 'auto':
+            assert n_index is not None, "n_index is needed to select a backend automatically"
+            aer_method = self.select_auto(n_index, folded_oracle, mps_max_bond, depth)
+        elif n_index is not None:
+            self.check_memory(n_index, folded_oracle, aer_method, mps_max_bond, depth)
+        if self.reason is not None:
+            print('Backend ' + self.selected_backend + ': ' + self.reason, file=sys.stderr)
+            instrument.get_tracer().event('backend_selection', backend=self.selected_backend, reason=self.reason)
+
+        self.aer_method = aer_method
+        self.mps_max_bond = mps_max_bond
+        return get_backend_factory(self.selected_backend)(self)
+
+    def get_memory_budget(self) -> int:
+        """Returns the memory budget in bytes, from SUSD_MEMORY_BUDGET (e.g. "8G"), or 80% of the
+        available physical memory by default (None if that is unknown)"""
+        if 'SUSD_MEMORY_BUDGET' in os.environ:
+            return resources.parse_memory(os.environ['SUSD_MEMORY_BUDGET'])
+        available = resources.get_available_memory()
+        return None if available is None else int(0.8*available)
+
+    def get_aer_method(self) -> str:
+        """Returns the Aer simulation method that the environment selects: 'matrix_product_state' with
+        the "auto" backend (the only method that `select_auto` uses on Aer), otherwise SUSD_AER_METHOD"""
+        if self.get_backend_name() == 'auto':
+            return 'matrix_product_state'
+        return os.environ.get('SUSD_AER_METHOD', 'automatic')
+
+    def get_mps_max_bond(self) -> int:
+        """Returns the maximum MPS bond dimension from SUSD_AER_MPS_MAX_BOND, or None for no truncation"""
+        return int(os.environ['SUSD_AER_MPS_MAX_BOND']) if 'SUSD_AER_MPS_MAX_BOND' in os.environ else None
+
+    def get_memory_method(self, backend_name: str, aer_method: str = 'automatic') -> str:
+        """Returns the simulation method of the named backend for the memory estimates (see `resources.estimate_memory`),
+        or None for a remote backend. Aer is estimated as a statevector simulation, unless it uses MPS.
+
+        :param backend_name: Backend name, e.g. a key of `resources.backend_methods`
+        :param aer_method: Aer simulation method (see `AerBackend.methods`)
+        """
+        if (backend_name == 'local_aer') and (aer_method == 'matrix_product_state'):
+            return 'matrix_product_state'
+        return resources.backend_methods.get(backend_name, 'statevector')
+
+    def select_auto(self, n_index: int, folded_oracle: bool = False, mps_max_bond: int = None, depth: int = None) -> str:
+        """Selects the first backend whose estimated memory fits the budget, in the order: statevector on
+        the local simulator, MPS on Aer, the reduced NumPy engine and finally IBM Cloud. Sets `selected_backend`
+        and `reason`, and returns the Aer simulation method.
 
-        if self.selected_backend == 'local_qiskit':
-            return LocalQiskitBackend(self.selected_device, self.shots)
+        :param mps_max_bond: Maximum bond dimension of an MPS simulation (None for no truncation)
+        :param depth: Depth of the deepest stage circuit, if known (see `select`)
+        """
+        budget = self.get_memory_budget()
+        n_qubits = resources.get_stage_qubits(n_index, folded_oracle)
+        candidates = [
+            ('local_qiskit', 'statevector'),
+            ('local_aer', 'matrix_product_state'),
+            ('reduced', 'reduced')
+        ]
+        for backend_name, method in candidates:
+            if (backend_name == 'local_aer') and self.exact:
+                # The exact mode of the Aer Sampler computes a statevector, whatever the method
+                continue
+            estimate = resources.estimate_memory(method, n_index, folded_oracle, depth=depth, max_bond=mps_max_bond)
+            if (budget is None) or (estimate <= budget):
+                # The reduced engine only simulates the x register
+                simulated_qubits = n_index if method == 'reduced' else n_qubits
+                self.selected_backend = backend_name
+                self.reason = (method + ' needs about ' + resources.format_memory(estimate) + ' for ' +
+                               str(simulated_qubits) + ' qubits, within the budget of ' +
+                               ('(unknown)' if budget is None else resources.format_memory(budget)))
+                if (method == 'matrix_product_state') and (mps_max_bond is not None):
+                    # The cap only changes the result if the bond dimension could grow beyond it
+                    if resources.estimate_memory(method, n_index, folded_oracle, depth=depth) > estimate:
+                        self.reason += (', with the bond dimension truncated to ' + str(mps_max_bond) +
+                                        ', so the simulation is approximate')
+                return method
+        remote_configured = ((os.environ.get('SUSD_IBM_SERVICE') == 'local') or
+                             (('SUSD_IBM_SVC_INSTANCE' in os.environ) and ('SUSD_IBM_SVC_TOKEN' in os.environ)))
+        if self.exact or not remote_configured:
+            raise MemoryError('No local backend fits the memory budget of ' + resources.format_memory(budget) +
+                              ' for n_index = ' + str(n_index) +
+                              (', and exact mode needs a local backend' if self.exact else ', and IBM Cloud is not configured'))
+        self.selected_backend = 'ibm_cloud'
+        self.reason = ('no local simulation of ' + str(n_qubits) + ' qubits fits the budget of ' +
+                       resources.format_memory(budget) + ', running remotely')
+        return 'automatic'
 
-        if self.selected_backend == 'ibm_cloud':
-            # Default to 'ibmq_qasm_simulator' device
-            if self.selected_device == 'basic_simulator':
-                self.selected_device = 'ibmq_qasm_simulator'
-            return IBMCloudBackend(self.selected_device, self.shots)
+    def check_memory(self, n_index: int, folded_oracle: bool = False, aer_method: str = 'automatic',
+                     mps_max_bond: int = None, depth: int = None) -> None:
+        """Sets `reason` to a warning if the explicitly selected local backend is expected to exceed the memory budget"""
+        method = self.get_memory_method(self.selected_backend, aer_method)
+        if method is None:
+            return
+        budget = self.get_memory_budget()
+        estimate = resources.estimate_memory(method, n_index, folded_oracle, depth=depth, max_bond=mps_max_bond)
+        if (budget is not None) and (estimate > budget):
+            self.reason = ('WARNING: ' + method + ' is expected to need about ' + resources.format_memory(estimate) +
+                           ', which exceeds the memory budget of ' + resources.format_memory(budget) +
+                           ' (set SUSD_BACKEND="auto" to choose a backend that fits)')
@@ -0,0 +1,161 @@
+import qiskit.circuit
+import partial
+import groverlong
+import gatelibrary
+
+
+class SharedStageGates():
+    """Parameterized gates that only depend on n_index (and the phase synthesis strategy), not on the oracle.
+
+    The rotation, diffusion and oracle kickback gates are built once and shared by the stage templates
+    of every (plain, cipher) pair with the same n_index, e.g. when streaming a batch of targets.
+    """
+
+    def __init__(self, n_index: int, phase_synthesis: str = 'ancilla'):
+        """
+        :param n_index: Scaling factor for the circuit
+        :param phase_synthesis: Synthesis strategy for the multi-controlled phases (see `groverlong.phase_synthesis_strategies`)
+        """
+        self.n_index = n_index
+        self.phase_synthesis = phase_synthesis
+        self.betas = qiskit.circuit.ParameterVector('beta', n_index)
+        self.phase = qiskit.circuit.Parameter('phase')
+        self.grover = groverlong.GroverLong(phase_synthesis)
+        # The gates are taken from the gate library (see gatelibrary.py), which may load them from disk
+        self.library = gatelibrary.get_gate_library()
+        self.parameters = list(self.betas) + [self.phase]
+        self.rotate_circbox = self.library.get(
+            ('rotate', n_index),
+            lambda: partial.Partial().get_parameterized_rotate_circbox(n_index, self.betas),
+            self.parameters
+        )
+        self.diffusion_circbox = self.library.get(
+            ('diffusion', n_index, phase_synthesis),
+            lambda: self.grover.get_diffusion_circbox(n_index, self.phase, self.rotate_circbox, self.rotate_circbox),
+            self.parameters
+        )
+        self._kickback_circboxes = dict()
+
+    def get_kickback_circbox(self, flag_bits: list) -> qiskit.circuit.Gate:
+        """Returns the parameterized oracle kickback gate for the given flag bits, building it on first use"""
+        key = tuple(flag_bits)
+        if key not in self._kickback_circboxes:
+            self._kickback_circboxes[key] = self.library.get(
+                ('kickback', self.n_index, key, self.phase_synthesis),
+                lambda: self.grover.get_oracle_kickback_circbox(self.n_index, flag_bits, self.phase),
+                self.parameters
+            )
+        return self._kickback_circboxes[key]
+
+
+class StageTemplate():
+    """Parameterized circuit for one stage of the partial search.
+
+    The circuit is built once for a given (n_index, stage, g_l), with `qiskit.circuit.Parameter` objects
+    for the rotation angles (beta_1, ..., beta_n) and the Grover-Long phase. Each new modelled state
+    then only needs a set of parameter values (see `get_parameter_values()`), which are passed to
+    `Backend.run()` as `parameter_values` so that the template is transpiled only once.
+    """
+
+    def __init__(
+            self,
+            n_index: int,
+            gl: int,
+            flag_bits: list,
+            flag_circbox: qiskit.circuit.Gate,
+            inv_flag_circbox: qiskit.circuit.Gate,
+            folded: bool = False,
+            phase_synthesis: str = 'ancilla',
+            shared_gates: SharedStageGates = None
+    ):
+        """
+        :param n_index: Scaling factor for the circuit
+        :param gl: Number of Grover-Long iterations in this stage
+        :param flag_bits: Qubit indices of the flag bits that are tested by the oracle (see `GroverLong.add_groverlong_iterations`)
+        :param flag_circbox: Keyscan gate
+        :param inv_flag_circbox: Inverse keyscan gate
+        :param folded: If True, the keyscan gates are constant-folded and the circuit has `n_index+1` qubits
+        :param phase_synthesis: Synthesis strategy for the multi-controlled phases (see `groverlong.phase_synthesis_strategies`)
+        :param shared_gates: Gates shared with other templates of the same n_index, or None to build them here
+        """
+        if shared_gates is None:
+            shared_gates = SharedStageGates(n_index, phase_synthesis)
+        self.n_index = n_index
+        self.gl = gl
+        self.betas = shared_gates.betas
+        self.phase = shared_gates.phase
+        grover = shared_gates.grover
+
+        if folded:
+            circ = qiskit.circuit.QuantumCircuit(n_index+1)
+        else:
+            circ = qiskit.circuit.QuantumCircuit(2*n_index+1)
+        rotate_circbox = shared_gates.rotate_circbox
+        circ.append(rotate_circbox, list(range(0, n_index)))
+        grover.add_groverlong_iterations(
+            circ,
+            n_index,
+            gl,
+            self.phase,
+            flag_bits,
+            flag_circbox,
+            inv_flag_circbox,
+            rotate_circbox,
+            rotate_circbox,
+            folded=folded,
+            kickback_circbox=shared_gates.get_kickback_circbox(flag_bits),
+            diffusion_circbox=shared_gates.diffusion_circbox
+        )
+        circ.measure_all()
+        self.circuit = circ
+
+    def get_parameter_values(self, betas: list, phase: float) -> dict:
+        """Returns the mapping from template parameters to the given values
+
+        :param betas: Rotation angles [beta_1, ..., beta_n] in units of radians (see `Partial.get_beta_angles`)
+        :param phase: Grover-Long phase in units of radians
+        """
+        parameter_values = dict(zip(self.betas, betas))
+        parameter_values[self.phase] = phase
+        return parameter_values
+
+
+class StageTemplateLibrary():
+    """Holds the stage templates for a single keyscan oracle, keyed by (stage, g_l)"""
+
+    def __init__(
+            self,
+            n_index: int,
+            flag_circbox: qiskit.circuit.Gate,
+            inv_flag_circbox: qiskit.circuit.Gate,
+            folded: bool = False,
+            phase_synthesis: str = 'ancilla',
+            shared_gates: SharedStageGates = None
+    ):
+        if shared_gates is None:
+            shared_gates = SharedStageGates(n_index, phase_synthesis)
+        assert shared_gates.n_index == n_index, "Shared gates were built for a different n_index"
+        assert shared_gates.phase_synthesis == phase_synthesis, "Shared gates use a different phase synthesis"
+        self.n_index = n_index
+        self.flag_circbox = flag_circbox
+        self.inv_flag_circbox = inv_flag_circbox
+        self.folded = folded
+        self.phase_synthesis = phase_synthesis
+        self.shared_gates = shared_gates
+        self._templates = dict()
+
+    def get_template(self, stage: int, gl: int, flag_bits: list) -> StageTemplate:
+        """Returns the template for the given stage and iteration count, building it on first use"""
+        key = (stage, gl)
+        if key not in self._templates:
+            self._templates[key] = StageTemplate(
+                self.n_index,
+                gl,
+                flag_bits,
+                self.flag_circbox,
+                self.inv_flag_circbox,
+                folded=self.folded,
+                phase_synthesis=self.phase_synthesis,
+                shared_gates=self.shared_gates
+            )
+        return self._templates[key]
@@ -0,0 +1,245 @@
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+import sys
+
+import numpy
+import atomicfile
+import scrambler
+import search
+
+# Parameter sweeps over a grid of search settings (n_index, shots, scrambler and the model of the partial
+# search: empirical_factor, min_weight, lambda_schedule and max_lambda, see `partial.Partial`). The cells
+# of the grid run in worker processes, and each finished cell is memoized on disk, keyed by a hash of its
+# settings, repeats, seed, backend configuration and the version of the code. Re-running a sweep (or a
+# larger sweep that contains it) only computes the missing cells. For example:
+#
+#   python3 sweep.py --n-index 4 6 8 --n-shots 50 100 --empirical-factor 0.1 0.2 0.4 --repeats 20 --seed 1 --workers 4
+#
+# Prints one CSV line per cell, with the mean number of Grover-Long iterations, the mean success
+# probability and the success rate over the repeats.
+
+# Swept settings: name -> type of the command line values
+sweep_parameters = {
+    'n_index': int,
+    'n_shots': int,
+    'scrambler': str,
+    'empirical_factor': float,
+    'min_weight': float,
+    'lambda_schedule': str,
+    'first_lambda': float,
+    'max_lambda': float
+}
+
+# Environment variables that select and configure the backend (see `selector.BackendSelector`), which are part
+# of the memoization key. Credentials are deliberately left out.
+backend_environment = [
+    'SUSD_BACKEND', 'SUSD_DEVICE', 'SUSD_EXACT', 'SUSD_AER_METHOD', 'SUSD_AER_MPS_MAX_BOND', 'SUSD_IBM_SERVICE',
+    'SUSD_MEMORY_BUDGET'
+]
+
+
+def get_cells(grid: dict, base: dict) -> list:
+    """Returns the settings of each cell of the grid (the cartesian product of the grid values), in grid order.
+    The plain text and key of `base` are masked to the n_index of each cell.
+
+    :param grid: Dict of setting name -> list of values
+    :param base: Settings that are shared by all of the cells (see `search.create_runner`)
+    """
+    names = list(grid.keys())
+    cells = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        cell = dict(base, **dict(zip(names, values)))
+        n_mask = (1 << cell['n_index']) - 1
+        cell['plain'] = cell['plain'] & n_mask
+        cell['key'] = cell['key'] & n_mask
+        cells.append(cell)
+    return cells
+
+
+def get_code_version() -> str:
+    """Returns a hash of the source files of the search, so that memoized cells are recomputed when the code changes"""
+    digest = hashlib.sha256()
+    for path in sorted(pathlib.Path(__file__).parent.glob('*.py')):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def get_backend_config() -> dict:
+    return {name: os.environ[name] for name in backend_environment if name in os.environ}
+
+
+def get_cell_key(cell: dict, n_repeats: int, seed, code_version: str, backend_config: dict) -> str:
+    """Returns the memoization key of a cell: a hash of everything that determines its results"""
+    config = {
+        'settings': cell,
+        'n_repeats': n_repeats,
+        'seed': seed,
+        'code_version': code_version,
+        'backend': backend_config
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+class SweepCache():
+    """Finished cells of parameter sweeps, stored as one JSON file per memoization key"""
+
+    def __init__(self, directory):
+        """
+        :param directory: Cache directory (created if it does not exist)
+        """
+        self.directory = pathlib.Path(directory)
+
+    def get_path(self, key: str) -> pathlib.Path:
+        return self.directory / (key + '.json')
+
+    def get(self, key: str) -> dict:
+        """Returns the record of a finished cell, or None if it is not in the cache"""
+        path = self.get_path(key)
+        if not path.exists():
+            return None
+        with path.open() as file:
+            return json.load(file)
+
+    def put(self, key: str, record: dict) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        atomicfile.write(self.get_path(key), lambda file: json.dump(record, file))
+
+
+def is_lambda_error(e: Exception) -> bool:
+    """Returns True for the assertion of `GroverLong.get_g` and `GroverLong.get_alpha` that lambda is out of range,
+    which some settings of the model (e.g. a large first_lambda) are expected to trigger"""
+    return isinstance(e, AssertionError) and str(e).startswith('lambda parameter in Grover-Long')
+
+
+def run_cell(cell: dict, n_repeats: int, seed=None) -> dict:
+    """Runs the repeats of one cell and returns its record, with the `settings`, the `results` of the
+    repeats that finished and the `errors` of the repeats whose lambda went out of range.
+    Any other exception is raised, so that the cell is not cached."""
+    runner = search.create_runner(cell, verbose=False)
+    results = []
+    errors = []
+    try:
+        for repeat_seed in search.get_repeat_seeds(seed, n_repeats):
+            try:
+                results.append(runner.run(seed=repeat_seed))
+            except AssertionError as e:
+                if not is_lambda_error(e):
+                    raise
+                errors.append({'seed': repeat_seed, 'error': type(e).__name__ + ': ' + str(e)})
+    finally:
+        runner.backend.close()
+    return {'settings': cell, 'n_repeats': n_repeats, 'seed': seed, 'results': results, 'errors': errors}
+
+
+def run_sweep(cells: list, n_repeats: int, cache: SweepCache, seed=None, n_workers: int = 1, verbose: bool = True) -> list:
+    """Runs the cells that are not in the cache, spread over a pool of `n_workers` processes, and returns the
+    records of all of the cells in cell order. Each cell is added to the cache as soon as it finishes.
+    If a cell fails (other than by lambda going out of range, see `run_cell`), it is not cached, and the
+    first such exception is raised once the other cells have finished.
+
+    :param cells: Settings of the cells (see `get_cells`)
+    :param n_repeats: Number of repeats per cell
+    :param cache: Cache of finished cells
+    :param seed: Base seed for the repeats of each cell (see `search.get_repeat_seeds`)
+    :param n_workers: Number of worker processes (1 runs the cells serially in this process)
+    """
+    code_version = get_code_version()
+    backend_config = get_backend_config()
+    keys = [get_cell_key(cell, n_repeats, seed, code_version, backend_config) for cell in cells]
+    records = [cache.get(key) for key in keys]
+    missing = [i for i, record in enumerate(records) if record is None]
+    if verbose:
+        print(str(len(cells) - len(missing)) + ' of ' + str(len(cells)) + ' cells cached, running '
+              + str(len(missing)), file=sys.stderr)
+
+    def finish(i: int, record: dict) -> None:
+        record['code_version'] = code_version
+        record['backend_config'] = backend_config
+        cache.put(keys[i], record)
+        records[i] = record
+        if verbose:
+            print('cell ' + str(i) + ' done', file=sys.stderr)
+
+    if n_workers <= 1:
+        for i in missing:
+            finish(i, run_cell(cells[i], n_repeats, seed))
+        return records
+    error = None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(run_cell, cells[i], n_repeats, seed): i for i in missing}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+                continue
+            finish(futures[future], record)
+    if error is not None:
+        raise error
+    return records
+
+
+def get_summary(record: dict) -> dict:
+    """Returns the mean `sum_gl`, `total_shots` and `probability`, the `success_rate` (the fraction of repeats
+    whose most probable candidate is the key) and the number of `errors` of a cell"""
+    results = record['results']
+    probability = [r['probability'] for r in results if r['probability'] is not None]
+    return {
+        'repeats': len(results),
+        'errors': len(record['errors']),
+        'mean_sum_gl': numpy.mean([r['sum_gl'] for r in results]) if results else numpy.nan,
+        'mean_total_shots': numpy.mean([r['total_shots'] for r in results]) if results else numpy.nan,
+        'mean_probability': numpy.mean(probability) if probability else numpy.nan,
+        'success_rate': numpy.mean([r['candidate'] == record['settings']['key'] for r in results]) if results else numpy.nan
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the staged partial search over a grid of settings, with memoized cells')
+    for name, value_type in sweep_parameters.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=value_type, nargs='+', default=None)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--folded', action='store_true', help='Use the constant-folded keyscan oracle')
+    parser.add_argument('--phase-synthesis', default='ancilla')
+    parser.add_argument('--plain', type=lambda v: int(v, 0), default=scrambler.default_plain)
+    parser.add_argument('--key', type=lambda v: int(v, 0), default=scrambler.default_key)
+    parser.add_argument('--cache-dir', default='../results/sweeps')
+    args = parser.parse_args()
+
+    base = {
+        'scrambler': 'basic',
+        'n_index': 4,
+        'n_shots': 100,
+        'folded_oracle': args.folded,
+        'phase_synthesis': args.phase_synthesis,
+        'plain': args.plain,
+        'key': args.key,
+        # Defaults of partial.Partial, so that a cell has the same key whether or not a setting is swept
+        'empirical_factor': 0.2,
+        'min_weight': None,
+        'lambda_schedule': 'entropy',
+        'first_lambda': 0.5,
+        'max_lambda': None
+    }
+    grid = {name: getattr(args, name) for name in sweep_parameters if getattr(args, name) is not None}
+    cells = get_cells(grid, base)
+    # The backend is chosen (in each worker process) by BackendSelector from the SUSD_* environment variables
+    records = run_sweep(cells, args.repeats, SweepCache(args.cache_dir), seed=args.seed, n_workers=args.workers)
+    summary_names = ['repeats', 'errors', 'mean_sum_gl', 'mean_total_shots', 'mean_probability', 'success_rate']
+    print(','.join(list(grid.keys()) + summary_names))
+    for record in records:
+        summary = get_summary(record)
+        print(','.join([str(record['settings'][name]) for name in grid] + [str(summary[name]) for name in summary_names]))
+
+
+if __name__ == '__main__':
+    main()
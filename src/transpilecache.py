@@ -0,0 +1,91 @@
+import collections
+import hashlib
+import threading
+import qiskit
+import qiskit.circuit
+
+# The transpiler passes share process-wide state (e.g. the standard equivalence library) that is not
+# safe to use from several threads at once, so concurrent searches (see campaign.py) transpile in turn
+_transpile_lock = threading.Lock()
+
+
+class TranspileCache():
+    """LRU cache of transpiled circuits, keyed by a structural hash of the circuit and the target backend.
+
+    The structural hash covers the operation names, qubit/clbit layout and parameters of every
+    instruction, recursing into custom gates (e.g. the boxes created with `to_gate()`). Unbound
+    `Parameter` objects are hashed by name and UUID, so a parameterized circuit maps to the same entry
+    for every set of values that is later bound to it, but templates that were built with other
+    `Parameter` objects of the same names (e.g. by another search runner) do not share its entry,
+    since their parameters could not be bound to it.
+    """
+
+    def __init__(self, max_size: int = 32):
+        """
+        :param max_size: Maximum number of transpiled circuits to keep (0 disables the cache)
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def transpile(self, circuit: qiskit.circuit.QuantumCircuit, backend) -> qiskit.circuit.QuantumCircuit:
+        """Returns the transpiled circuit for the given backend, from the cache if possible"""
+        key = self.get_key(circuit, backend)
+        # The cache can be shared by concurrent searches (see campaign.py), so updates are locked
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        with _transpile_lock:
+            new_circuit = qiskit.transpile(circuit, backend)
+        if self.max_size > 0:
+            with self._lock:
+                self._entries[key] = new_circuit
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return new_circuit
+
+    def get_key(self, circuit: qiskit.circuit.QuantumCircuit, backend) -> str:
+        """Returns the cache key for the given circuit and target backend"""
+        target = (type(backend).__name__, getattr(backend, 'name', None))
+        structure = (target, get_circuit_structure(circuit))
+        return hashlib.sha256(repr(structure).encode()).hexdigest()
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def get_circuit_structure(circuit: qiskit.circuit.QuantumCircuit) -> tuple:
+    """Returns a hashable, deterministic description of the circuit's instructions"""
+    instructions = []
+    for instruction in circuit.data:
+        op = instruction.operation
+        qubits = tuple(circuit.find_bit(q).index for q in instruction.qubits)
+        clbits = tuple(circuit.find_bit(c).index for c in instruction.clbits)
+        params = tuple(_get_param_key(p) for p in op.params)
+        # Custom gates and instructions (as created by to_gate()) are identified by their definitions
+        if (type(op) in (qiskit.circuit.Gate, qiskit.circuit.Instruction)) and (op.definition is not None):
+            definition = get_circuit_structure(op.definition)
+        else:
+            definition = None
+        instructions.append((op.name, qubits, clbits, params, definition))
+    return (circuit.num_qubits, circuit.num_clbits, tuple(instructions))
+
+
+def _get_param_key(param):
+    if isinstance(param, qiskit.circuit.ParameterExpression):
+        # Parameters with the same name are different objects unless their UUIDs match
+        uuids = tuple(sorted((p.name, str(p.uuid)) for p in param.parameters))
+        return ('expr', str(param), uuids)
+    if isinstance(param, float):
+        return ('float', repr(param))
+    return (type(param).__name__, repr(param))
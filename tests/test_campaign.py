@@ -0,0 +1,73 @@
+import os
+import pathlib
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'src'))
+
+import campaign
+import search
+
+
+def get_settings(key: int) -> dict:
+    return {
+        'scrambler': 'basic',
+        'n_index': 5,
+        'n_shots': 50,
+        'folded_oracle': False,
+        'plain': 0b10010,
+        'key': key
+    }
+
+
+class CampaignTest(unittest.TestCase):
+
+    def setUp(self):
+        self._environ = dict(os.environ)
+        os.environ['SUSD_BACKEND'] = 'local_qiskit'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self._environ)
+
+    def test_shared_local_backend(self):
+        # Runners for the same n_index share the backend and its transpile cache
+        settings_list = [get_settings(0b01100), get_settings(0b01100), get_settings(0b10101)]
+        results = campaign.run_campaign(settings_list, max_in_flight=2, seed=1)
+        self.assertEqual(len(results), len(settings_list))
+        for result in results:
+            self.assertNotIsInstance(result, Exception)
+            self.assertGreater(result['total_shots'], 0)
+
+    def test_seeded_searches_match_single_runs(self):
+        # The shots and seed of every job are passed with it, so sharing the backend does not change the results
+        settings_list = [get_settings(0b01100), get_settings(0b10101)]
+        results = campaign.run_campaign(settings_list, max_in_flight=2, seed=2)
+        seeds = search.get_repeat_seeds(2, len(settings_list))
+        for settings, seed, result in zip(settings_list, seeds, results):
+            single_result = search.create_runner(settings, verbose=False).run(seed=seed)
+            self.assertEqual(result['stages'], single_result['stages'])
+            self.assertEqual(result['candidate'], single_result['candidate'])
+
+    def test_resume_from_checkpoints(self):
+        settings_list = [get_settings(0b01100), get_settings(0b10101)]
+        results = campaign.run_campaign(settings_list, max_in_flight=2, seed=3)
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            # Interrupt the first search after two stages
+            checkpoint_files = search.get_checkpoints(settings_list, checkpoint_dir, resume=True, prefix='search-')
+            runner = campaign.create_runners(settings_list[:1])[0]
+            seed = search.get_repeat_seeds(3, len(settings_list))[0]
+            state = runner.start(seed, checkpoint_files[0])
+            for i in range(2):
+                stage, lamb, gl = runner.plan_stage(state)
+                distrib, n_shots = runner.sample_stage(stage, lamb, gl, state['modelled_state'])
+                runner.finish_stage(state, stage, lamb, gl, distrib, n_shots, seed, checkpoint_files[0])
+            resumed_results = campaign.run_campaign(settings_list, max_in_flight=2, seed=3, checkpoint_dir=checkpoint_dir, resume=True)
+        for result, resumed_result in zip(results, resumed_results):
+            self.assertEqual(result['stages'], resumed_result['stages'])
+            self.assertEqual(result['candidate'], resumed_result['candidate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import pathlib
+import sys
+import tempfile
+import unittest
+
+import numpy
+import qiskit
+import qiskit.circuit
+from qiskit.quantum_info import Operator
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'src'))
+
+import gatelibrary
+import groverlong
+import stagetemplate
+
+
+def get_operator(gate: qiskit.circuit.Gate, values: dict) -> Operator:
+    """Returns the operator of a parameterized gate, with the parameters bound by name"""
+    circ = qiskit.circuit.QuantumCircuit(gate.num_qubits)
+    circ.append(gate, range(gate.num_qubits))
+    circ = circ.assign_parameters({p: values[p.name] for p in circ.parameters})
+    return Operator(circ)
+
+
+class GateLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self._library = gatelibrary._library
+
+    def tearDown(self):
+        gatelibrary._library = self._library
+
+    def test_round_trip(self):
+        # Gates loaded from disk must act like the freshly built gates, for every phase synthesis strategy
+        n_index = 8
+        flag_bits = [0, 2, 3, 5, 6]
+        values = {'phase': 0.63*numpy.pi}
+        values.update({'beta[' + str(i) + ']': 0.1 + 0.05*i for i in range(n_index)})
+        for strategy in groverlong.phase_synthesis_strategies:
+            with self.subTest(strategy=strategy), tempfile.TemporaryDirectory() as directory:
+                gatelibrary._library = gatelibrary.GateLibrary(directory=directory)
+                built = stagetemplate.SharedStageGates(n_index, strategy)
+                built_kickback = built.get_kickback_circbox(flag_bits)
+                self.assertEqual(gatelibrary._library.misses, 3)
+                # A new library (e.g. in another process) loads the gates from disk
+                gatelibrary._library = gatelibrary.GateLibrary(directory=directory)
+                loaded = stagetemplate.SharedStageGates(n_index, strategy)
+                loaded_kickback = loaded.get_kickback_circbox(flag_bits)
+                self.assertEqual(gatelibrary._library.disk_hits, 3)
+                for built_gate, loaded_gate in [
+                    (built.rotate_circbox, loaded.rotate_circbox),
+                    (built.diffusion_circbox, loaded.diffusion_circbox),
+                    (built_kickback, loaded_kickback)
+                ]:
+                    self.assertTrue(get_operator(loaded_gate, values).equiv(get_operator(built_gate, values)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import pathlib
+import sys
+import unittest
+
+import numpy
+import qiskit
+import qiskit.circuit
+from qiskit.quantum_info import Operator
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'src'))
+
+import groverlong
+
+
+def get_phase_operator(strategy: str, n_controls: int, controls: list, phase: float) -> numpy.ndarray:
+    """Returns the operator of the controlled phase on the states where the ancilla (the last qubit) is 0"""
+    circ = qiskit.circuit.QuantumCircuit(n_controls+1)
+    groverlong.GroverLong(strategy).add_controlled_phase(circ, controls, n_controls, phase)
+    # The ancilla is the most significant qubit, so its 0 subspace is the first half of the basis states
+    return Operator(circ).data[:, :2**n_controls]
+
+
+class PhaseSynthesisTest(unittest.TestCase):
+
+    def test_strategies_are_equivalent(self):
+        phase = 0.37*numpy.pi
+        for n_controls in range(1, 9):
+            controls = list(range(n_controls))
+            expected = get_phase_operator('ancilla', n_controls, controls, phase)
+            for strategy in ['mcp', 'relative']:
+                with self.subTest(n_controls=n_controls, strategy=strategy):
+                    actual = get_phase_operator(strategy, n_controls, controls, phase)
+                    numpy.testing.assert_allclose(actual, expected, atol=1e-9)
+
+    def test_kickback_strategies_are_equivalent(self):
+        # The kickback oracle tests a subset of the x qubits
+        n_index = 8
+        flag_bits = [1, 2, 4, 5, 7]
+        phase = 0.81*numpy.pi
+        operators = dict()
+        for strategy in groverlong.phase_synthesis_strategies:
+            circ = qiskit.circuit.QuantumCircuit(n_index+1)
+            circ.append(groverlong.GroverLong(strategy).get_oracle_kickback_circbox(n_index, flag_bits, phase), range(n_index+1))
+            operators[strategy] = Operator(circ).data[:, :2**n_index]
+        for strategy in ['mcp', 'relative']:
+            numpy.testing.assert_allclose(operators[strategy], operators['ancilla'], atol=1e-9)
+
+    def test_relative_uses_basic_gates(self):
+        # The 'relative' circuits must not contain multi-controlled X gates that are synthesized on demand (e.g. MCXVChain)
+        circ = qiskit.circuit.QuantumCircuit(13)
+        groverlong.GroverLong('relative').add_controlled_phase(circ, list(range(12)), 12, 0.5)
+        self.assertEqual([name for name in circ.count_ops() if name.startswith('mcx')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()